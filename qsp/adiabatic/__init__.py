@@ -1,4 +1,19 @@
 from .adiabatic_1d import adiabatic_state_preparation_1d
 from .adiabatic_2d import adiabatic_state_preparation_2d
+from .adiabatic_uniform import adiabatic_state_preparation_uniform
 
-__all__ = ["adiabatic_state_preparation_1d", "adiabatic_state_preparation_2d"]
+from .gate_sinks import GateSink
+from .gate_sinks import make_gate_sink
+
+from .schedules import gap_adapted_schedule
+from .schedules import make_schedule
+
+__all__ = [
+    "GateSink",
+    "adiabatic_state_preparation_1d",
+    "adiabatic_state_preparation_2d",
+    "adiabatic_state_preparation_uniform",
+    "gap_adapted_schedule",
+    "make_gate_sink",
+    "make_schedule",
+]
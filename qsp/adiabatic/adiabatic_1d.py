@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import hashlib
+
 import numpy as np
 import scipy as sp
 
@@ -8,20 +10,56 @@ import quimb.tensor as qtn
 import quimb as qu
 from tqdm import tqdm
 
+from ..tsp_helper_routines import check_checkpoint
+from ..tsp_helper_routines import load_checkpoint
+from ..tsp_helper_routines import save_checkpoint
+from ..tsp_helper_routines import should_validate
+
+from .gate_sinks import make_gate_sink
+from .observables_1d import measure_observables
+from .observables_1d import stack_site_tensors
+from .product_formulas import check_formula
+from .product_formulas import exponentiate_hermitian
+from .product_formulas import stage_hamiltonian
+from .product_formulas import stages
+from .product_formulas import sweep_sequence
+from .tebd_1d import mps_to_tebd
+from .tebd_1d import tebd_step
+from .tebd_1d import tebd_to_mps
+
+
+def evolution_gates(hamiltonian, phy_dim, dt):
+    """returns {bond: (evo_op, u, v)}, the evolution operator exp(-1j*dt*h) of
+    every bond and its split u, v into the two sites (evo_op = u v with the
+    physical indices of the sites grouped). bonds sharing the same term
+    object (e.g. the bulk of a translation invariant hamiltonian) share the
+    computation.
+    """
+    d = phy_dim
+
+    terms = {id(term): term for term in hamiltonian.values()}
+    evo_ops = exponentiate_hermitian(np.stack(list(terms.values())), d, dt)
 
-def make_evolution_mpo(hamiltonian, L, phy_dim, tau, Tmax, compress=True):
+    u, s, v = np.linalg.svd(evo_ops.transpose([0, 1, 3, 2, 4]).reshape(-1, d**2, d**2))
+    v = s[:, :, None] * v
+    splits = dict(zip(terms.keys(), zip(evo_ops, u, v)))
 
+    return {bond: splits[id(term)] for bond, term in hamiltonian.items()}
+
+
+def make_evolution_mpo(hamiltonian, L, phy_dim, tau, Tmax, compress=True):
+    """returns the mpos applying the gates of all bonds from left to right and
+    from right to left. both sweeps use the same gates, they are computed
+    once.
+    """
     gates = []
     d = phy_dim
+    bond_gates = evolution_gates(hamiltonian, d, tau * Tmax / 2)
 
     # mpo for applying gates from left to right
     mpo_tens = [[] for _ in range(L)]
     for bond in hamiltonian.keys():
-        evo_op = sp.linalg.expm(
-            -hamiltonian[bond].reshape(d**2, d**2) * 1j * tau * Tmax / 2
-        ).reshape((d, d, d, d))
-        u, s, v = sp.linalg.svd(evo_op.transpose([0, 2, 1, 3]).reshape(d**2, d**2))
-        v = np.diag(s) @ v
+        evo_op, u, v = bond_gates[bond]
 
         mpo_tens[bond[0]].append(u.reshape(d, d, -1))
         mpo_tens[bond[1]].append(v.reshape((-1, d, d)))  # first comes v and then u
@@ -44,11 +82,7 @@ def make_evolution_mpo(hamiltonian, L, phy_dim, tau, Tmax, compress=True):
     # mpo for applying gates from right to left
     mpo_tens = [[] for _ in range(L)]
     for bond in reversed(hamiltonian.keys()):  # run over all the interaction
-        evo_op = sp.linalg.expm(
-            -hamiltonian[bond].reshape(d**2, d**2) * 1j * tau * Tmax / 2
-        ).reshape((d, d, d, d))
-        u, s, v = sp.linalg.svd(evo_op.transpose([0, 2, 1, 3]).reshape(d**2, d**2))
-        v = np.diag(s) @ v
+        evo_op, u, v = bond_gates[bond]
 
         mpo_tens[bond[0]].append(u.reshape(d, d, -1))  # first comes u and then u
         mpo_tens[bond[1]].append(v.reshape((-1, d, d)))
@@ -102,32 +136,55 @@ def make_hamiltonian_mpo(hamiltonian, L, phy_dim, compress=False):
     return H_mpo, H_local_ham1D
 
 
-def constuct_parent_hamiltonian(Qs, L, phy_dim):
+def stack_bond_tensors(Qs, L):
+    """returns the two-site tensors of all bonds as (L-1, D*D, d*d) array, rows
+    are the (zero padded) outer bonds and columns the physical indices
+    """
+    stack = stack_site_tensors(Qs)
+    D, d = stack.shape[2:]
+
+    thetas = np.einsum("nlap,narq->nlrpq", stack[:-1], stack[1:])
+    return thetas.reshape(L - 1, D * D, d * d)
+
+
+def kernel_projectors(thetas, phy_dim):
+    """returns the projectors onto the kernels of the (n, m, d*d) matrices
+    thetas, computed with one batched (reduced) svd. the kernel is spanned by
+    the conjugated rows of vh beyond the rank, as in scipy.linalg.null_space,
+    so its projector is one minus the one onto the leading rows.
+    """
     d = phy_dim
+    _, s, vh = np.linalg.svd(thetas, full_matrices=False)
 
-    bonds = [(it, it + 1) for it in range(L - 1)]
+    rcond = np.finfo(s.dtype).eps * max(thetas.shape[1:])
+    ranks = np.sum(s > rcond * np.max(s, axis=-1, keepdims=True), axis=-1)
+    in_range = np.arange(s.shape[-1])[None, :] < ranks[:, None]
 
-    hamiltonian = {}
-    for (site1, site2) in bonds:
-        Q1, Q2 = Qs[site1], Qs[site2]
+    vh = vh * in_range[..., None]
+    projectors = np.eye(d**2) - np.swapaxes(vh, 1, 2) @ np.conj(vh)
+    return projectors.reshape(-1, d, d, d, d)
 
-        if Q1.ndim == 2:
-            Q1 = np.expand_dims(Q1, axis=0)
 
-        if Q2.ndim == 2:
-            Q2 = np.expand_dims(Q2, axis=1)
+def constuct_parent_hamiltonian(Qs, L, phy_dim, translation_invariant=False):
+    """returns the parent hamiltonian of the mps Qs as {bond: term}, every
+    term projects onto the kernel of the two-site tensor of its bond. all
+    terms are computed at once from the stacked two-site tensors.
 
-        kernel = sp.linalg.null_space(
-            ncon([Q1, Q2], [(-1, 1, -3), (1, -2, -4)]).reshape(-1, d**2)
-        )
+    if translation_invariant (all bulk tensors equal), only the two boundary
+    terms and a single bulk term, shared by all bulk bonds, are computed.
+    """
+    bonds = [(it, it + 1) for it in range(L - 1)]
 
-        ham_term = 0.0
-        for it in range(kernel.shape[1]):
-            v = kernel[:, it]
-            ham_term += ncon((np.conj(v), v), ([-1], [-2]))
-        hamiltonian[(site1, site2)] = ham_term.reshape((d, d, d, d))
+    if translation_invariant and L > 3:
+        Qs_reduced = [Qs[0], Qs[1], Qs[1], Qs[L - 1]]
+        first, bulk, last = kernel_projectors(
+            stack_bond_tensors(Qs_reduced, 4), phy_dim
+        )
+        ham_terms = [first] + [bulk] * (L - 3) + [last]
+    else:
+        ham_terms = kernel_projectors(stack_bond_tensors(Qs, L), phy_dim)
 
-    return hamiltonian
+    return dict(zip(bonds, ham_terms))
 
 
 def calculate_energy_from_parent_hamiltonian_mpo(mps, H_mpo):
@@ -138,9 +195,201 @@ def calculate_energy_from_parent_hamiltonian_mpo(mps, H_mpo):
     return exp_val
 
 
+# range of the adaptive step size, relative to the initial step tau
+ADAPTIVE_TAU_RANGE = (1 / 16, 16)
+
+# histories of adiabatic_state_preparation_1d, one value per step
+HISTORY_KEYS = ("ts", "ss", "energy", "target_fidelity", "current_fidelity")
+
+
+def interpolated_mps(initial_mps, target_mps, s):
+    """returns the tensors (1-s)*initial + s*target and their normalized mps"""
+    Qs = [
+        (1 - s) * initial.data + s * target.data
+        for initial, target in zip(initial_mps, target_mps)
+    ]
+    mps_s = qtn.MatrixProductState(Qs, shape="lrp")
+    mps_s.normalize()
+    return Qs, mps_s
+
+
+def schedule_fingerprint(s_func, ts):
+    """a hash of the values of the schedule s_func at the times ts"""
+    ss = np.array([s_func(t) for t in ts], dtype=np.float64)
+    return hashlib.sha1(ss.tobytes()).hexdigest()
+
+
+def step_hamiltonians(
+    initial_mps,
+    target_mps,
+    s_func,
+    t,
+    tau,
+    Tmax,
+    L,
+    phy_dim,
+    translation_invariant,
+    cache,
+):
+    """returns hamiltonian_at(f), the parent hamiltonian at the time t + f*tau
+    of a step (at most Tmax, the last step must not ask s_func for s past its
+    end), cache {f: hamiltonian} holds the ones already computed
+    """
+
+    def hamiltonian_at(f):
+        if f not in cache:
+            s = s_func(min(t + f * tau, Tmax))
+            Qs, _ = interpolated_mps(initial_mps, target_mps, s)
+            cache[f] = constuct_parent_hamiltonian(
+                Qs, L, phy_dim, translation_invariant=translation_invariant
+            )
+        return cache[f]
+
+    return hamiltonian_at
+
+
+def trotter_step(
+    psi,
+    tebd_state,
+    hamiltonian_at,
+    L,
+    phy_dim,
+    tau,
+    Tmax,
+    max_bond,
+    formula="second",
+    record_gates=True,
+):
+    """one trotter step of length tau with the product formula formula,
+    returns the evolved mps, the bonds (their first site) and the applied
+    gates. hamiltonian_at(f) returns the parent hamiltonian at the fraction f
+    of the step (see
+    product_formulas.stages). with tebd_state = (B, lambdas) the tebd
+    integrator is used (and tebd_state is updated inplace), otherwise the mpo
+    integrator, which applies every stage of the compositions as a left to
+    right and a right to left mpo sweep. the mpo integrator only builds the
+    gates of the circuit if record_gates (no bonds and gates otherwise).
+    """
+    if tebd_state is not None:
+
+        def terms_at(nodes):
+            return np.stack(list(stage_hamiltonian(hamiltonian_at, nodes).values()))
+
+        bonds_curr, gates_curr = tebd_step(
+            *tebd_state, terms_at, tau * Tmax, formula=formula
+        )
+        return tebd_to_mps(tebd_state[0], max_bond), bonds_curr, gates_curr
+
+    check_formula(formula, compositions_only=True)
+    bonds = list(hamiltonian_at(0.0).keys())
+
+    # the gates exp(-1j*weight/2*tau*Tmax*h) of both sweeps of every stage
+    half_steps = {}
+    for weight, nodes in stages(formula):
+        mpo_lr, mpo_rl, stage_gates = make_evolution_mpo(
+            stage_hamiltonian(hamiltonian_at, nodes),
+            L,
+            phy_dim,
+            weight * tau,
+            Tmax,
+            compress=True,
+        )
+        half_steps[nodes] = (weight / 2, dict(zip(bonds, stage_gates)))
+
+        psi = mpo_lr.apply(psi)
+        psi.compress(max_bond=max_bond)
+
+        psi = mpo_rl.apply(psi)
+        psi.compress(max_bond=max_bond)
+
+    psi.normalize()
+
+    if not record_gates:
+        return psi, [], []
+
+    # the gates of a circuit, where the gates at the turning points of the
+    # sweeps are merged, i.e. a piece is a power of the sweep gate
+    d = phy_dim
+    bonds_curr, gates_curr = [], []
+    for bond, pieces in sweep_sequence(bonds, formula):
+        gate = np.eye(d**2)
+        for coeff, nodes in pieces:
+            half_weight, evo_ops = half_steps[nodes]
+            power = int(round(coeff / half_weight))
+            evo_op = evo_ops[bond].reshape(d**2, d**2)
+            gate = np.linalg.matrix_power(evo_op, power) @ gate
+
+        bonds_curr.append(bond[0])
+        gates_curr.append(gate.reshape(d, d, d, d))
+    return psi, bonds_curr, gates_curr
+
+
 def adiabatic_state_preparation_1d(
-    target_mps, initial_mps, Tmax, tau, s_func, max_bond, verbose=False
+    target_mps,
+    initial_mps,
+    Tmax,
+    tau,
+    s_func,
+    max_bond,
+    verbose=False,
+    checkpoint_file=None,
+    checkpoint_every=10,
+    translation_invariant=False,
+    integrator="mpo",
+    adaptive_tol=None,
+    formula="second",
+    gate_sink="memory",
+    measure_every=1,
 ):
+    """if checkpoint_file is given, the evolved mps and the accumulated history
+    are written to it every checkpoint_every time steps. calling the function
+    again with the same checkpoint_file resumes the evolution from the last
+    saved time step. for translation invariant target and initial mps,
+    translation_invariant=True computes a single bulk term of the parent
+    hamiltonian (see constuct_parent_hamiltonian).
+
+    integrator="mpo" applies the gates of every time step as two mpos (left
+    to right and right to left sweep) and compresses the mps to max_bond
+    after each. integrator="tebd" applies them as even/odd layers of
+    two-site updates truncated to max_bond (see tebd_1d), without building
+    mpos or compressing the whole mps.
+
+    formula selects the product formula of a time step (see
+    product_formulas): "second" (default, the parent hamiltonian frozen at
+    the beginning of the step), "midpoint2" (the same split evaluated at the
+    midpoint of the step), the fourth order compositions "suzuki4" and
+    "yoshida4" and, for the tebd integrator only, the optimized even/odd
+    splittings "omelyan2" and "omelyan4". all but "second" evaluate the
+    parent hamiltonian within the step where the formula needs it, so the
+    fourth order formulas stay fourth order for the time dependent
+    hamiltonian and allow larger tau at equal accuracy.
+
+    if adaptive_tol is given, tau is only the initial step size. the step
+    size is halved until the instantaneous ground states at the beginning and
+    the end of the step have an infidelity of at most adaptive_tol (the
+    change the evolved state has to follow), and it grows by 1.5 after steps
+    with less than adaptive_tol/4 (within ADAPTIVE_TAU_RANGE). this only
+    needs overlaps of the interpolated mps, no step is repeated. the last
+    step ends at Tmax.
+
+    the gates of every step are passed to gate_sink (see gate_sinks):
+    "memory" keeps them as {t: gates} (the default), "discard" drops them,
+    "summary" keeps their number, their estimated cost and a random sample,
+    a path ending in .npy or .qasm streams them to that file. data["gates"] is what the sink
+    returns. the histories are kept in arrays over the steps, preallocated
+    for the largest number of steps, data["ss"], data["energy"],
+    data["target_fidelity"] and data["current_fidelity"] are {t: value} as
+    in the other drivers and data["history"] holds the arrays (nan where not
+    measured, data["history"]["ts"] are the times).
+
+    the target and instantaneous fidelities and the energy of psi in the
+    parent hamiltonian at s are measured every measure_every steps (and at
+    the last one) from shared environments of psi (see observables_1d).
+    """
+    if integrator not in ["mpo", "tebd"]:
+        raise ValueError(f"integrator should be mpo or tebd, got {integrator}")
+    check_formula(formula, compositions_only=integrator == "mpo")
+
     L = target_mps.L
     phy_dim = target_mps.phys_dim()
 
@@ -151,66 +400,152 @@ def adiabatic_state_preparation_1d(
     initial_mps.normalize()
 
     ts = np.arange(0, Tmax + tau, tau)
-    ss, energy, target_fidelity, current_fidelity = {}, {}, {}, {}
-    gates = {}
-
-    psi = initial_mps
-    for t in tqdm(ts):
-        s = s_func(t)
+    min_dt, max_dt = tau * ADAPTIVE_TAU_RANGE[0], tau * ADAPTIVE_TAU_RANGE[1]
+
+    num_steps = len(ts) if adaptive_tol is None else int(np.ceil(ts[-1] / min_dt)) + 2
+    history = {key: np.full(num_steps, np.nan) for key in HISTORY_KEYS}
+    gate_sink = make_gate_sink(gate_sink)
+
+    # a resumed run has to continue the same integration, the schedule is
+    # compared by its values on the time grid
+    settings = {
+        "Tmax": Tmax,
+        "tau": tau,
+        "max_bond": max_bond,
+        "integrator": integrator,
+        "formula": formula,
+        "adaptive_tol": adaptive_tol,
+        "measure_every": measure_every,
+        "schedule": schedule_fingerprint(s_func, ts),
+    }
 
-        Qs = [0] * L
-        for site, (initial, target) in enumerate(zip(initial_mps, target_mps)):
-            Qs[site] = (1 - s) * initial.data + s * target.data
+    psi, step, t, dt = initial_mps, 0, 0.0, tau
+    state = load_checkpoint(checkpoint_file)
+    if state is not None:
+        check_checkpoint(state, **settings)
+        psi, step = state["psi"], state["step"] + 1
+        t = state.get("t_next", ts[step] if step < len(ts) else np.inf)
+        dt = state.get("dt", tau)
+        history = state["history"]
+    gate_sink.start(L, phy_dim, None if state is None else state["gate_sink"])
 
-        hamiltonian = constuct_parent_hamiltonian(Qs, L, phy_dim)
-        hamiltonian_mpo, _ = make_hamiltonian_mpo(
-            hamiltonian, L, phy_dim, compress=False
-        )
-        mpo_lr, mpo_rl, gates_curr = make_evolution_mpo(
-            hamiltonian, L, phy_dim, tau, Tmax, compress=True
-        )
+    tebd_state = mps_to_tebd(psi, max_bond) if integrator == "tebd" else None
 
-        mps_s = qtn.MatrixProductState(Qs, shape="lrp")
-        mps_s.normalize()
+    progress = tqdm(initial=step, total=len(ts))
+    while t <= ts[-1]:
+        s = s_func(t)
 
-        # sanity check to see if the mps is indeed the ground state of the parent hamiltonian
-        assert (
-            calculate_energy_from_parent_hamiltonian_mpo(mps_s, hamiltonian_mpo) / L
-            < 1e-14
+        Qs, mps_s = interpolated_mps(initial_mps, target_mps, s)
+        hamiltonian = constuct_parent_hamiltonian(
+            Qs, L, phy_dim, translation_invariant=translation_invariant
         )
 
-        ## apply second order trotter decomposition
-        psi = mpo_lr.apply(psi)
-        psi.compress(max_bond=max_bond)
+        # sanity check to see if the mps is indeed the ground state of the parent hamiltonian
+        if should_validate("parent_hamiltonian"):
+            hamiltonian_mpo, _ = make_hamiltonian_mpo(
+                hamiltonian, L, phy_dim, compress=False
+            )
+            assert (
+                calculate_energy_from_parent_hamiltonian_mpo(mps_s, hamiltonian_mpo) / L
+                < 1e-14
+            )
 
-        psi = mpo_rl.apply(psi)
-        psi.compress(max_bond=max_bond)
+        # the step ends where the instantaneous ground state is at most
+        # adaptive_tol away
+        dt_step, jump = dt, 0.0
+        while adaptive_tol is not None:
+            dt_step = min(dt, ts[-1] - t) if t < ts[-1] else dt
+            s_next = s_func(min(t + dt_step, Tmax))
+            _, mps_next = interpolated_mps(initial_mps, target_mps, s_next)
+            jump = 1 - np.abs(((mps_s.H & mps_next) ^ all))
+            if jump <= adaptive_tol or dt <= min_dt:
+                break
+            dt = max(dt / 2, min_dt)
+
+        ## apply the trotter decomposition
+        hamiltonian_at = step_hamiltonians(
+            initial_mps,
+            target_mps,
+            s_func,
+            t,
+            dt_step,
+            Tmax,
+            L,
+            phy_dim,
+            translation_invariant,
+            {0.0: hamiltonian},
+        )
+        psi, bonds_curr, gates_curr = trotter_step(
+            psi,
+            tebd_state,
+            hamiltonian_at,
+            L,
+            phy_dim,
+            dt_step,
+            Tmax,
+            max_bond,
+            formula=formula,
+            record_gates=gate_sink.keeps_gates,
+        )
 
-        psi.normalize()
+        if adaptive_tol is None:
+            t_next = ts[step + 1] if step + 1 < len(ts) else np.inf
+        else:
+            t_next = t + dt_step
+            if jump < adaptive_tol / 4:
+                dt = min(1.5 * dt, max_dt)
 
         ###
-        ss[t] = s
-        energy[
-            t
-        ] = 0  # np.real(calculate_energy_from_parent_hamiltonian_mpo(psi, hamiltonian_mpo))
-        target_fidelity[t] = np.abs(((target_mps.H & psi) ^ all))
-        current_fidelity[t] = np.abs(((mps_s.H & psi) ^ all))
-        gates[t] = gates_curr
-
-        if verbose:
-            print(
-                f"\n{t=:.2f}, {s=:.4f}, e={energy[t]:.4f}, "
-                f"f={target_fidelity[t]:.8f}, curr_f={current_fidelity[t]:.8f}\n"
+        history["ts"][step] = t
+        history["ss"][step] = s
+        if step % measure_every == 0 or t_next > ts[-1]:
+            (
+                history["target_fidelity"][step],
+                history["current_fidelity"][step],
+                history["energy"][step],
+            ) = measure_observables(psi, target_mps, mps_s, hamiltonian)
+
+            if verbose:
+                print(
+                    f"\n{t=:.2f}, {s=:.4f}, e={history['energy'][step]:.4f}, "
+                    f"f={history['target_fidelity'][step]:.8f}, "
+                    f"curr_f={history['current_fidelity'][step]:.8f}\n"
+                )
+        gate_sink.add(step, t, bonds_curr, gates_curr)
+
+        if checkpoint_file is not None and (
+            (step + 1) % checkpoint_every == 0 or t_next > ts[-1]
+        ):
+            save_checkpoint(
+                checkpoint_file,
+                {
+                    **settings,
+                    "step": step,
+                    "t_next": t_next,
+                    "dt": dt,
+                    "psi": psi,
+                    "history": history,
+                    "gate_sink": gate_sink.state(),
+                },
             )
 
+        step, t = step + 1, t_next
+        progress.update()
+    progress.close()
+
     ###################################
+    history = {key: values[:step] for key, values in history.items()}
     data = {
-        "ss": ss,
-        "energy": energy,
-        "target_fidelity": target_fidelity,
-        "current_fidelity": current_fidelity,
-        "gates": gates,
+        key: {
+            t: value
+            for t, value in zip(history["ts"], values.tolist())
+            if not np.isnan(value)
+        }
+        for key, values in history.items()
+        if key != "ts"
     }
+    data["history"] = history
+    data["gates"] = gate_sink.close()
     return data
 
 
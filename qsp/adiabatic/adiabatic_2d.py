@@ -8,6 +8,14 @@ import quimb as qu
 import quimb.tensor as qtn
 from tqdm import tqdm
 
+from ..tsp_helper_routines import check_checkpoint
+from ..tsp_helper_routines import load_checkpoint
+from ..tsp_helper_routines import save_checkpoint
+
+from .product_formulas import sequence_gates
+from .product_formulas import stage_hamiltonian
+from .product_formulas import sweep_sequence
+
 
 def construct_parent_hamiltonian(tensor_grid, bonds, Lx, Ly, phy_dim):
     d = phy_dim
@@ -45,16 +53,28 @@ def construct_parent_hamiltonian(tensor_grid, bonds, Lx, Ly, phy_dim):
     return hamiltonian, quimb_hamiltonian
 
 
-def apply_evolution_operator(parent_hamiltonian, peps, tau, Tmax, max_bond, phy_dim):
-    d = phy_dim
-    for bond, curr_term in parent_hamiltonian.terms.items():
-
-        curr_gate = sp.linalg.expm(-curr_term.reshape(d**2, d**2) * 1j * tau * Tmax)
-        peps.gate(
-            curr_gate.reshape((d, d, d, d)), where=bond, contract="split", inplace=True
-        )
+def apply_evolution_operator(
+    hamiltonian_at, peps, tau, Tmax, max_bond, phy_dim, formula="first"
+):
+    """applies the gates of one trotter step with the product formula formula
+    (see product_formulas.sweep_sequence), "first" applies every bond once in
+    a single sweep. hamiltonian_at(f) returns the terms {bond: term} of the
+    parent hamiltonian at the fraction f of the step. returns the number of
+    applied gates.
+    """
+    sequence = sweep_sequence(list(hamiltonian_at(0.0).keys()), formula)
+    gates = sequence_gates(
+        lambda nodes: stage_hamiltonian(hamiltonian_at, nodes),
+        sequence,
+        phy_dim,
+        tau * Tmax,
+    )
+    for (bond, _), curr_gate in zip(sequence, gates):
+        peps.gate(curr_gate, where=bond, contract="split", inplace=True)
         peps.compress_all(inplace=True, max_bond=max_bond)
 
+    return len(sequence)
+
 
 def linear_interpolation(s, target_grid, initial_grid):
     tensor_grid = []
@@ -80,8 +100,22 @@ def adiabatic_state_preparation_2d(
     max_bond,
     s_func,
     verbose=False,
+    checkpoint_file=None,
+    checkpoint_every=10,
+    formula="first",
 ):
-
+    """if checkpoint_file is given, the evolved peps and the accumulated history
+    are written to it every checkpoint_every time steps. calling the function
+    again with the same checkpoint_file resumes the evolution from the last
+    saved time step.
+
+    formula is the product formula of a time step: "first" (one sweep over
+    the bonds), "second" (forward and backward sweep), "midpoint2" (the
+    same evaluated at the midpoint of the step) or the fourth order
+    compositions "suzuki4" and "yoshida4" (see product_formulas), all but
+    "first" and "second" evaluate the parent hamiltonian within the step.
+    the number of gates of every step is recorded in num_gates.
+    """
     target_peps = qtn.PEPS(target_grid, shape="ldrup")
     target_peps.normalize(inplace=True)
 
@@ -90,15 +124,46 @@ def adiabatic_state_preparation_2d(
 
     ts = np.arange(0, Tmax + tau, tau)
 
-    ss, target_fidelity, energy = {}, {}, {}
-    for t in tqdm(ts):
+    ss, target_fidelity, energy, num_gates = {}, {}, {}, {}
+
+    start = 0
+    state = load_checkpoint(checkpoint_file)
+    if state is not None:
+        check_checkpoint(state, Tmax=Tmax, tau=tau, max_bond=max_bond)
+        peps, start = state["peps"], state["step"] + 1
+        ss, target_fidelity, energy = (
+            state["ss"],
+            state["target_fidelity"],
+            state["energy"],
+        )
+        num_gates = state.get("num_gates", {})
+
+    for step in tqdm(range(start, len(ts)), initial=start, total=len(ts)):
+        t = ts[step]
         s = s_func(t)
         tensor_grid = linear_interpolation(s, target_grid, initial_grid)
 
         _, hamiltonian = construct_parent_hamiltonian(
             tensor_grid, bonds, Lx, Ly, phy_dim
         )
-        apply_evolution_operator(hamiltonian, peps, tau, Tmax, max_bond, phy_dim)
+        # the parent hamiltonian at the times within the step the formula
+        # needs, the last step must not ask s_func for s past Tmax
+        terms = {0.0: hamiltonian.terms}
+
+        def hamiltonian_at(f):
+            if f not in terms:
+                grid = linear_interpolation(
+                    s_func(min(t + f * tau, Tmax)), target_grid, initial_grid
+                )
+                _, hamiltonian_f = construct_parent_hamiltonian(
+                    grid, bonds, Lx, Ly, phy_dim
+                )
+                terms[f] = hamiltonian_f.terms
+            return terms[f]
+
+        num_gates[t] = apply_evolution_operator(
+            hamiltonian_at, peps, tau, Tmax, max_bond, phy_dim, formula=formula
+        )
         peps.normalize(inplace=True)
 
         ss[t] = s
@@ -109,7 +174,30 @@ def adiabatic_state_preparation_2d(
                 f"\n{t=:.2f}, {s=:.5f}, e={energy[t]:.08f}, f={target_fidelity[t]:.08f}\n"
             )
 
-    data = {"ss": ss, "target_fidelity": target_fidelity, "energy": energy}
+        if checkpoint_file is not None and (
+            (step + 1) % checkpoint_every == 0 or (step + 1) == len(ts)
+        ):
+            save_checkpoint(
+                checkpoint_file,
+                {
+                    "Tmax": Tmax,
+                    "tau": tau,
+                    "max_bond": max_bond,
+                    "step": step,
+                    "peps": peps,
+                    "ss": ss,
+                    "target_fidelity": target_fidelity,
+                    "energy": energy,
+                    "num_gates": num_gates,
+                },
+            )
+
+    data = {
+        "ss": ss,
+        "target_fidelity": target_fidelity,
+        "energy": energy,
+        "num_gates": num_gates,
+    }
 
     return data
 
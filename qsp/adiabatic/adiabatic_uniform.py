@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""adiabatic preparation of uniform (infinite) mps. the interpolated state is
+described by a single bulk tensor, so every time step needs a single bulk
+parent hamiltonian term and gate. the state is evolved with itebd on a two-site
+unit cell and all fidelities are per site, i.e. independent of the system
+size.
+"""
+
+import numpy as np
+from tqdm import tqdm
+
+from ..tsp_helper_routines import should_validate
+
+from .adiabatic_1d import kernel_projectors
+from .gate_sinks import make_gate_sink
+from .product_formulas import check_formula
+from .product_formulas import stage_hamiltonian
+from .tebd_1d import itebd_step
+
+
+def _dominant_eigenvector(transfer_matrix):
+    vals, vecs = np.linalg.eig(transfer_matrix)
+    it = np.argmax(np.abs(vals))
+    return vals[it], vecs[:, it]
+
+
+def _fixed_point(transfer_matrix, D):
+    """dominant eigenvalue and (hermitian, positive) fixed point"""
+    val, vec = _dominant_eigenvector(transfer_matrix)
+    fixed_point = vec.reshape(D, D)
+    fixed_point = fixed_point / np.trace(fixed_point)
+    return np.abs(val), (fixed_point + np.conj(fixed_point.T)) / 2
+
+
+def transfer_matrix(A, T=None):
+    """sum_p A_p x conj(T_p) as (D_A*D_T, D_A*D_T) matrix, A and T are
+    (l, p, r) tensors
+    """
+    T = A if T is None else T
+    Da, Dt = A.shape[0], T.shape[0]
+    E = np.einsum("apb,cpd->acbd", A, np.conj(T))
+    return E.reshape(Da * Dt, Da * Dt)
+
+
+def normalize_uniform(A):
+    """rescales the (l, p, r) bulk tensor A such that the uniform mps has norm
+    one per site
+    """
+    val, _ = _dominant_eigenvector(transfer_matrix(A))
+    return A / np.sqrt(np.abs(val))
+
+
+def uniform_canonical_form(A, max_bond):
+    """returns the right canonical tensor B (chi, d, chi) and the schmidt
+    values (chi,) of the uniform mps with the (l, p, r) bulk tensor A, zero
+    padded (or truncated) to chi = max_bond. A should be injective.
+    """
+    D = A.shape[0]
+    A = normalize_uniform(A)
+
+    # sum_p A_p R A_p^dag = R = X X^dag, B_p = X^-1 A_p X is right canonical
+    _, R = _fixed_point(transfer_matrix(A), D)
+    w, W = np.linalg.eigh(R)
+    X = W * np.sqrt(np.clip(w, 0.0, None))
+    B = np.einsum("ab,bpc,cd->apd", np.linalg.inv(X), A, X)
+
+    # the left fixed point of B is diagonal (the squared schmidt values) in
+    # the eigenbasis of the left fixed point
+    _, L = _fixed_point(np.conj(transfer_matrix(B).T), D)
+    w, W = np.linalg.eigh(L)
+    w, W = w[::-1], W[:, ::-1]
+    B = np.einsum("ba,bpc,cd->apd", np.conj(W), B, W)
+    lam = np.sqrt(np.clip(w, 0.0, None))
+
+    chi = max_bond
+    keep = min(D, chi)
+    B_padded = np.zeros((chi, A.shape[1], chi), dtype=np.complex128)
+    B_padded[:keep, :, :keep] = B[:keep, :, :keep]
+    lam_padded = np.zeros(chi)
+    lam_padded[:keep] = lam[:keep] / np.linalg.norm(lam[:keep])
+    return B_padded, lam_padded
+
+
+def uniform_fidelity(B, T):
+    """|<T|psi>| per site of the uniform mps with the (normalized) bulk tensor
+    T and the right canonical unit cell B (n, chi, d, chi)
+    """
+    transfer = transfer_matrix(B[0], T)
+    for B_site in B[1:]:
+        transfer = transfer @ transfer_matrix(B_site, T)
+
+    val, _ = _dominant_eigenvector(transfer)
+    return np.abs(val) ** (1 / len(B))
+
+
+def uniform_energy(B, lambdas, ham_term):
+    """<psi|h|psi> per site, averaged over the bonds of the unit cell"""
+    d = B.shape[2]
+    h = ham_term.reshape(d**2, d**2)
+
+    energies = []
+    for site in range(len(B)):
+        theta = np.einsum(
+            "l,lpa,aqr->lpqr", lambdas[site], B[site], B[(site + 1) % len(B)]
+        )
+        theta = theta.transpose(0, 3, 1, 2).reshape(-1, d**2)
+        energies.append(np.real(np.sum(np.conj(theta) * (theta @ h.T))))
+
+    return np.mean(energies)
+
+
+def bulk_parent_term(initial, target, s):
+    """returns the interpolated (l, p, r) bulk tensor, its (1, D*D, d*d)
+    two-site tensor and the (d, d, d, d) bulk term of the parent hamiltonian
+    """
+    d = target.shape[1]
+    Q = (1 - s) * initial + s * target
+    theta = np.einsum("lpa,aqr->lrpq", Q, Q).reshape(1, -1, d**2)
+    return Q, theta, kernel_projectors(theta, d)[0]
+
+
+def adiabatic_state_preparation_uniform(
+    target_tensor,
+    initial_tensor,
+    Tmax,
+    tau,
+    s_func,
+    max_bond,
+    verbose=False,
+    formula="second",
+    gate_sink="memory",
+):
+    """adiabatic preparation of the uniform mps with the bulk tensor
+    target_tensor, starting from the one with the bulk tensor initial_tensor
+    (both (l, r, p) as the bulk tensors of make_aklt_mps and
+    make_bell_pair_mps, with the same bond dimension). the evolved state is a
+    uniform mps of bond dimension max_bond with a two-site unit cell, the
+    energy and fidelities are per site. formula is the product formula of a
+    time step, see product_formulas.
+
+    the gates of every step are passed to gate_sink as in
+    adiabatic_state_preparation_1d (see gate_sinks), on the sites of the
+    unit cell and the first site of the next one (the bond (1, 0) of the
+    unit cell is the bond 1 of these three sites). data["gates"] is what the
+    sink returns, {t: gates} for the default "memory".
+    """
+    check_formula(formula)
+
+    target = normalize_uniform(np.asarray(target_tensor).transpose(0, 2, 1))
+    initial = normalize_uniform(np.asarray(initial_tensor).transpose(0, 2, 1))
+    d = target.shape[1]
+
+    B, lam = uniform_canonical_form(initial, max_bond)
+    B, lambdas = np.stack([B, B]), np.stack([lam, lam])
+
+    ts = np.arange(0, Tmax + tau, tau)
+    ss, energy, target_fidelity, current_fidelity = {}, {}, {}, {}
+    gate_sink = make_gate_sink(gate_sink)
+    gate_sink.start(len(B) + 1, d)
+
+    for step, t in enumerate(tqdm(ts)):
+        s = s_func(t)
+
+        Q, theta, ham_term = bulk_parent_term(initial, target, s)
+
+        # sanity check to see if the state is annihilated by the bulk term
+        if should_validate("parent_hamiltonian"):
+            residual = theta[0] @ ham_term.reshape(d**2, d**2).T
+            assert np.linalg.norm(residual) < 1e-12 * np.linalg.norm(theta[0])
+
+        # the bulk term at the times within the step the formula needs, the
+        # last step must not ask s_func for s past Tmax
+        terms = {0.0: {0: ham_term}}
+
+        def hamiltonian_at(f):
+            if f not in terms:
+                s_f = s_func(min(t + f * tau, Tmax))
+                terms[f] = {0: bulk_parent_term(initial, target, s_f)[2]}
+            return terms[f]
+
+        bonds_curr, gates_curr = itebd_step(
+            B,
+            lambdas,
+            lambda nodes: stage_hamiltonian(hamiltonian_at, nodes)[0],
+            tau * Tmax,
+            formula=formula,
+        )
+
+        ss[t] = s
+        energy[t] = uniform_energy(B, lambdas, ham_term)
+        target_fidelity[t] = uniform_fidelity(B, target)
+        current_fidelity[t] = uniform_fidelity(B, normalize_uniform(Q))
+        gate_sink.add(step, t, bonds_curr, gates_curr)
+
+        if verbose:
+            print(
+                f"\n{t=:.2f}, {s=:.4f}, e={energy[t]:.4f}, "
+                f"f={target_fidelity[t]:.8f}, curr_f={current_fidelity[t]:.8f}\n"
+            )
+
+    data = {
+        "ss": ss,
+        "energy": energy,
+        "target_fidelity": target_fidelity,
+        "current_fidelity": current_fidelity,
+        "gates": gate_sink.close(),
+    }
+    return data
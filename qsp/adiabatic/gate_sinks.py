@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""sinks for the two-site gates of the adiabatic evolution. every time step
+passes its gates (and the bonds they act on) to the sink, which keeps them in
+memory (as before), discards them, keeps summary statistics only, or streams
+them to an .npy file or an openqasm 2 file, so the memory does not grow with
+the number of steps.
+
+the adiabatic routines call start(num_sites, phy_dim, state) before the first
+step, add(step, t, bonds, gates) after every step and close() at the end,
+whose result is returned as data["gates"]. state() is saved in the
+checkpoints, start(..., state) resumes from it (file sinks drop what was
+written after the checkpoint).
+"""
+
+import os
+import struct
+
+import numpy as np
+
+# fixed size of the .npy header, so it can be rewritten with the final shape
+_NPY_HEADER_SIZE = 256
+
+
+class GateSink:
+    # False if the sink ignores the gates, which then need not be built
+    keeps_gates = True
+
+    def start(self, num_sites, phy_dim, state=None):
+        pass
+
+    def add(self, step, t, bonds, gates):
+        raise NotImplementedError
+
+    def state(self):
+        return None
+
+    def close(self):
+        return None
+
+
+class MemoryGateSink(GateSink):
+    """keeps {t: gates} of all steps"""
+
+    def start(self, num_sites, phy_dim, state=None):
+        self.gates = {} if state is None else state
+
+    def add(self, step, t, bonds, gates):
+        self.gates[t] = list(gates)
+
+    def state(self):
+        return self.gates
+
+    def close(self):
+        return self.gates
+
+
+class DiscardGateSink(GateSink):
+    keeps_gates = False
+
+    def add(self, step, t, bonds, gates):
+        pass
+
+
+class SummaryGateSink(GateSink):
+    """keeps the number of steps and gates, their total cost (max_num_gates,
+    num_cx) estimated gate by gate as they arrive (see estimate_costs, only
+    for qubit sites, d = 2**k) and a uniform random sample of num_samples
+    gates (reservoir sampling), e.g. for approximate_adiabatic_cost with
+    exact=True. the sampler is seeded with seed and its state is saved in
+    the checkpoints, so the sample does not change between runs or after a
+    resume.
+    """
+
+    def __init__(self, num_samples=30, seed=0):
+        self.num_samples, self.seed = num_samples, seed
+
+    def start(self, num_sites, phy_dim, state=None):
+        # imported here, as in QasmGateSink
+        from ..q_circs.synthesis import estimate_costs
+
+        self.estimate_costs, self.phy_dim = estimate_costs, phy_dim
+        self.k = int(round(np.log2(phy_dim)))
+        qubit_sites = 2**self.k == phy_dim
+
+        state = state or {
+            "num_steps": 0,
+            "num_gates": 0,
+            "cost": np.zeros(2) if qubit_sites else None,
+            "samples": [],
+        }
+        self.num_steps, self.num_gates = state["num_steps"], state["num_gates"]
+        self.cost = None if state["cost"] is None else np.array(state["cost"])
+        self.samples = list(state["samples"])
+        self.rng = np.random.default_rng(self.seed)
+        if "rng" in state:
+            self.rng.bit_generator.state = state["rng"]
+
+    def add(self, step, t, bonds, gates):
+        if self.cost is not None and len(gates) > 0:
+            us = np.asarray(gates).reshape(-1, self.phy_dim**2, self.phy_dim**2)
+            self.cost += np.sum(self.estimate_costs(us, self.k), axis=1)
+
+        for gate in gates:
+            if len(self.samples) < self.num_samples:
+                self.samples.append(gate)
+            else:
+                it = self.rng.integers(self.num_gates + 1)
+                if it < self.num_samples:
+                    self.samples[it] = gate
+            self.num_gates += 1
+        self.num_steps += 1
+
+    def state(self):
+        return {
+            "num_steps": self.num_steps,
+            "num_gates": self.num_gates,
+            "cost": self.cost,
+            "samples": self.samples,
+            "rng": self.rng.bit_generator.state,
+        }
+
+    def close(self):
+        return self.state()
+
+
+def _npy_header(dtype, shape):
+    header = repr(
+        {
+            "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            "fortran_order": False,
+            "shape": tuple(shape),
+        }
+    ).encode("latin1")
+    preamble = np.lib.format.magic(1, 0) + struct.pack("<H", _NPY_HEADER_SIZE - 10)
+    return preamble + header.ljust(_NPY_HEADER_SIZE - 11) + b"\n"
+
+
+class _NpyStream:
+    """an .npy file of (n, *shape) arrays, appended row by row. the header
+    has a fixed size and is rewritten with n after every append.
+    """
+
+    def __init__(self, path, dtype, shape, num_rows=None):
+        self.path, self.dtype, self.shape = path, np.dtype(dtype), tuple(shape)
+        self.row_size = self.dtype.itemsize * int(np.prod(shape))
+
+        if num_rows is None:
+            self.file, self.num_rows = open(path, "wb"), 0
+            self.file.write(_npy_header(self.dtype, (0,) + self.shape))
+        else:
+            # resumes after num_rows rows, drops the rest
+            self.file, self.num_rows = open(path, "r+b"), num_rows
+            self.file.truncate(_NPY_HEADER_SIZE + num_rows * self.row_size)
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(rows.tobytes())
+        self.num_rows += len(rows)
+
+        self.file.seek(0)
+        self.file.write(_npy_header(self.dtype, (self.num_rows,) + self.shape))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class NpyGateSink(GateSink):
+    """streams the gates to the .npy file path as (n, d, d, d, d) array, and
+    (step, bond) of every gate to path_bonds.npy as (n, 2) array. both are
+    read with np.load(path, mmap_mode="r").
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.bonds_path = os.path.splitext(path)[0] + "_bonds.npy"
+
+    def start(self, num_sites, phy_dim, state=None):
+        num_rows = None if state is None else state["num_gates"]
+        d = phy_dim
+        self.gates = _NpyStream(self.path, np.complex128, (d, d, d, d), num_rows)
+        self.bonds = _NpyStream(self.bonds_path, np.int64, (2,), num_rows)
+
+    def add(self, step, t, bonds, gates):
+        self.gates.append(np.asarray(gates))
+        self.bonds.append([(step, bond) for bond in bonds])
+
+    def state(self):
+        return {"num_gates": self.gates.num_rows}
+
+    def close(self):
+        self.gates.close()
+        self.bonds.close()
+        return self.path
+
+
+class QasmGateSink(GateSink):
+    """streams the gates as openqasm 2 circuit (u3 and cx gates) to path. site
+    i of the mps is the block of qubits [i*k, (i+1)*k) with d = 2**k, the
+    first qubit of a block being the most significant one (as the sites in
+    circuit_from_unitary_layers). two-qubit gates (k=1) are synthesized
+    natively, larger ones are transpiled by qiskit. the lines are written
+    directly (qiskit.qasm2.dumps is not available in all supported qiskit
+    versions).
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def start(self, num_sites, phy_dim, state=None):
+        # imported here, the other sinks do not need qiskit
+        import qiskit
+
+        from ..q_circs import append_unitaries
+
+        self.qiskit, self.append_unitaries = qiskit, append_unitaries
+
+        self.k = int(round(np.log2(phy_dim)))
+        if 2**self.k != phy_dim:
+            raise ValueError(f"qasm output needs qubit sites, got {phy_dim=}")
+        self.num_qubits = num_sites * self.k
+
+        if state is None:
+            self.file = open(self.path, "w")
+            self.file.write(
+                f'OPENQASM 2.0;\ninclude "qelib1.inc";\nqreg q[{self.num_qubits}];\n'
+            )
+        else:
+            self.file = open(self.path, "r+")
+            self.file.truncate(state["position"])
+            self.file.seek(state["position"])
+        self.position = self.file.tell()
+
+    def add(self, step, t, bonds, gates):
+        d, k = 2**self.k, self.k
+        pairs = [
+            (gate.reshape(d**2, d**2), list(range(k * bond, k * (bond + 2)))[::-1])
+            for bond, gate in zip(bonds, gates)
+        ]
+
+        circ = self.qiskit.QuantumCircuit(self.num_qubits)
+        if k == 1:
+            self.append_unitaries(circ, pairs)
+        else:
+            for u, qubits in pairs:
+                circ.unitary(u, qubits)
+            circ = self.qiskit.transpile(circ, basis_gates=["cx", "u"])
+
+        self.file.write(f"// step {step}, t={t}\n")
+        for instruction in circ.data:
+            op = instruction.operation
+            qubits = ",".join(
+                f"q[{circ.find_bit(q).index}]" for q in instruction.qubits
+            )
+            if op.name == "cx":
+                self.file.write(f"cx {qubits};\n")
+            else:
+                # u and u3 are the same gate, u3 is the one in qelib1.inc
+                params = ",".join(repr(float(param)) for param in op.params)
+                self.file.write(f"u3({params}) {qubits};\n")
+        self.file.flush()
+        self.position = self.file.tell()
+
+    def state(self):
+        return {"position": self.position}
+
+    def close(self):
+        self.file.close()
+        return self.path
+
+
+GATE_SINKS = {
+    "memory": MemoryGateSink,
+    "discard": DiscardGateSink,
+    "summary": SummaryGateSink,
+}
+
+
+def make_gate_sink(gate_sink):
+    """returns a sink for gate_sink, one of GATE_SINKS, a path ending in .npy
+    or .qasm (streamed to that file) or already a GateSink
+    """
+    if isinstance(gate_sink, GateSink):
+        return gate_sink
+
+    if gate_sink in GATE_SINKS:
+        return GATE_SINKS[gate_sink]()
+
+    if isinstance(gate_sink, str) and gate_sink.endswith(".npy"):
+        return NpyGateSink(gate_sink)
+
+    if isinstance(gate_sink, str) and gate_sink.endswith(".qasm"):
+        return QasmGateSink(gate_sink)
+
+    raise ValueError(
+        f"gate_sink should be one of {list(GATE_SINKS)}, a .npy or .qasm path "
+        f"or a GateSink, got {gate_sink}"
+    )
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""observables of the evolved mps psi of the 1d adiabatic preparation from
+shared environments. the bras psi, the target and the instantaneous ground
+state are stacked (zero padded to a common bond dimension) and contracted
+with psi in one sweep of left environments, which gives both fidelities and
+the norm. one sweep of right environments of psi then gives the two-site
+reduced density matrices of all bonds at once, and the energy of the parent
+hamiltonian is their trace with the stacked bond terms. this replaces one
+full network contraction per overlap and the mpo of the hamiltonian.
+"""
+
+import numpy as np
+
+
+def stack_site_tensors(Qs, D=None):
+    """returns the (lrp) tensors of an mps as (L, D, D, d) array, zero padded
+    to the bond dimension D (the largest one if None). the boundary tensors
+    (r, p) and (l, p) get a trivial outer bond.
+    """
+    L, d = len(Qs), Qs[0].shape[-1]
+    if D is None:
+        D = max(max(Q.shape[:-1]) for Q in Qs)
+
+    stack = np.zeros((L, D, D, d), dtype=np.result_type(*Qs))
+    for site, Q in enumerate(Qs):
+        if Q.ndim == 2:
+            Q = np.expand_dims(Q, axis=0 if site == 0 else 1)
+        stack[site, : Q.shape[0], : Q.shape[1]] = Q
+    return stack
+
+
+def mps_arrays(mps):
+    """the arrays of the quimb mps in lrp order"""
+    mps.permute_arrays(shape="lrp")
+    return [np.asarray(array) for array in mps.arrays]
+
+
+def left_environments(kets, bras):
+    """returns the (L+1, K, D, D) left environments of the (L, D, D, d) kets
+    with the K (K, L, D, D, d) bras, environment n contracts the sites < n
+    (bra bond first). environment L holds the overlaps <bra|ket> at [0, 0].
+    """
+    L, D, _, d = kets.shape
+    K = bras.shape[0]
+
+    envs = np.zeros((L + 1, K, D, D), dtype=np.result_type(kets, bras))
+    envs[0, :, 0, 0] = 1.0
+    for site in range(L):
+        x = (envs[site] @ kets[site].reshape(D, D * d)).reshape(K, D, D, d)
+        x = x.transpose(0, 1, 3, 2).reshape(K, D * d, D)
+        bra = np.conj(bras[:, site]).transpose(0, 2, 1, 3).reshape(K, D, D * d)
+        envs[site + 1] = bra @ x
+    return envs
+
+
+def right_environments(kets):
+    """returns the (L+1, D, D) right environments of the (L, D, D, d) kets
+    with themselves, environment n contracts the sites >= n
+    """
+    L, D, _, d = kets.shape
+
+    envs = np.zeros((L + 1, D, D), dtype=kets.dtype)
+    envs[L, 0, 0] = 1.0
+    for site in reversed(range(L)):
+        x = kets[site].transpose(0, 2, 1) @ envs[site + 1].T
+        x = x.transpose(2, 1, 0).reshape(D * d, D)
+        envs[site] = np.conj(kets[site]).reshape(D, D * d) @ x
+    return envs
+
+
+def bond_expectation_values(kets, left_envs, right_envs, terms):
+    """returns <psi|h_n|psi> of the (L-1, d, d, d, d) two-site terms on all
+    bonds n, from the environments of psi with itself, in one batched
+    contraction
+    """
+    L, D, _, d = kets.shape
+    A, B = kets[:-1], kets[1:]
+
+    # the two-site tensors (n, l, p, q, r) of all bonds
+    AB = A.transpose(0, 1, 3, 2).reshape(L - 1, D * d, D) @ B.transpose(
+        0, 1, 3, 2
+    ).reshape(L - 1, D, d * D)
+    AB = AB.reshape(L - 1, D, d, d, D)
+
+    ket = (left_envs[: L - 1] @ AB.reshape(L - 1, D, -1)).reshape(L - 1, D, d**2, D)
+    ket = ket.transpose(0, 2, 1, 3).reshape(L - 1, d**2, D * D)
+    h_ket = terms.reshape(L - 1, d**2, d**2) @ ket
+
+    bra = (np.conj(AB).reshape(L - 1, -1, D) @ right_envs[2:]).reshape(
+        L - 1, D, d**2, D
+    )
+    bra = bra.transpose(0, 2, 1, 3).reshape(h_ket.shape)
+    return np.sum(bra * h_ket, axis=(1, 2))
+
+
+def measure_observables(psi, target_mps, mps_s, hamiltonian=None):
+    """returns (target_fidelity, current_fidelity, energy) of psi, i.e.
+    |<target|psi>|, |<mps_s|psi>| and <psi|H|psi>/<psi|psi> of the parent
+    hamiltonian {bond: term} (None if not given), from shared environments
+    """
+    Qs = [mps_arrays(mps) for mps in (psi, target_mps, mps_s)]
+    D = max(max(Q.shape[:-1]) for arrays in Qs for Q in arrays)
+    bras = np.stack([stack_site_tensors(arrays, D) for arrays in Qs])
+    kets = bras[0]
+
+    left_envs = left_environments(kets, bras)
+    norm, target_overlap, current_overlap = left_envs[-1, :, 0, 0]
+
+    energy = None
+    if hamiltonian is not None:
+        right_envs = right_environments(kets)
+        terms = np.stack(list(hamiltonian.values()))
+        energy = np.sum(
+            bond_expectation_values(kets, left_envs[:, 0], right_envs, terms)
+        )
+        energy = np.real(energy) / np.real(norm)
+
+    return np.abs(target_overlap), np.abs(current_overlap), energy
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""trotter-suzuki product formulas for the adiabatic evolution.
+
+compositions are symmetric products S2(w_1 dt) ... S2(w_n dt) of the second
+order formula S2, they are used with any second order step (the mpo sweeps in
+1d, the forward and backward gate sweeps in 2d) and reach fourth order.
+splittings are products exp(c_1 dt A) exp(c_2 dt B) ... of the even (A) and
+odd (B) bonds, as used by tebd, where adjacent layers of the same bonds are
+merged into one layer.
+
+the parent hamiltonian changes during a time step. a step is therefore made
+of stages, every stage applies a formula to the hamiltonian frozen at the
+nodes ((f_1, c_1), ...), i.e. to sum_j c_j h(t + f_j dt). freezing it at the
+beginning of the step limits any formula to first order in the time
+dependence, as "first" and "second" (the default, one hamiltonian per step)
+do. "midpoint2" is the second order formula evaluated at the midpoint.
+"""
+
+import numpy as np
+
+_p = 1 / (4 - 4 ** (1 / 3))
+_w1 = 1 / (2 - 2 ** (1 / 3))
+
+COMPOSITIONS = {
+    "second": [1.0],
+    "midpoint2": [1.0],
+    # suzuki's fractal fourth order formula
+    "suzuki4": [_p, _p, 1 - 4 * _p, _p, _p],
+    # yoshida's triple jump
+    "yoshida4": [_w1, 1 - 2 * _w1, _w1],
+}
+
+# optimized splittings of omelyan, mryglod and folk, Comput. Phys. Commun. 146,
+# 188 (2002): the minimum norm second order formula and the fourth order one
+# (pefrl), as (bonds, coefficient) with bonds 0 (even) or 1 (odd)
+_xi2 = 0.1931833275037836
+_xi, _lam, _chi = 0.1786178958448091, -0.2123418310626054, -0.06626458266981849
+
+OPTIMIZED_SPLITTINGS = {
+    "omelyan2": [(0, _xi2), (1, 0.5), (0, 1 - 2 * _xi2), (1, 0.5), (0, _xi2)],
+    "omelyan4": [
+        (0, _xi),
+        (1, (1 - 2 * _lam) / 2),
+        (0, _chi),
+        (1, _lam),
+        (0, 1 - 2 * (_chi + _xi)),
+        (1, _lam),
+        (0, _chi),
+        (1, (1 - 2 * _lam) / 2),
+        (0, _xi),
+    ],
+}
+
+PRODUCT_FORMULAS = list(COMPOSITIONS) + list(OPTIMIZED_SPLITTINGS)
+
+# gauss-legendre nodes and the coefficients of the fourth order commutator
+# free magnus integrator of blanes and moan, Appl. Numer. Math. 56, 1519 (2006)
+_g1, _g2 = 1 / 2 - np.sqrt(3) / 6, 1 / 2 + np.sqrt(3) / 6
+_a1, _a2 = 1 / 2 + np.sqrt(3) / 3, 1 / 2 - np.sqrt(3) / 3
+
+
+def check_formula(formula, compositions_only=False):
+    formulas = list(COMPOSITIONS) if compositions_only else PRODUCT_FORMULAS
+    if formula not in formulas:
+        raise ValueError(f"formula should be one of {formulas}, got {formula}")
+
+
+def stages(formula):
+    """returns the stages [(weight, nodes), ...] of a time step, every stage
+    applies the time independent formula over weight*dt to the hamiltonian
+    of its nodes. "first" and "second" freeze the hamiltonian at the
+    beginning of the step, the other compositions evaluate every S2 at its
+    midpoint (S2 stays time symmetric, so the composition keeps its order),
+    "omelyan2" is evaluated at the midpoint and "omelyan4" in the two stages
+    of the commutator free magnus integrator.
+    """
+    if formula in ["first", "second"]:
+        return [(1.0, ((0.0, 1.0),))]
+
+    if formula == "omelyan2":
+        return [(1.0, ((0.5, 1.0),))]
+
+    if formula == "omelyan4":
+        return [(0.5, ((_g1, _a1), (_g2, _a2))), (0.5, ((_g1, _a2), (_g2, _a1)))]
+
+    stages_, offset = [], 0.0
+    for w in COMPOSITIONS[formula]:
+        stages_.append((w, ((offset + w / 2, 1.0),)))
+        offset += w
+    return stages_
+
+
+def _append_piece(layers, key, coeff, nodes):
+    # merges the piece into the last layer if it acts on the same bonds
+    if layers and layers[-1][0] == key:
+        pieces = layers[-1][1]
+        if pieces[-1][1] == nodes:
+            pieces[-1] = (pieces[-1][0] + coeff, nodes)
+        else:
+            pieces.append((coeff, nodes))
+    else:
+        layers.append((key, [(coeff, nodes)]))
+
+
+def splitting(formula):
+    """returns the even/odd layers [(bonds, pieces), ...] of a time step of
+    formula, bonds is 0 (even) or 1 (odd). the gate of a bond is the product
+    of exp(-1j*coeff*dt*h) over the pieces [(coeff, nodes), ...] of its
+    layer (the first applied first), h the hamiltonian of the nodes.
+    """
+    check_formula(formula)
+    frozen = OPTIMIZED_SPLITTINGS.get(formula, [(0, 0.5), (1, 1.0), (0, 0.5)])
+
+    layers = []
+    for weight, nodes in stages(formula):
+        for bonds, coeff in frozen:
+            _append_piece(layers, bonds, weight * coeff, nodes)
+    return layers
+
+
+def sweep_sequence(bonds, formula):
+    """returns the gates [(bond, pieces), ...] of formula applied as sweeps
+    over bonds (pieces as in splitting). "first" is a single sweep, every
+    stage of the compositions is a forward and a backward sweep with half of
+    its weight. consecutive gates on the same bond (at the turning points of
+    the sweeps) are merged into one, as they are in a circuit.
+    """
+    if formula != "first" and formula not in COMPOSITIONS:
+        raise ValueError(
+            f"formula should be one of {['first'] + list(COMPOSITIONS)}, got {formula}"
+        )
+
+    sequence = []
+    for weight, nodes in stages(formula):
+        if formula == "first":
+            sweeps = [(bond, weight) for bond in bonds]
+        else:
+            sweeps = [(bond, weight / 2) for bond in list(bonds) + list(bonds)[::-1]]
+
+        for bond, coeff in sweeps:
+            _append_piece(sequence, bond, coeff, nodes)
+    return sequence
+
+
+def stage_hamiltonian(hamiltonian_at, nodes):
+    """returns the hamiltonian sum_j c_j h(f_j) of the nodes ((f_1, c_1), ...)
+    as {bond: term}, hamiltonian_at(f) returns h at the fraction f of the
+    time step as {bond: term}
+    """
+    if len(nodes) == 1 and nodes[0][1] == 1.0:
+        return hamiltonian_at(nodes[0][0])
+
+    hamiltonians = [(c, hamiltonian_at(f)) for f, c in nodes]
+    return {
+        bond: sum(c * hamiltonian[bond] for c, hamiltonian in hamiltonians)
+        for bond in hamiltonians[0][1]
+    }
+
+
+def exponentiate_hermitian(terms, phy_dim, dt):
+    """returns exp(-1j*dt*h) of the stacked hermitian (n, d, d, d, d) two-site
+    terms as (n, d, d, d, d) array, from one batched eigendecomposition
+    """
+    d = phy_dim
+    vals, vecs = np.linalg.eigh(terms.reshape(-1, d**2, d**2))
+    phases = np.exp(-1j * dt * vals)
+    evo_ops = (vecs * phases[:, None, :]) @ np.conj(np.swapaxes(vecs, 1, 2))
+    return evo_ops.reshape(-1, d, d, d, d)
+
+
+def pieces_gates(terms_of, pieces, phy_dim, dt):
+    """returns the (n, d, d, d, d) gates of the pieces of a layer (see
+    splitting), terms_of(nodes) returns the (n, d, d, d, d) terms of its
+    bonds
+    """
+    d = phy_dim
+    gates = np.eye(d**2)
+    for coeff, nodes in pieces:
+        evo_ops = exponentiate_hermitian(terms_of(nodes), d, coeff * dt)
+        gates = evo_ops.reshape(-1, d**2, d**2) @ gates
+    return gates.reshape(-1, d, d, d, d)
+
+
+def sequence_gates(hamiltonian_of, sequence, phy_dim, dt):
+    """returns the (d, d, d, d) gates of the sequence [(bond, pieces), ...]
+    (see sweep_sequence), hamiltonian_of(nodes) returns {bond: term}. the
+    terms of all bonds are diagonalized once per nodes, in one batched eigh,
+    and every piece only exponentiates the eigenvalues.
+    """
+    d = phy_dim
+    spectra = {}
+    for _, pieces in sequence:
+        for _, nodes in pieces:
+            if nodes not in spectra:
+                hamiltonian = hamiltonian_of(nodes)
+                terms = np.stack(list(hamiltonian.values()))
+                vals, vecs = np.linalg.eigh(terms.reshape(-1, d**2, d**2))
+                spectra[nodes] = dict(zip(hamiltonian.keys(), zip(vals, vecs)))
+
+    gates = []
+    for bond, pieces in sequence:
+        gate = np.eye(d**2)
+        for coeff, nodes in pieces:
+            vals, vecs = spectra[nodes][bond]
+            evo_op = (vecs * np.exp(-1j * coeff * dt * vals)) @ np.conj(vecs.T)
+            gate = evo_op @ gate
+        gates.append(gate.reshape(d, d, d, d))
+    return gates
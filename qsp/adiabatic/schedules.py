@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""interpolation schedules s(t) of the adiabatic preparation, s(0)=0 and
+s(Tmax)=1. besides the fixed schedules, gap_adapted_schedule slows down where
+the gap of the parent hamiltonian, estimated from the transfer matrix of the
+interpolated bulk tensor, is small.
+"""
+
+import numpy as np
+
+
+def sin_sin_schedule(Tmax):
+    return lambda t: np.sin((np.pi / 2) * np.sin((np.pi / 2) * t / Tmax) ** 2) ** 2
+
+
+def sin_schedule(Tmax):
+    return lambda t: np.sin((np.pi / 2) * t / Tmax) ** 2
+
+
+def linear_schedule(Tmax):
+    return lambda t: t / Tmax
+
+
+SCHEDULES = {
+    "sin_sin": sin_sin_schedule,
+    "sin": sin_schedule,
+    "linear": linear_schedule,
+}
+
+
+def transfer_matrix_gap(tensor):
+    """1 - |e_2/e_1| of the transfer matrix of the (l, r, p) bulk tensor, i.e.
+    the inverse correlation length, a cheap proxy of the parent hamiltonian
+    gap (which closes with the transfer matrix gap)
+    """
+    D = tensor.shape[0]
+    E = np.einsum("abp,cdp->acbd", tensor, np.conj(tensor)).reshape(D**2, D**2)
+    vals = np.sort(np.abs(np.linalg.eigvals(E)))[::-1]
+    return 1.0 - vals[1] / vals[0]
+
+
+def gap_adapted_schedule(
+    initial_tensor,
+    target_tensor,
+    Tmax,
+    base="sin_sin",
+    num_points=201,
+    power=2,
+    min_gap=1e-3,
+):
+    """returns the schedule s(t) = S(u(t)) of the linear interpolation between
+    the (l, r, p) bulk tensors. u is the base schedule (keeping its smooth
+    start and end), S is the local adiabatic reparametrization dS/du ~
+    gap(S)**power, i.e. it slows down where the gap is small. the gap is
+    estimated by transfer_matrix_gap on num_points values of s and bounded
+    from below by min_gap.
+    """
+    ss = np.linspace(0, 1, num_points)
+    gaps = np.array(
+        [transfer_matrix_gap((1 - s) * initial_tensor + s * target_tensor) for s in ss]
+    )
+    rates = 1.0 / np.maximum(gaps, min_gap) ** power
+
+    # u(s) is the normalized integral of du/ds ~ 1/gap**power
+    us = np.concatenate([[0.0], np.cumsum((rates[1:] + rates[:-1]) / 2)])
+    us = us / us[-1]
+
+    u_func = SCHEDULES[base](Tmax)
+    return lambda t: np.interp(u_func(t), us, ss)
+
+
+def make_schedule(schedule, Tmax, initial_tensor=None, target_tensor=None):
+    """returns s_func for schedule, one of SCHEDULES, "gap" (needs the bulk
+    tensors, see gap_adapted_schedule) or already a function of t
+    """
+    if callable(schedule):
+        return schedule
+
+    if schedule == "gap":
+        if initial_tensor is None or target_tensor is None:
+            raise ValueError("the gap adapted schedule needs the bulk tensors")
+        return gap_adapted_schedule(initial_tensor, target_tensor, Tmax)
+
+    if schedule not in SCHEDULES:
+        raise ValueError(
+            f"schedule should be one of {list(SCHEDULES) + ['gap']}, got {schedule}"
+        )
+    return SCHEDULES[schedule](Tmax)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""tebd for the 1d adiabatic evolution. the mps is kept in the right
+canonical form of Hastings (arXiv:0903.3253): right canonical site tensors B
+and the schmidt values of every bond, so the two-site gates are applied
+without inverting schmidt values. all bonds of a layer (even or odd bonds) are
+updated at once on (max_bond) zero padded stacks, with one batched truncated
+svd. a time step is any even/odd splitting of product_formulas.
+"""
+
+import numpy as np
+
+from ..tsp_helper_routines.mps_sum import arrays_to_mps
+from ..tsp_helper_routines.mps_sum import mps_to_arrays
+
+from .product_formulas import pieces_gates
+from .product_formulas import splitting
+
+
+def bond_dims(L, phy_dim, max_bond):
+    """largest useful dimension of every bond (including the dummy end bonds)"""
+    return [min(max_bond, phy_dim**it, phy_dim ** (L - it)) for it in range(L + 1)]
+
+
+def mps_to_tebd(psi, max_bond):
+    """returns the (L, chi, d, chi) right canonical site tensors and the
+    (L+1, chi) schmidt values of psi, chi = max_bond. psi is compressed to
+    max_bond, as after every step of the mpo integrator, and the bonds of
+    the right canonical mps are rotated into their schmidt bases in one sweep.
+    """
+    psi = psi.copy()
+    psi.compress(form="right", max_bond=max_bond)
+    psi.normalize()
+    arrays = mps_to_arrays(psi)
+
+    L, d, chi = len(arrays), arrays[0].shape[1], max_bond
+
+    B = np.zeros((L, chi, d, chi), dtype=np.complex128)
+    lambdas = np.zeros((L + 1, chi))
+    lambdas[0, 0] = lambdas[L, 0] = 1.0
+
+    # c is the left part of the mps in the schmidt basis of the previous bond
+    c, vh_prev = np.ones((1, 1)), np.ones((1, 1))
+    for it, array in enumerate(arrays):
+        dl, _, dr = array.shape
+        m = np.einsum("ab,bpc->apc", c, array).reshape(-1, dr)
+        _, s, vh = np.linalg.svd(m, full_matrices=False)
+        if it == L - 1:
+            # keeps the phase of psi
+            vh = np.ones((1, 1))
+
+        # full rank right bonds after the compression, i.e. vh is square
+        b = np.einsum("ab,bpc,dc->apd", vh_prev, array, np.conj(vh))
+        B[it, : b.shape[0], :, : b.shape[2]] = b
+        lambdas[it + 1, : len(s)] = s
+
+        c, vh_prev = s[:, None] * vh, vh
+
+    return B, lambdas
+
+
+def tebd_to_mps(B, max_bond):
+    """the mps of the right canonical tensors B, without the padding"""
+    L, _, d, _ = B.shape
+    dims = bond_dims(L, d, max_bond)
+    arrays = [B[it, : dims[it], :, : dims[it + 1]] for it in range(L)]
+    return arrays_to_mps(arrays)
+
+
+def apply_gate_layer(B, lambdas, sites, gates):
+    """applies gates[n] (d, d, d, d) on the sites (sites[n], sites[n]+1) of
+    the tebd mps (inplace). the sites should not overlap, the new bonds are
+    truncated to the max_bond of the stacks and renormalized. the site after
+    the last one is the first one, i.e. the bond (L-1, 0) of the unit cell
+    of a uniform mps is updated with sites=[L-1].
+    """
+    sites = np.asarray(sites)
+    n, chi, d = len(sites), B.shape[1], B.shape[2]
+    right = (sites + 1) % len(B)
+
+    theta = np.einsum("nlpa,naqr->nlpqr", B[sites], B[right])
+    theta = np.einsum("nabpq,nlpqr->nlabr", gates, theta).reshape(n, chi * d, -1)
+
+    weighted = lambdas[sites][:, :, None] * theta.reshape(n, chi, -1)
+    _, s, vh = np.linalg.svd(weighted.reshape(n, chi * d, -1), full_matrices=False)
+
+    s, vh = s[:, :chi], vh[:, :chi]
+    norms = np.linalg.norm(s, axis=1)
+
+    # drops the (numerically) vanishing schmidt values, their arbitrary
+    # singular vectors would otherwise leak into the padding
+    kept = s > np.finfo(s.dtype).eps * s[:, :1]
+    s, vh = s * kept, vh * kept[..., None]
+
+    B[right] = vh.reshape(n, chi, d, chi)
+    B[sites] = (theta @ np.conj(np.swapaxes(vh, 1, 2))).reshape(n, chi, d, chi)
+    B[sites] /= norms[:, None, None, None]
+    lambdas[right] = s / norms[:, None]
+
+
+def product_formula_step(B, lambdas, terms_at, dt, formula="second"):
+    """one trotter step of length dt with the even/odd splitting of formula
+    (see product_formulas.splitting). terms_at(nodes) returns the hamiltonian
+    of the nodes as (n_bonds, d, d, d, d) stack, the term it is the bond (it,
+    it+1). with n_bonds == len(B) the last term is the bond (L-1, 0) of a
+    uniform unit cell. returns the bonds (the first site) and the applied
+    gates.
+    """
+    d = B.shape[2]
+
+    stacks = {}
+    for _, pieces in splitting(formula):
+        for _, nodes in pieces:
+            if nodes not in stacks:
+                stacks[nodes] = terms_at(nodes)
+    n_bonds = len(next(iter(stacks.values())))
+
+    applied_bonds, applied, layer_gates = [], [], {}
+    for bonds, pieces in splitting(formula):
+        sites = np.arange(bonds, n_bonds, 2)
+        if not len(sites):
+            continue
+
+        key = (bonds, tuple(pieces))
+        if key not in layer_gates:
+            layer_gates[key] = pieces_gates(
+                lambda nodes: stacks[nodes][sites], pieces, d, dt
+            )
+        apply_gate_layer(B, lambdas, sites, layer_gates[key])
+        applied_bonds.extend(sites)
+        applied.extend(layer_gates[key])
+
+    return applied_bonds, applied
+
+
+def tebd_step(B, lambdas, terms_at, dt, formula="second"):
+    """one trotter step of length dt of the tebd mps, terms_at(nodes)
+    returns the (L-1, d, d, d, d) stack of the bond hamiltonians. returns the
+    bonds and the applied gates.
+    """
+    return product_formula_step(B, lambdas, terms_at, dt, formula=formula)
+
+
+def itebd_step(B, lambdas, term_at, dt, formula="second"):
+    """one trotter step of length dt of a uniform mps with the two-site unit
+    cell B (2, chi, d, chi), lambdas[i] are the schmidt values of the bond
+    left of site i. term_at(nodes) returns the (d, d, d, d) bulk hamiltonian
+    term. returns the bonds and the applied gates.
+    """
+
+    def terms_at(nodes):
+        term = term_at(nodes)
+        return np.stack([term, term])
+
+    return product_formula_step(B, lambdas, terms_at, dt, formula=formula)
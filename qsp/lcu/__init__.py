@@ -1,5 +1,13 @@
 from .lcu_optimization_manopt import lcu_unitary_circuit_optimization as lcu_manopt
 from .lcu_optimization_qgopt import lcu_unitary_circuit_optimization as lcu_qgopt
+from .lcu_multistart import lcu_multistart_optimization as lcu_multistart
 from .lcu import lcu_unitary_circuit
+from .lcu_kappas import optimal_kappas
 
-__all__ = ["lcu_manopt", "lcu_qgopt", "lcu_unitary_circuit"]
+__all__ = [
+    "lcu_manopt",
+    "lcu_multistart",
+    "lcu_qgopt",
+    "lcu_unitary_circuit",
+    "optimal_kappas",
+]
@@ -1,11 +1,12 @@
 import numpy as np
-from scipy.optimize import minimize
 from tqdm import tqdm
 
+from .lcu_kappas import optimal_kappas
 
 from ..sequential import generate_bond_d_unitary
 from ..sequential import apply_unitary_layers_on_wfn
 
+from ..tsp_helper_routines import MPSSum
 from ..tsp_helper_routines import cl_zero_mps
 from ..tsp_helper_routines import norm_mps_ovrlap
 from ..tsp_helper_routines import compute_energy_expval
@@ -25,10 +26,6 @@ def compress_copy(psi, max_bond):
     return f, unitary
 
 
-def loss_for_kappa(al, psi, approx_psi, residual, qubit_hamiltonian=0):
-    return -np.abs(norm_mps_ovrlap(psi, approx_psi + al[0] * residual))
-
-
 def lcu_unitary_circuit(
     mps,
     italic_D=4,
@@ -55,38 +52,39 @@ def lcu_unitary_circuit(
     mps.permute_arrays(shape="lpr")
     mps.right_canonize(normalize=True)
 
+    # the encoded terms t_i are kept as a lazy sum, its gram matrix <t_i|t_j> is
+    # updated as terms are added so that all kappas are re-fitted jointly
+    encoded_sum = MPSSum()
+
     for it in tqdm(range(italic_D)):
         if it == 0:
             approx_mps, unitary = compress_copy(mps, 2)
-            curr_us = [unitary]
-            kappa = 1
-
-            encoded_mps = apply_unitary_layers_on_wfn(curr_us, zero_wfn)
+            approx_kappas = np.ones(1)
 
         else:
             renom_factor = (mps.H @ approx_mps) / (approx_mps.H @ approx_mps)
             residual, unitary = compress_copy(mps - renom_factor * approx_mps, 2)
-            curr_us = [unitary]
-
-            ###
-            result = minimize(
-                loss_for_kappa,
-                np.array([0.1]),
-                args=(mps, approx_mps, residual, qubit_hamiltonian),
-                method="BFGS",
-            )
 
-            kappa = result.x[0]
-
-            ###
-            approx_mps = approx_mps + kappa * residual
-            encoded_mps = encoded_mps + kappa * apply_unitary_layers_on_wfn(
-                curr_us, zero_wfn
+        curr_us = [unitary]
+        encoded_sum.append(apply_unitary_layers_on_wfn(curr_us, zero_wfn))
+        gram, target_overlaps = encoded_sum.gram, encoded_sum.overlaps_with(mps)
+
+        if it > 0:
+            # kappa of the new residual with the previous ones fixed, i.e. the
+            # same greedy step as before, solved in the 2d span (approx, residual)
+            span = np.zeros((it + 1, 2))
+            span[:it, 0] = approx_kappas
+            span[it, 1] = 1.0
+            (_, kappa), _ = optimal_kappas(
+                span.T @ gram @ span, span.T @ target_overlaps
             )
+            approx_kappas = np.append(approx_kappas, kappa)
+            approx_mps = approx_mps + kappa * residual
 
-            if do_compression:
-                approx_mps.right_canonize()
-                approx_mps.compress(max_bond=max_bond_dim)
+            # without compression only numerically vanishing singular values
+            # are dropped, which keeps the bond at the rank of the sum
+            approx_mps.right_canonize()
+            approx_mps.compress(max_bond=max_bond_dim if do_compression else None)
 
             if verbose:
                 print(
@@ -95,9 +93,11 @@ def lcu_unitary_circuit(
                     "residual_psi_D = {np.max(residual.bond_sizes())}\n"
                 )
 
-            encoded_mps.compress()
-
-        kappas.append(kappa)
+        ###
+        # all kappas of the encoded mps are re-fitted jointly
+        kappas, _ = optimal_kappas(gram, target_overlaps)
+        encoded_sum.set_coeffs(kappas)
+        kappas = list(kappas)
 
         for u in curr_us:
             unitaries_sanity_check(u)
@@ -106,7 +106,7 @@ def lcu_unitary_circuit(
 
         ##
         approx_mps_overlap.append(norm_mps_ovrlap(mps, approx_mps))
-        overlap = norm_mps_ovrlap(mps, encoded_mps)
+        overlap = np.conj(encoded_sum.norm_ovrlap(mps))
 
         if verbose:
             print(
@@ -119,6 +119,7 @@ def lcu_unitary_circuit(
 
             approx_energy = 0
             if qubit_hamiltonian != 0:
+                encoded_mps = encoded_sum.to_mps()
                 approx_energy = compute_energy_expval(encoded_mps, qubit_hamiltonian)
 
             if verbose:
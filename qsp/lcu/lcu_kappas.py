@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""closed form lcu coefficients.
+
+for terms |t_i> and a normalized target |psi> the overlap of the lcu state
+sum_i kappa_i |t_i> with the target is
+
+    |<psi|sum_i kappa_i t_i>|^2 / <sum_i kappa_i t_i|sum_i kappa_i t_i>
+        = (kappa^T A kappa) / (kappa^T B kappa),
+
+with A = Re(b b^H), b_i = <t_i|psi> and B = Re(G), G_ij = <t_i|t_j> (kappas
+are real). the optimal kappas are the top generalized eigenvector of (A, B),
+so all kappas can be re-fitted jointly from the small gram matrix without
+touching the mps again.
+"""
+
+import numpy as np
+import scipy as sp
+
+
+def optimal_kappas(gram, target_overlaps, rcond=1e-12):
+    """returns the real kappas maximizing the normalized overlap with the
+    target, and that overlap. kappas[0] is fixed to 1 (when it is not
+    vanishing), as for the first term of the lcu construction.
+    """
+    gram = np.asarray(gram)
+    b = np.asarray(target_overlaps)
+
+    A = np.real(np.outer(b, np.conj(b)))
+    B = np.real(gram)
+    # regularize nearly linearly dependent terms
+    B = B + rcond * np.trace(B) * np.eye(len(B))
+
+    eigvals, eigvecs = sp.linalg.eigh(A, B)
+    kappas = eigvecs[:, -1]
+
+    if np.abs(kappas[0]) > rcond:
+        kappas = kappas / kappas[0]
+    else:
+        kappas = kappas / np.linalg.norm(kappas)
+
+    overlap = np.sqrt(np.clip(eigvals[-1], 0.0, None))
+    return kappas, overlap
+
+
+def lcu_overlap(gram, target_overlaps, kappas):
+    """|<psi|sum_i kappa_i t_i>| / ||sum_i kappa_i t_i|| from the gram matrix"""
+    kappas = np.asarray(kappas)
+    nomin = np.abs(np.sum(kappas * np.conj(target_overlaps)))
+    denomin = np.sqrt(np.abs(np.conj(kappas) @ gram @ kappas))
+    return nomin / denomin
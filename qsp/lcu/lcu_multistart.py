@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""multi-start variational lcu. several perturbed copies of the greedy lcu
+terms are optimized in parallel worker processes, in rounds of prune_every
+iterations. after every round the starts whose overlap is behind the best one
+by more than prune_margin are dropped, the others continue from their
+checkpoints.
+"""
+
+import os
+import tempfile
+import warnings
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .lcu_optimization_misc import convert_to_lcu_mps
+from .lcu_optimization_misc import lcu_isometries
+
+from ..tsp_helper_routines import MPSSum
+
+
+def _init_worker(num_threads):
+    import tensorflow as tf
+
+    # the threads can only be set before tensorflow is initialized, which the
+    # main module of the caller may already have done (spawn imports it again
+    # in every worker)
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    except RuntimeError:
+        warnings.warn(
+            "tensorflow is already initialized in the lcu worker, its threads "
+            "are not limited to the share of the cores of the worker"
+        )
+
+
+def _run_start(method, target_mps, kappas, lcu_mps, iterations, kwargs):
+    # imported here so the workers only load the optimizer they need
+    if method == "manopt":
+        from .lcu_optimization_manopt import lcu_unitary_circuit_optimization
+
+        data = lcu_unitary_circuit_optimization(
+            target_mps, kappas, lcu_mps, max_iterations=iterations, **kwargs
+        )
+
+    else:
+        from .lcu_optimization_qgopt import lcu_unitary_circuit_optimization
+
+        data = lcu_unitary_circuit_optimization(
+            target_mps, kappas, lcu_mps, pause_at=iterations, **kwargs
+        )
+
+    overlap = MPSSum(data["lcu_mps_opt"], data["kappas"]).norm_ovrlap(target_mps)
+    return np.abs(overlap), data["lcu_mps_opt"], data["kappas"]
+
+
+def perturb_lcu_mps(lcu_mps, perturbation, seed=None):
+    """returns the lcu terms with every site isometry perturbed by gaussian
+    noise of relative size perturbation (and re-orthonormalized)
+    """
+    rng = np.random.default_rng(seed)
+    x = lcu_isometries([mps.copy() for mps in lcu_mps])
+
+    noise = rng.normal(size=x.shape) + 1j * rng.normal(size=x.shape)
+    x, _ = np.linalg.qr(x + perturbation * noise / np.sqrt(2))
+
+    return convert_to_lcu_mps(x, len(lcu_mps), lcu_mps[0].L)
+
+
+def lcu_multistart_optimization(
+    target_mps,
+    kappas,
+    lcu_mps,
+    max_iterations,
+    method="manopt",
+    num_starts=4,
+    perturbation=0.05,
+    prune_every=50,
+    prune_margin=1e-3,
+    max_workers=None,
+    seed=None,
+    verbose=False,
+    **kwargs,
+):
+    """runs num_starts variational lcu optimizations (method is "manopt" or
+    "qgopt", kwargs are passed on) and returns the data of the best one. start
+    0 is the unperturbed greedy solution, the others are perturbed copies
+    (see perturb_lcu_mps). the starts run in a pool of max_workers spawned
+    processes (all cores by default), tensorflow in each worker is limited to
+    its share of the cores. every prune_every iterations the starts with an
+    overlap below best - prune_margin are dropped.
+
+    the spawned workers import the main module of the caller again, so a
+    script calling this has to guard its code by if __name__ == "__main__".
+    """
+    if method not in ["manopt", "qgopt"]:
+        raise ValueError(f"method should be manopt or qgopt, got {method}")
+
+    max_workers = min(num_starts, max_workers or os.cpu_count())
+    num_threads = max(1, os.cpu_count() // max_workers)
+
+    starts = [lcu_mps] + [
+        perturb_lcu_mps(lcu_mps, perturbation, seed=None if seed is None else seed + i)
+        for i in range(1, num_starts)
+    ]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir, ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(num_threads,),
+    ) as executor:
+        alive, iterations = list(range(num_starts)), 0
+        while alive and iterations < max_iterations:
+            iterations = min(iterations + prune_every, max_iterations)
+
+            futures = {}
+            for i in alive:
+                checkpoint_file = os.path.join(tmp_dir, f"start_{i}.pkl")
+                start_kwargs = dict(kwargs, checkpoint_file=checkpoint_file)
+                if method == "qgopt":
+                    start_kwargs["max_iterations"] = max_iterations
+
+                futures[i] = executor.submit(
+                    _run_start,
+                    method,
+                    target_mps,
+                    kappas,
+                    starts[i],
+                    iterations,
+                    start_kwargs,
+                )
+            results.update({i: future.result() for i, future in futures.items()})
+
+            best = max(results[i][0] for i in alive)
+            alive = [i for i in alive if results[i][0] >= best - prune_margin]
+            if verbose:
+                print(
+                    f"iterations={iterations}, best overlap={best:.10f}, "
+                    f"{len(alive)} of {num_starts} starts left"
+                )
+
+    overlaps = [results[i][0] for i in range(num_starts)]
+    best = int(np.argmax(overlaps))
+    overlap, lcu_mps_opt, kappas = results[best]
+
+    data = {
+        "lcu_mps_opt": lcu_mps_opt,
+        "kappas": kappas,
+        "overlap": overlap,
+        "overlaps": overlaps,
+        "best_start": best,
+    }
+    return data
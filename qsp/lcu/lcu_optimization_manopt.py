@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import numpy as np
-import scipy as sp
 import tensorflow as tf
 
 
@@ -9,197 +8,170 @@ import pymanopt
 from pymanopt.manifolds import ComplexGrassmann  # as Manifold
 from pymanopt.optimizers import (
     ConjugateGradient,
-)  # TrustRegions, ConjugateGradient, NelderMead
-import quimb.tensor as qtn
+    TrustRegions,
+)  # NelderMead
 
 
-from .lcu_optimization_misc import mps_overlap
-from .lcu_optimization_misc import quimb_mps_to_tf_mps
+from .lcu_optimization_misc import compiled_lcu_overlap
+from .lcu_optimization_misc import convert_to_lcu_mps
+from .lcu_optimization_misc import lcu_isometries
+from .lcu_optimization_misc import pad_target_mps
+from .lcu_kappas import optimal_kappas
+from .lcu_overlap_derivatives import LCUOverlapDerivatives
 
-
-@tf.function
-def compute_overlap(
-    lcu_list_var,
-    lcu_shapes_list,
-    target_isometry_list,
-    target_shapes_list,
-    kappas,
-    no_of_layers,
-    L,
-    half_id,
-    half_zr,
-):
-
-    nomin = 0.0
-    for it in range(no_of_layers):
-        kappa = kappas[it]
-        curr_mps = [lcu_list_var[indx, :, :] for indx in range(it * L, (it + 1) * L)]
-
-        curr_mps_shapes = lcu_shapes_list[it * L : (it + 1) * L]
-
-        curr_mps[0] = half_id @ curr_mps[0]
-        curr_mps[-1] = curr_mps[-1] @ half_zr
-
-        temp = mps_overlap(
-            curr_mps, curr_mps_shapes, target_isometry_list, target_shapes_list
-        )
-        # with and without kappa, the optimal answer is same
-        nomin = nomin + kappa * temp
-
-    denomin = 0.0
-    for it1 in range(no_of_layers):
-        kappa1 = kappas[it1]
-        curr_mps1 = [lcu_list_var[indx, :, :] for indx in range(it1 * L, (it1 + 1) * L)]
-        curr_mps_shapes1 = lcu_shapes_list[it1 * L : (it1 + 1) * L]
-
-        curr_mps1[0] = half_id @ curr_mps1[0]
-        curr_mps1[-1] = curr_mps1[-1] @ half_zr
-
-        for it2 in range(no_of_layers):
-            kappa2 = kappas[it2]
-            curr_mps2 = [
-                lcu_list_var[indx, :, :] for indx in range(it2 * L, (it2 + 1) * L)
-            ]
-            curr_mps_shapes2 = lcu_shapes_list[it2 * L : (it2 + 1) * L]
-
-            curr_mps2[0] = half_id @ curr_mps2[0]
-            curr_mps2[-1] = curr_mps2[-1] @ half_zr
-
-            temp = mps_overlap(curr_mps1, curr_mps_shapes1, curr_mps2, curr_mps_shapes2)
-            denomin = denomin + (kappa1 * kappa2) * temp
-
-    overlap = tf.math.abs(nomin / tf.math.sqrt(denomin))
-    overlap = -tf.cast(overlap, dtype=tf.float64)
-    # print(1-overlap)
-
-    return overlap
+from ..tsp_helper_routines import check_checkpoint
+from ..tsp_helper_routines import load_checkpoint
+from ..tsp_helper_routines import save_checkpoint
 
 
 def lcu_unitary_circuit_optimization(
-    target_mps, kappas, lcu_mps, max_time=7200, max_iterations=3000, verbose=False
+    target_mps,
+    kappas,
+    lcu_mps,
+    max_time=7200,
+    max_iterations=3000,
+    verbose=False,
+    checkpoint_file=None,
+    checkpoint_every=100,
+    method="conjugate_gradient",
+    refit_kappas_every=None,
 ):
-
-    half_id = tf.convert_to_tensor(
-        [[1.0, 0.0, 0.0, 0.0], [0.0, 1.0, 0.0, 0.0]], dtype=tf.complex128
-    )
-    half_zr = tf.reshape(
-        tf.convert_to_tensor([1.0, 0.0], dtype=tf.complex128), shape=(-1, 1)
-    )
-
-    kappas = np.array(kappas, dtype=np.complex128)
-    kappas = [kappa.tolist() for kappa in kappas]
-    kappas = tf.Variable(kappas)
-
-    target_isometry_list, target_shapes_list = quimb_mps_to_tf_mps(
-        target_mps, canonical_form="left"
-    )
-    target_isometry_list = list(map(tf.constant, target_isometry_list))
-    target_isometry_list = list(
-        map(lambda x: tf.cast(x, dtype=tf.complex128), target_isometry_list)
-    )
-
-    lcu_isometry_list = []
-    lcu_shapes_list = []
-    for mps in lcu_mps:
-        isometry_list, shapes_list = quimb_mps_to_tf_mps(mps, canonical_form="left")
-        for shape, isometry in zip(shapes_list, isometry_list):
-
-            if isometry.shape == (4, 1):  # eng
-                isometry = (
-                    np.array(
-                        [
-                            isometry,
-                            sp.linalg.null_space(isometry.T)[:, 0].reshape(-1, 1),
-                        ]
-                    )
-                    .squeeze()
-                    .T
-                )
-
-            elif isometry.shape == (2, 2):  # beginning
-                temp = np.zeros((4, 2), dtype=np.complex128)
-                temp[:2, :2] = isometry
-                isometry = temp
-
-            lcu_shapes_list.append(shape)
-            lcu_isometry_list.append(isometry)
+    """method="conjugate_gradient" uses the compiled tensorflow overlap and its
+    autodiff gradient. method="trust_regions" runs pymanopt's riemannian
+    trust-region solver with the analytic euclidean gradient and
+    hessian-vector products of LCUOverlapDerivatives, it typically converges in
+    far fewer (but more expensive) outer iterations.
+
+    the kappas are re-fitted in closed form (optimal_kappas) from the gram
+    matrix and target overlaps of the current terms every refit_kappas_every
+    iterations and at the end (never if None, the default), the final kappas
+    are returned in data. the optimizer is restarted after every refit, so
+    conjugate gradient continues with a steepest descent step and trust
+    regions with its initial radius.
+
+    if checkpoint_file is given, the optimization runs in segments of
+    checkpoint_every iterations and the current point on the manifold is
+    written to the file after each segment. calling the function again with
+    the same checkpoint_file resumes from the last saved point, with the
+    remaining iteration and time budget. the conjugate gradient direction is
+    not part of pymanopt's public state, so the first step after a resume is a
+    steepest descent step.
+    """
+
+    kappas = tf.Variable(np.array(kappas, dtype=np.complex128))
+    target = tf.constant(pad_target_mps(target_mps))
 
     no_of_layers, L = len(lcu_mps), target_mps.L
-
-    tensor = np.zeros((no_of_layers * L, 4, 2), dtype=np.complex128)
-    for it, isometry in enumerate(lcu_isometry_list):
-        tensor[it, :, :] = isometry
-    tensor = tf.convert_to_tensor(tensor, dtype=tf.complex128)
+    tensor = lcu_isometries(lcu_mps)
+    derivatives = LCUOverlapDerivatives(target.numpy(), kappas.numpy(), no_of_layers)
 
     manifold = ComplexGrassmann(4, 2, k=no_of_layers * L)
-    euclidean_gradient = euclidean_hessian = None
-
-    compute_overlap(
-        tensor,
-        lcu_shapes_list,
-        target_isometry_list,
-        target_shapes_list,
-        kappas,
-        no_of_layers,
-        L,
-        half_id,
-        half_zr,
-    )
-
-    @pymanopt.function.tensorflow(manifold)
-    def loss(x):
-        return compute_overlap(
-            x,
-            lcu_shapes_list,
-            target_isometry_list,
-            target_shapes_list,
-            kappas,
-            no_of_layers,
-            L,
-            half_id,
-            half_zr,
-        )
 
-    euclidean_gradient = euclidean_hessian = None
+    if method == "conjugate_gradient":
+        compute_overlap = compiled_lcu_overlap(no_of_layers, L)
 
-    problem = pymanopt.Problem(
-        manifold,
-        loss,
-        euclidean_gradient=euclidean_gradient,
-        euclidean_hessian=euclidean_hessian,
-    )
+        @pymanopt.function.tensorflow(manifold)
+        def loss(x):
+            return compute_overlap(x, target, kappas)
 
-    # optimizer = TrustRegions(verbosity=2 * int(not quiet), max_time=7200)
-    # estimated_spanning_set = optimizer.run( problem, Delta_bar=8 * np.sqrt(2), initial_point=tensor).point
+        problem = pymanopt.Problem(manifold, loss)
+        Optimizer = ConjugateGradient
 
-    optimizer = ConjugateGradient(
-        max_time=max_time, max_iterations=max_iterations, verbosity=int(verbose) * 2
-    )
-    estimated_spanning_set = optimizer.run(problem, initial_point=tensor).point
-
-    lcu_mps_opt = convert_to_lcu_mps(
-        estimated_spanning_set, len(kappas.numpy()), target_mps.L
-    )
-    data = {"lcu_mps_opt": lcu_mps_opt, "optimizer": optimizer}
-    return data
+    elif method == "trust_regions":
 
+        @pymanopt.function.numpy(manifold)
+        def loss(x):
+            return derivatives.cost(x)
 
-def convert_to_lcu_mps(opt_tensor, num_of_layers, L):
-    half_id = np.array([[1.0, 0.0, 0.0, 0.0], [0.0, 1.0, 0.0, 0.0]])
-    half_zr = np.array([1.0, 0.0])
+        @pymanopt.function.numpy(manifold)
+        def euclidean_gradient(x):
+            return derivatives.euclidean_gradient(x)
 
-    lcu_mps_opt = []
-    for k_it in range(num_of_layers):
-        curr_mps = [opt_tensor[k_it * L + site] for site in range(L)]
-        curr_mps[0] = (half_id @ curr_mps[0]).reshape(2, 2).transpose((1, 0))
-        curr_mps[-1] = (curr_mps[-1] @ half_zr).reshape(2, 2)
+        @pymanopt.function.numpy(manifold)
+        def euclidean_hessian(x, v):
+            return derivatives.euclidean_hessian(x, v)
 
-        for it in range(1, L - 1):
-            curr_mps[it] = curr_mps[it].reshape((2, 2, 2)).transpose((0, 2, 1))
+        problem = pymanopt.Problem(
+            manifold,
+            loss,
+            euclidean_gradient=euclidean_gradient,
+            euclidean_hessian=euclidean_hessian,
+        )
+        Optimizer = TrustRegions
 
-        lcu_mps_opt.append(qtn.MatrixProductState(curr_mps))
+    else:
+        raise ValueError(
+            f"method should be conjugate_gradient or trust_regions, got {method}"
+        )
 
-    return lcu_mps_opt
+    def refit_kappas(point):
+        gram, target_overlaps = derivatives.gram_and_overlaps(np.array(point))
+        new_kappas, _ = optimal_kappas(gram, target_overlaps)
+        kappas.assign(new_kappas.astype(np.complex128))
+        derivatives.set_kappas(new_kappas)
+
+    point, iterations, elapsed_time = tensor, 0, 0.0
+    state = load_checkpoint(checkpoint_file)
+    if state is not None:
+        check_checkpoint(state, no_of_layers=no_of_layers, L=L)
+        point = state["point"]
+        iterations, elapsed_time = state["iterations"], state["time"]
+        kappas.assign(state.get("kappas", kappas.numpy()))
+        derivatives.set_kappas(kappas.numpy())
+
+    segment = max_iterations
+    if checkpoint_file is not None:
+        segment = min(segment, checkpoint_every)
+    if refit_kappas_every is not None:
+        segment = min(segment, refit_kappas_every)
+
+    last_refit = iterations
+    while iterations < max_iterations and elapsed_time < max_time:
+        optimizer = Optimizer(
+            max_time=max_time - elapsed_time,
+            max_iterations=min(segment, max_iterations - iterations),
+            verbosity=int(verbose) * 2,
+        )
+        result = optimizer.run(problem, initial_point=point)
+        point = result.point
+        iterations += result.iterations
+        elapsed_time += result.time
+
+        if (
+            refit_kappas_every is not None
+            and iterations - last_refit >= refit_kappas_every
+        ):
+            refit_kappas(point)
+            last_refit = iterations
+
+        if checkpoint_file is not None:
+            save_checkpoint(
+                checkpoint_file,
+                {
+                    "no_of_layers": no_of_layers,
+                    "L": L,
+                    "point": np.array(point),
+                    "kappas": kappas.numpy(),
+                    "iterations": iterations,
+                    "time": elapsed_time,
+                },
+            )
+
+        # stop unless the segment ended only because of its iteration budget
+        if "max iter" not in result.stopping_criterion or result.iterations == 0:
+            break
+
+    estimated_spanning_set = np.array(point)
+    if refit_kappas_every is not None:
+        refit_kappas(estimated_spanning_set)
+
+    lcu_mps_opt = convert_to_lcu_mps(estimated_spanning_set, no_of_layers, L)
+    data = {
+        "lcu_mps_opt": lcu_mps_opt,
+        "kappas": np.real(kappas.numpy()),
+        "optimizer": optimizer,
+    }
+    return data
 
 
 if __name__ == "__main__":
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import numpy as np
+import scipy as sp
 import tensorflow as tf
 import tensornetwork as tn
+import quimb.tensor as qtn
+
+from ..tsp_helper_routines import should_validate
+from ..tsp_helper_routines.mps_sum import mps_to_arrays
 
 tn.set_default_backend("tensorflow")
 
@@ -73,7 +78,8 @@ def quimb_mps_to_tf_mps(mps, canonical_form):
         mps.right_canonize(normalize=True)
 
     tens_list = [mps.tensor_map[tid].data for tid in range(mps.L)]
-    canonical_form_sanity_check(tens_list, canonical_form=canonical_form)
+    if should_validate("canonical_form"):
+        canonical_form_sanity_check(tens_list, canonical_form=canonical_form)
 
     isometry_list = mps_to_isometry_list(tens_list, canonical_form)
     shapes_list = [ten.shape for ten in tens_list]
@@ -86,36 +92,155 @@ def quimb_mps_to_tf_mps(mps, canonical_form):
     return isometry_list, shapes_list
 
 
-@tf.function
-def mps_overlap(bra_isom, bra_shapes, ket_isom, ket_shapes):
+def lcu_isometries(lcu_mps):
+    """returns the left canonical bond-2 lcu mps stacked as a (K*L, 4, 2) array
+    of isometries, the rows of every site are ordered as (left, phys). bonds of
+    size one are zero padded and the missing columns are completed with an
+    orthonormal basis of the null space, the padding is projected out by the
+    boundary vectors of the overlap kernel.
+    """
+    isometries = []
+    for mps in lcu_mps:
+        quimb_mps_to_tf_mps(mps, canonical_form="left")
+
+        for ten in mps_to_arrays(mps):
+            dl, d, dr = ten.shape
+            padded = np.zeros((2, 2, 2), dtype=np.complex128)
+            padded[:dl, :d, :dr] = ten
+            isometry = padded.reshape(4, 2)
+
+            if dr == 1:
+                isometry[:, 1] = sp.linalg.null_space(isometry[:, :1].conj().T)[:, 0]
+
+            isometries.append(isometry)
+
+    return np.array(isometries)
+
+
+def pad_target_mps(target_mps):
+    """returns the normalized target as an (L, D, 2, D) array of (left, phys,
+    right) tensors, zero padded to the largest bond dimension D
+    """
+    target_mps = target_mps.copy()
+    target_mps.normalize()
+
+    arrays = mps_to_arrays(target_mps)
+    D = max(max(ten.shape[0], ten.shape[2]) for ten in arrays)
+    target = np.zeros((len(arrays), D, 2, D), dtype=np.complex128)
+    for i, ten in enumerate(arrays):
+        dl, _, dr = ten.shape
+        target[i, :dl, :, :dr] = ten
+
+    return target
+
+
+def upper_triangle_pairs(no_of_layers):
+    """indices (i, j) with i <= j, and the multiplicity of each pair in the
+    hermitian form sum_ij conj(kappa_i) kappa_j <t_i|t_j>
+    """
+    i_indx, j_indx = np.triu_indices(no_of_layers)
+    multiplicity = np.where(i_indx == j_indx, 1.0, 2.0)
+    return i_indx, j_indx, multiplicity
+
+
+def batched_lcu_overlap(x, target, kappas, no_of_layers):
+    """returns -|<target|sum_k kappa_k t_k>| / |sum_k kappa_k t_k|.
+
+    x holds the K bond-2 terms t_k as (K*L, 4, 2) isometries (see
+    lcu_isometries) and target is the (L, D, 2, D) padded target mps (see
+    pad_target_mps). the gram matrix <t_i|t_j> (upper triangle only) and the
+    overlaps <target|t_k> are contracted as batched transfer matrices, sweeping
+    once over the sites for all terms and pairs at the same time.
+    """
+    i_indx, j_indx, multiplicity = upper_triangle_pairs(no_of_layers)
+    K, L = no_of_layers, target.shape[0]
+
+    # (L, K, left, phys, right)
+    terms = tf.transpose(tf.reshape(x, (K, L, 2, 2, 2)), (1, 0, 2, 3, 4))
+    bra = tf.math.conj(tf.gather(terms, i_indx, axis=1))
+    ket = tf.gather(terms, j_indx, axis=1)
+
+    P, D = len(multiplicity), tf.shape(target)[1]
+    gram_env = tf.one_hot(tf.zeros(P, dtype=tf.int32), 4, dtype=x.dtype)
+    gram_env = tf.reshape(gram_env, (P, 2, 2))
+    target_env = tf.one_hot(tf.zeros(K, dtype=tf.int32), 2 * D, dtype=x.dtype)
+    target_env = tf.reshape(target_env, (K, D, 2))
+
+    def transfer(envs, site):
+        gram_env, target_env = envs
+        bra_A, ket_A, target_A, A = site
+        gram_env = tf.einsum("nab,napc,nbpd->ncd", gram_env, bra_A, ket_A)
+        target_env = tf.einsum(
+            "kab,apc,kbpd->kcd", target_env, tf.math.conj(target_A), A
+        )
+        return gram_env, target_env
+
+    gram_env, target_env = tf.foldl(
+        transfer,
+        (bra, ket, tf.cast(target, x.dtype), terms),
+        initializer=(gram_env, target_env),
+    )
+    gram = gram_env[:, 0, 0]
+    target_overlaps = target_env[:, 0, 0]
+
+    kappas = tf.cast(kappas, x.dtype)
+    nomin = tf.reduce_sum(kappas * target_overlaps)
+    denomin = tf.reduce_sum(
+        multiplicity
+        * tf.math.real(
+            tf.math.conj(tf.gather(kappas, i_indx)) * tf.gather(kappas, j_indx) * gram
+        )
+    )
+
+    overlap = tf.math.abs(nomin) / tf.math.sqrt(tf.cast(denomin, tf.float64))
+    return -tf.cast(overlap, dtype=tf.float64)
+
+
+# compiled overlap kernels, keyed on (no_of_layers, L, dtype)
+_compiled = {}
 
-    bra_mps = [tf.reshape(A, shape) for A, shape in zip(bra_isom, bra_shapes)]
-    ket_mps = [
-        tf.reshape(tf.math.conj(A), shape) for A, shape in zip(ket_isom, ket_shapes)
+
+def compiled_lcu_overlap(no_of_layers, L, dtype=tf.complex128):
+    """returns batched_lcu_overlap(x, target, kappas) as a tf.function with a
+    fixed input signature. it is traced once per (no_of_layers, L, dtype) and
+    reused by every later call in the process, for any target bond dimension.
+
+    for a real dtype x is the real representation (K*L, 4, 2, 2) of the
+    isometries, as used by QGOpt, and is converted to complex on the graph.
+    """
+    dtype = tf.as_dtype(dtype)
+    key = (no_of_layers, L, dtype)
+    if key in _compiled:
+        return _compiled[key]
+
+    x_shape = (no_of_layers * L, 4, 2) + ((2,) if not dtype.is_complex else ())
+    input_signature = [
+        tf.TensorSpec(shape=x_shape, dtype=dtype),
+        tf.TensorSpec(shape=(L, None, 2, None), dtype=tf.complex128),
+        tf.TensorSpec(shape=(no_of_layers,), dtype=tf.complex128),
     ]
 
-    L = len(bra_mps)
-    co = 1
-    list_of_tens = []
-    list_of_inds = []
-    for tid, (bra_A, ket_A) in enumerate(zip(bra_mps, ket_mps)):
-        ket_A = tf.math.conj(ket_A)
+    @tf.function(input_signature=input_signature)
+    def overlap(x, target, kappas):
+        if not dtype.is_complex:
+            x = tf.complex(x[..., 0], x[..., 1])
+        return batched_lcu_overlap(x, target, kappas, no_of_layers)
 
-        list_of_tens.append(bra_A)
-        list_of_tens.append(ket_A)
+    _compiled[key] = overlap
+    return overlap
 
-        if tid == 0:
-            list_of_inds.append([co, co + 1])
-            list_of_inds.append([co, co + 2])
-            co += 3
 
-        elif tid == (L - 1):
-            list_of_inds.append([co - 2, co])
-            list_of_inds.append([co - 1, co])
+def convert_to_lcu_mps(opt_tensor, num_of_layers, L):
+    """inverse of lcu_isometries, returns the K terms as quimb mps"""
+    opt_tensor = np.asarray(opt_tensor).reshape(num_of_layers, L, 2, 2, 2)
 
-        else:
-            list_of_inds.append([co - 2, co, co + 1])
-            list_of_inds.append([co - 1, co, co + 2])
-            co += 3
+    lcu_mps_opt = []
+    for k_it in range(num_of_layers):
+        # (left, phys, right) -> (left, right, phys)
+        curr_mps = [opt_tensor[k_it, site].transpose(0, 2, 1) for site in range(L)]
+        curr_mps[0] = curr_mps[0][0]
+        curr_mps[-1] = curr_mps[-1][:, 0]
+
+        lcu_mps_opt.append(qtn.MatrixProductState(curr_mps))
 
-    return tn.ncon(list_of_tens, list_of_inds)
+    return lcu_mps_opt
@@ -2,7 +2,6 @@ import numpy as np
 import pickle as pkl
 
 
-import quimb.tensor as qtn
 import QGOpt as qgo
 from tqdm import tqdm
 
@@ -10,110 +9,73 @@ from tqdm import tqdm
 import tensorflow as tf
 
 
-from .lcu_optimization_misc import mps_overlap
-from .lcu_optimization_misc import quimb_mps_to_tf_mps
+from .lcu_optimization_misc import compiled_lcu_overlap
+from .lcu_optimization_misc import convert_to_lcu_mps
+from .lcu_optimization_misc import lcu_isometries
+from .lcu_optimization_misc import pad_target_mps
+from .lcu_kappas import optimal_kappas
+from .lcu_overlap_derivatives import LCUOverlapDerivatives
 
+from ..tsp_helper_routines import check_checkpoint
+from ..tsp_helper_routines import load_checkpoint
+from ..tsp_helper_routines import save_checkpoint
 
-@tf.function
-def compute_overlap(
-    lcu_list_var,
-    lcu_shapes_list,
-    target_isometry_list,
-    target_shapes_list,
-    kappas,
-    no_of_layers,
-    L,
-):
 
-    lcu_list_var_c = list(map(qgo.manifolds.real_to_complex, lcu_list_var))
-    # kappas = list(map(qgo.manifolds.real_to_complex, kappas))
-
-    nomin = 0.0
-    for it in range(no_of_layers):
-        kappa = kappas[it]
-        curr_mps = lcu_list_var_c[it * L : (it + 1) * L]
-        curr_mps_shapes = lcu_shapes_list[it * L : (it + 1) * L]
-
-        # with and without kappa, the optimal answer is same
-        temp = mps_overlap(
-            curr_mps, curr_mps_shapes, target_isometry_list, target_shapes_list
-        )
-        nomin = nomin + kappa * temp
-
-    denomin = 0.0
-    for it1 in range(no_of_layers):
-        kappa1 = kappas[it1]
-        curr_mps1 = lcu_list_var_c[it1 * L : (it1 + 1) * L]
-        curr_mps_shapes1 = lcu_shapes_list[it1 * L : (it1 + 1) * L]
-
-        for it2 in range(no_of_layers):
-            kappa2 = kappas[it2]
-            curr_mps2 = lcu_list_var_c[it2 * L : (it2 + 1) * L]
-            curr_mps_shapes2 = lcu_shapes_list[it2 * L : (it2 + 1) * L]
-
-            temp = mps_overlap(curr_mps1, curr_mps_shapes1, curr_mps2, curr_mps_shapes2)
-            denomin = denomin + (kappa1 * kappa2) * temp
-
-    overlap = tf.math.abs(nomin / tf.math.sqrt(denomin))
-    overlap = -tf.cast(overlap, dtype=tf.float64)
-    return overlap
-
-
-def lcu_list_to_x(lcu_list, shape_structure):
-    x = []
-    for ten, shape in zip(lcu_list, shape_structure):
-        for ele in ten.numpy().flatten():
-            x.append(ele)
-    x = np.array(x, dtype=np.float64)
-    return x
-
-
-def x_to_tf_lcu_list(x, shape_structure):
-    xx = []
-    offset = 0
-    for shape in shape_structure:
-        ten = tf.Variable(
-            np.array(x[offset : (offset + np.prod(shape))], dtype=np.float64).reshape(
-                shape
-            ),
-            dtype=tf.float64,
-        )
-        offset = offset + np.prod(shape)
-        xx.append(ten)
-
-    return xx
-
-
-# @tf.function
-def value_and_gradient(
-    lcu_isometry_list_var,
-    lcu_shapes_list,
-    target_isometry_list,
-    target_shapes_list,
-    kappas,
-    no_of_layers,
-    L,
-):
+class StepCountedRAdam(qgo.optimizers.RAdam):
+    """QGOpt's RAdam made traceable, so apply_gradients can run in a
+    tf.function. RAdam counts the steps of its bias correction in the python
+    attribute iter, which would be frozen at trace time, here iter follows
+    the iterations variable of the optimizer instead (which apply_gradients
+    increments after every update and which is saved with the optimizer
+    weights). the update also returns the updated variable, as
+    apply_gradients groups what the updates return (RAdam's returns nothing).
+    """
+
+    @property
+    def iter(self):
+        # the update in progress is step iterations + 1
+        return tf.cast(self.iterations + 1, tf.complex128)
 
-    with tf.GradientTape() as tape:
-        overlap = compute_overlap(
-            lcu_isometry_list_var,
-            lcu_shapes_list,
-            target_isometry_list,
-            target_shapes_list,
-            kappas,
-            no_of_layers,
-            L,
-        )
+    @iter.setter
+    def iter(self, value):
+        # RAdam increments iter itself, apply_gradients already does
+        pass
 
-    # grad = tape.gradient(overlap, lcu_isometry_list_var)
-    grad = tape.gradient(overlap, lcu_isometry_list_var + [kappas])
-    return overlap, grad
+    def _resource_apply_dense(self, grad, var):
+        super()._resource_apply_dense(grad, var)
+        return var.read_value()
 
 
 def lcu_unitary_circuit_optimization(
-    target_mps, kappas, lcu_mps, max_iterations, verbose=False
+    target_mps,
+    kappas,
+    lcu_mps,
+    max_iterations,
+    verbose=False,
+    checkpoint_file=None,
+    checkpoint_every=100,
+    metrics_every=10,
+    refit_kappas_every=None,
+    pause_at=None,
 ):
+    """the whole riemannian step (gradient, RAdam update, learning rate decay
+    and gradient norm) is a single compiled function, the overlap and gradient
+    norm of every iteration are recorded on the device and only copied to the
+    host every metrics_every iterations (and at checkpoints).
+
+    the kappas are re-fitted in closed form (optimal_kappas) from the gram
+    matrix and target overlaps of the current terms every refit_kappas_every
+    iterations and at the end (never if None, the default), the final kappas
+    are returned in data.
+
+    if checkpoint_file is given, the variables, the state of the riemannian
+    optimizer (moment estimates, step counter and learning rate) and the
+    overlap history are written to it every checkpoint_every iterations.
+    calling the function again with the same checkpoint_file resumes the
+    optimization exactly where it stopped. if pause_at is given, the run stops
+    (and checkpoints) after pause_at of the max_iterations iterations, so it
+    can be continued later with the same learning rate schedule.
+    """
 
     # tf.random.set_seed(42)
 
@@ -124,8 +86,12 @@ def lcu_unitary_circuit_optimization(
     # learning rate is multiplied by this coefficient each iteration
     decay = (lr_f / lr_i) ** (1 / iters)
 
+    # the learning rate is decayed within the compiled step (float32 as the
+    # hyperparameter variables keras creates)
+    learning_rate = tf.Variable(lr_i, dtype=tf.float32)
+
     m = qgo.manifolds.StiefelManifold()  # complex Stiefel manifold
-    riemannian_optimizer = qgo.optimizers.RAdam(m, learning_rate=lr_i)
+    riemannian_optimizer = StepCountedRAdam(m, learning_rate=learning_rate)
     # riemannian_optimizer = tf.keras.optimizers.Adam()
     # lr_schedule = tf.keras.optimizers.schedules.ExponentialDecay(
     #     initial_learning_rate=1.,
@@ -133,86 +99,100 @@ def lcu_unitary_circuit_optimization(
     #     decay_rate=0.99)
     # optimizer = tf.keras.optimizers.SGD(learning_rate=lr_schedule)
 
-    kappas = np.array(kappas, dtype=np.complex128)
-    kappas = [kappa.tolist() for kappa in kappas]
-    # kappas = list(map(qgo.manifolds.complex_to_real, kappas))
-    kappas = tf.Variable(kappas)
-
-    target_isometry_list, target_shapes_list = quimb_mps_to_tf_mps(
-        target_mps, canonical_form="left"
-    )
-    target_isometry_list = list(map(tf.constant, target_isometry_list))
-    target_isometry_list = list(
-        map(lambda x: tf.cast(x, dtype=tf.complex128), target_isometry_list)
-    )
-
-    lcu_isometry_list = []
-    lcu_shapes_list = []
-    for mps in lcu_mps:
-        isometry_list, shapes_list = quimb_mps_to_tf_mps(mps, canonical_form="left")
-
-        for shape, isometry in zip(shapes_list, isometry_list):
-            lcu_shapes_list.append(shape)
-            lcu_isometry_list.append(isometry)
+    kappas = tf.Variable(np.array(kappas, dtype=np.complex128))
+    target = tf.constant(pad_target_mps(target_mps))
 
-    lcu_isometry_list = list(map(qgo.manifolds.complex_to_real, lcu_isometry_list))
-    lcu_isometry_list_var = list(map(tf.Variable, lcu_isometry_list))
-    shape_structure = [t.shape for t in lcu_isometry_list]
+    # all the sites of all the terms as one batch of (4, 2) isometries
+    lcu_var = tf.Variable(qgo.manifolds.complex_to_real(lcu_isometries(lcu_mps)))
 
     no_of_layers, L = len(lcu_mps), target_mps.L
-    overlaps_list = []
-    for j in tqdm(range(iters)):
-        # overlap, grad = value_and_gradient(lcu_isometry_list_var, kappas)
-        overlap, grad = value_and_gradient(
-            lcu_isometry_list_var,
-            lcu_shapes_list,
-            target_isometry_list,
-            target_shapes_list,
-            kappas,
-            no_of_layers,
-            L,
-        )
-
-        riemannian_optimizer.apply_gradients(zip(grad, lcu_isometry_list_var))
-        riemannian_optimizer._set_hyper(
-            "learning_rate", riemannian_optimizer._get_hyper("learning_rate") * decay
-        )
-
-        # vanilla optimization over kappas does not help
-        # optimizer.apply_gradients(zip([grad[-1]], [kappas]))
-        overlaps_list.append(overlap)
-        grad_norm = np.linalg.norm(lcu_list_to_x(grad, shape_structure))
-        if verbose:
-            print(f" overlap={overlap.numpy():.06f}, \t |grad|={grad_norm:.06f},\t")
-
-    tf.print(f"final overlap (after {iters} iters): ", overlaps_list[-1])
+    compute_overlap = compiled_lcu_overlap(no_of_layers, L, tf.float64)
+    derivatives = LCUOverlapDerivatives(target.numpy(), kappas.numpy(), no_of_layers)
+
+    def refit_kappas():
+        x = qgo.manifolds.real_to_complex(lcu_var).numpy()
+        gram, target_overlaps = derivatives.gram_and_overlaps(x)
+        new_kappas, _ = optimal_kappas(gram, target_overlaps)
+        kappas.assign(new_kappas.astype(np.complex128))
+
+    overlaps = tf.Variable(tf.zeros(iters, dtype=tf.float64))
+    grad_norms = tf.Variable(tf.zeros(iters, dtype=tf.float64))
+
+    @tf.function
+    def train_step(j):
+        with tf.GradientTape() as tape:
+            overlap = compute_overlap(lcu_var, target, kappas)
+
+        grad = tape.gradient(overlap, lcu_var)
+
+        riemannian_optimizer.apply_gradients([(grad, lcu_var)])
+        learning_rate.assign(learning_rate * decay)
+
+        overlaps[j].assign(overlap)
+        grad_norms[j].assign(tf.norm(grad))
+
+    start = 0
+    state = load_checkpoint(checkpoint_file)
+    if state is not None:
+        check_checkpoint(state, no_of_layers=no_of_layers, L=L, iters=iters)
+
+        # the moment estimates can only be loaded into existing slots, they
+        # are created by an update with a zero gradient, whose result is
+        # overwritten
+        riemannian_optimizer.apply_gradients([(tf.zeros_like(lcu_var), lcu_var)])
+        lcu_var.assign(state["variables"][0])
+        riemannian_optimizer.set_weights(state["optimizer_weights"])
+        learning_rate.assign(state["learning_rate"])
+        kappas.assign(state.get("kappas", kappas.numpy()))
+
+        start = state["iteration"] + 1
+        overlaps[:start].assign(state["overlaps"])
+
+    stop = iters if pause_at is None else min(pause_at, iters)
+    for j in tqdm(range(start, stop), initial=start, total=iters):
+        train_step(tf.constant(j))
+
+        # vanilla optimization over kappas does not help, they are re-fitted
+        # in closed form instead
+        if refit_kappas_every is not None and (j + 1) % refit_kappas_every == 0:
+            refit_kappas()
+
+        if verbose and ((j + 1) % metrics_every == 0 or (j + 1) == stop):
+            overlap, grad_norm = overlaps[j].numpy(), grad_norms[j].numpy()
+            print(f" overlap={overlap:.06f}, \t |grad|={grad_norm:.06f},\t")
+
+        if checkpoint_file is not None and (
+            (j + 1) % checkpoint_every == 0 or (j + 1) == stop
+        ):
+            save_checkpoint(
+                checkpoint_file,
+                {
+                    "no_of_layers": no_of_layers,
+                    "L": L,
+                    "iters": iters,
+                    "iteration": j,
+                    "variables": [lcu_var.numpy()],
+                    "kappas": kappas.numpy(),
+                    "optimizer_weights": riemannian_optimizer.get_weights(),
+                    "learning_rate": float(learning_rate.numpy()),
+                    "overlaps": overlaps[: j + 1].numpy(),
+                },
+            )
+
+    if refit_kappas_every is not None:
+        refit_kappas()
+
+    overlaps_list = overlaps.numpy()
+    tf.print(f"final overlap (after {stop} iters): ", overlaps_list[stop - 1])
 
     ####
     lcu_mps_opt = convert_to_lcu_mps(
-        lcu_isometry_list_var, lcu_shapes_list, len(lcu_mps), target_mps.L
+        qgo.manifolds.real_to_complex(lcu_var).numpy(), no_of_layers, L
     )
-    data = {"lcu_mps_opt": lcu_mps_opt}
+    data = {"lcu_mps_opt": lcu_mps_opt, "kappas": np.real(kappas.numpy())}
     return data
 
 
-def convert_to_lcu_mps(tens_list, lcu_shapes_list, num_of_layers, L):
-    tens = list(map(qgo.manifolds.real_to_complex, tens_list))
-    tens = [tf.reshape(x, shape).numpy() for x, shape in zip(tens, lcu_shapes_list)]
-
-    lcu_mps_opt = []
-    for k_it in range(num_of_layers):
-        curr_mps = [tens[k_it * L + site] for site in range(L)]
-        curr_mps[0] = curr_mps[0].transpose((1, 0))
-        curr_mps[-1] = curr_mps[-1]
-
-        for it in range(1, L - 1):
-            curr_mps[it] = curr_mps[it].transpose((0, 2, 1))
-
-        lcu_mps_opt.append(qtn.MatrixProductState(curr_mps))
-
-    return lcu_mps_opt
-
-
 if __name__ == "__main__":
     with open("/home/mohsin/Documents/gh/gh_qsp/examples/temp_dump.pkl", "rb") as f:
         [target_mps, kappas, lcu_mps] = pkl.load(f)
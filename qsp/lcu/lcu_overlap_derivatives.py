@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""analytic derivatives of the lcu overlap objective
+
+    f(A) = -|n| / sqrt(d),  n = sum_k kappa_k <target|t_k>,
+                            d = sum_jk conj(kappa_j) kappa_k <t_j|t_k>,
+
+with respect to the site tensors A of the bond-2 terms t_k (the (K*L, 4, 2)
+isometries of lcu_isometries). all first derivatives follow from the left and
+right environments of <target|t_k> and <t_j|t_k>, the hessian-vector products
+from the same environments and their directional derivatives along the
+tangent vector, swept once as dual numbers. for real f of complex A the
+euclidean gradient g is defined by Df[V] = Re(sum conj(g) V), as used by the
+complex manifolds of pymanopt.
+"""
+
+import numpy as np
+
+
+def _boundary(*shape):
+    env = np.zeros(shape, dtype=np.complex128)
+    env[..., 0, 0] = 1.0
+    return env
+
+
+def _step_target(env, T, A):
+    return np.einsum("kab,apc,kbpd->kcd", env, np.conj(T), A)
+
+
+def _step_target_right(env, T, A):
+    return np.einsum("apc,kbpd,kcd->kab", np.conj(T), A, env)
+
+
+def _step_gram(env, A_bra, A_ket):
+    return np.einsum("jkab,japc,kbpd->jkcd", env, np.conj(A_bra), A_ket)
+
+
+def _step_gram_right(env, A_bra, A_ket):
+    return np.einsum("japc,kbpd,jkcd->jkab", np.conj(A_bra), A_ket, env)
+
+
+class LCUOverlapDerivatives:
+    """cost, euclidean gradient and hessian-vector products of the lcu overlap
+    objective. the environments of the last point are cached, so the repeated
+    calls of a trust-region solver at the same point only sweep once for the
+    point and once per tangent vector.
+
+    Parameters
+    ----------
+    target : numpy.ndarray
+        (L, D, 2, D) padded target mps, see pad_target_mps
+
+    kappas : list(complex)
+        coefficients of the K terms
+
+    no_of_layers : int
+        number of terms K
+    """
+
+    def __init__(self, target, kappas, no_of_layers):
+        self.target = np.asarray(target, dtype=np.complex128)
+        self.kappas = np.asarray(kappas, dtype=np.complex128)
+        self.K, self.L = no_of_layers, self.target.shape[0]
+        self._x = None
+
+    def set_kappas(self, kappas):
+        self.kappas = np.asarray(kappas, dtype=np.complex128)
+        self._x = None
+
+    def gram_and_overlaps(self, x):
+        """returns the gram matrix <t_i|t_j> and the overlaps <t_i|target> of
+        the terms at x, as used by optimal_kappas
+        """
+        self._environments(x)
+        return self.gram, np.conj(self.b)
+
+    def _terms(self, x):
+        return np.asarray(x).reshape(self.K, self.L, 2, 2, 2)
+
+    def _environments(self, x):
+        if self._x is not None and np.array_equal(self._x, x):
+            return
+        self._x = np.array(x)
+
+        K, L, D, T = self.K, self.L, self.target.shape[1], self.target
+        A = self._terms(x)
+
+        LT, RT = [_boundary(K, D, 2)], [_boundary(K, D, 2)]
+        LG, RG = [_boundary(K, K, 2, 2)], [_boundary(K, K, 2, 2)]
+        for s in range(L):
+            LT.append(_step_target(LT[-1], T[s], A[:, s]))
+            LG.append(_step_gram(LG[-1], A[:, s], A[:, s]))
+        for s in reversed(range(L)):
+            RT.insert(0, _step_target_right(RT[0], T[s], A[:, s]))
+            RG.insert(0, _step_gram_right(RG[0], A[:, s], A[:, s]))
+
+        self.A, self.LT, self.RT, self.LG, self.RG = A, LT, RT, LG, RG
+        self.b = LT[-1][:, 0, 0]
+        self.gram = LG[-1][:, :, 0, 0]
+        self.n = np.sum(self.kappas * self.b)
+        self.d = np.real(np.conj(self.kappas) @ self.gram @ self.kappas)
+
+        # F = dn/dA without kappa, H = d<psi|t_k>/dA with the bra fixed
+        self.F = np.stack(
+            [
+                np.einsum("kab,apc,kcd->kbpd", LT[s], np.conj(T[s]), RT[s + 1])
+                for s in range(L)
+            ],
+            axis=1,
+        )
+        self.H = np.stack(
+            [self._gram_site(LG[s], A[:, s], RG[s + 1]) for s in range(L)], axis=1
+        )
+
+    def _gram_site(self, left, A_bra, right):
+        return np.einsum(
+            "j,jkab,japc,jkcd->kbpd", np.conj(self.kappas), left, np.conj(A_bra), right
+        )
+
+    def _coefficients(self):
+        abs_n, sqrt_d = np.abs(self.n), np.sqrt(self.d)
+        alpha = np.conj(self.n) / (abs_n * sqrt_d)
+        beta = abs_n / sqrt_d**3
+        return alpha, beta
+
+    def cost(self, x):
+        self._environments(x)
+        return -np.abs(self.n) / np.sqrt(self.d)
+
+    def euclidean_gradient(self, x):
+        self._environments(x)
+        alpha, beta = self._coefficients()
+        kappas = self.kappas[:, None, None, None, None]
+
+        grad = np.conj(kappas * (-alpha * self.F + beta * self.H))
+        return grad.reshape(self.K * self.L, 4, 2)
+
+    def euclidean_hessian(self, x, v):
+        """directional derivative of euclidean_gradient at x along v"""
+        self._environments(x)
+        K, L, D, T = self.K, self.L, self.target.shape[1], self.target
+        A, LT, RT, LG, RG = self.A, self.LT, self.RT, self.LG, self.RG
+        V = self._terms(v)
+
+        # directional derivatives of the environments
+        dLT, dRT = [np.zeros((K, D, 2), dtype=np.complex128)], [None] * (L + 1)
+        dLG, dRG = [np.zeros((K, K, 2, 2), dtype=np.complex128)], [None] * (L + 1)
+        dRT[L], dRG[L] = dLT[0], dLG[0]
+        for s in range(L):
+            dLT.append(
+                _step_target(dLT[s], T[s], A[:, s]) + _step_target(LT[s], T[s], V[:, s])
+            )
+            dLG.append(
+                _step_gram(dLG[s], A[:, s], A[:, s])
+                + _step_gram(LG[s], V[:, s], A[:, s])
+                + _step_gram(LG[s], A[:, s], V[:, s])
+            )
+        for s in reversed(range(L)):
+            dRT[s] = _step_target_right(dRT[s + 1], T[s], A[:, s])
+            dRT[s] += _step_target_right(RT[s + 1], T[s], V[:, s])
+            dRG[s] = _step_gram_right(dRG[s + 1], A[:, s], A[:, s])
+            dRG[s] += _step_gram_right(RG[s + 1], V[:, s], A[:, s])
+            dRG[s] += _step_gram_right(RG[s + 1], A[:, s], V[:, s])
+
+        dF = np.stack(
+            [
+                np.einsum("kab,apc,kcd->kbpd", dLT[s], np.conj(T[s]), RT[s + 1])
+                + np.einsum("kab,apc,kcd->kbpd", LT[s], np.conj(T[s]), dRT[s + 1])
+                for s in range(L)
+            ],
+            axis=1,
+        )
+        dH = np.stack(
+            [
+                self._gram_site(dLG[s], A[:, s], RG[s + 1])
+                + self._gram_site(LG[s], V[:, s], RG[s + 1])
+                + self._gram_site(LG[s], A[:, s], dRG[s + 1])
+                for s in range(L)
+            ],
+            axis=1,
+        )
+
+        kappas = self.kappas[:, None, None, None, None]
+        n, d = self.n, self.d
+        abs_n, sqrt_d = np.abs(n), np.sqrt(d)
+        alpha, beta = self._coefficients()
+
+        dn = np.sum(kappas * self.F * V)
+        dd = 2.0 * np.real(np.sum(kappas * self.H * V))
+        dabs_n = np.real(np.conj(n) * dn) / abs_n
+
+        dalpha = (
+            np.conj(dn) / (abs_n * sqrt_d)
+            - np.conj(n) * dabs_n / (abs_n**2 * sqrt_d)
+            - alpha * dd / (2.0 * d)
+        )
+        dbeta = dabs_n / sqrt_d**3 - 1.5 * beta * dd / d
+
+        dgrad = kappas * (-dalpha * self.F - alpha * dF + dbeta * self.H + beta * dH)
+        return np.conj(dgrad).reshape(K * L, 4, 2)
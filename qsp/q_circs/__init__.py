@@ -4,9 +4,29 @@ from .qiskit_circuit import circuit_from_quimb_unitary
 
 from .qiskit_lcu_circuit import lcu_circuit_from_unitary_layers
 
+from .mps_simulator import circuit_overlap_mps
+from .mps_simulator import circuit_to_mps
+
+from .synthesis import append_unitaries
+from .synthesis import clear_synthesis_cache
+from .synthesis import cx_count_bounds
+from .synthesis import decompose_unitaries
+from .synthesis import decompose_unitary
+from .synthesis import estimate_costs
+from .synthesis import two_qubit_cx_counts
+
 __all__ = [
+    "append_unitaries",
     "approximate_adiabatic_cost",
     "circuit_from_unitary_layers",
     "circuit_from_quimb_unitary",
+    "circuit_overlap_mps",
+    "circuit_to_mps",
+    "clear_synthesis_cache",
+    "cx_count_bounds",
+    "decompose_unitaries",
+    "decompose_unitary",
+    "estimate_costs",
     "lcu_circuit_from_unitary_layers",
+    "two_qubit_cx_counts",
 ]
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""verification of qiskit circuits against a target mps without ever building
+the 2^L statevector. the circuit is simulated as an mps (memory linear in the
+number of qubits for bounded bond dimension) and the overlap with the target
+is contracted directly.
+
+qubit i of the qiskit circuit is site i of the simulated mps, the same
+convention used when the circuits are built.
+"""
+
+import numpy as np
+
+import qiskit
+import quimb.tensor as qtn
+
+BASIS_GATES = ["cx", "u3"]
+IGNORED_INSTRUCTIONS = ["barrier", "save_statevector"]
+
+
+cx = np.array(
+    [
+        [1.0, 0.0, 0.0, 0.0],
+        [0.0, 1.0, 0.0, 0.0],
+        [0.0, 0.0, 0.0, 1.0],
+        [0.0, 0.0, 1.0, 0.0],
+    ]
+)
+
+swap = np.array(
+    [
+        [1.0, 0.0, 0.0, 0.0],
+        [0.0, 0.0, 1.0, 0.0],
+        [0.0, 1.0, 0.0, 0.0],
+        [0.0, 0.0, 0.0, 1.0],
+    ]
+)
+
+
+def u3(theta, phi, lam):
+    return np.array(
+        [
+            [np.cos(theta / 2), -np.exp(1j * lam) * np.sin(theta / 2)],
+            [
+                np.exp(1j * phi) * np.sin(theta / 2),
+                np.exp(1j * (phi + lam)) * np.cos(theta / 2),
+            ],
+        ]
+    )
+
+
+class _MPSState:
+    """mps as a list of (left, phys, right) arrays with a tracked orthogonality
+    center, two-site gates only sweep the center from its last position so the
+    cost of a gate does not grow with the number of qubits
+    """
+
+    def __init__(self, num_qubits, max_bond=None, cutoff=1e-10):
+        zero = np.zeros((1, 2, 1), dtype=np.complex128)
+        zero[0, 0, 0] = 1.0
+        self.arrays = [zero.copy() for _ in range(num_qubits)]
+        self.center = 0
+        self.max_bond = max_bond
+        self.cutoff = cutoff
+
+    def move_center(self, site):
+        while self.center < site:
+            i = self.center
+            dl, d, dr = self.arrays[i].shape
+            q, r = np.linalg.qr(self.arrays[i].reshape(dl * d, dr))
+            self.arrays[i] = q.reshape(dl, d, -1)
+            self.arrays[i + 1] = np.tensordot(r, self.arrays[i + 1], axes=(1, 0))
+            self.center += 1
+
+        while self.center > site:
+            i = self.center
+            dl, d, dr = self.arrays[i].shape
+            q, r = np.linalg.qr(self.arrays[i].reshape(dl, d * dr).T)
+            self.arrays[i] = q.T.reshape(-1, d, dr)
+            self.arrays[i - 1] = np.tensordot(self.arrays[i - 1], r.T, axes=(2, 0))
+            self.center -= 1
+
+    def apply_1q(self, u, site):
+        self.arrays[site] = np.einsum("ij,ajb->aib", u, self.arrays[site])
+
+    def apply_2q(self, u, site):
+        """applies the 4x4 gate u on (site, site+1), site being the first
+        (most significant) index of u
+        """
+        self.move_center(site)
+        dl, dr = self.arrays[site].shape[0], self.arrays[site + 1].shape[2]
+
+        theta = np.tensordot(self.arrays[site], self.arrays[site + 1], axes=(2, 0))
+        theta = np.einsum("ijkl,aklb->aijb", u.reshape(2, 2, 2, 2), theta)
+        v, s, wh = np.linalg.svd(theta.reshape(dl * 2, 2 * dr), full_matrices=False)
+
+        keep = max(1, np.sum(s > self.cutoff * s[0]))
+        if self.max_bond is not None:
+            keep = min(keep, self.max_bond)
+
+        self.arrays[site] = v[:, :keep].reshape(dl, 2, keep)
+        self.arrays[site + 1] = (s[:keep, None] * wh[:keep]).reshape(keep, 2, dr)
+        self.center = site + 1
+
+    def apply_cx(self, control, target):
+        # bring the control next to the target with swaps, and back afterwards
+        step = 1 if control < target else -1
+        swaps = list(range(control, target - step, step))
+        for q in swaps:
+            self.apply_2q(swap, min(q, q + step))
+
+        q = target - step
+        self.apply_2q(cx if q < target else swap @ cx @ swap, min(q, target))
+
+        for q in reversed(swaps):
+            self.apply_2q(swap, min(q, q + step))
+
+    def to_quimb(self):
+        arrays = [array.transpose(0, 2, 1) for array in self.arrays]
+        arrays[0] = arrays[0][0]
+        arrays[-1] = arrays[-1][:, 0]
+        return qtn.MatrixProductState(arrays, shape="lrp")
+
+
+def circuit_to_mps(circ, max_bond=None, cutoff=1e-10):
+    """simulates circ (acting on |0...0>) as an mps with bond dimension capped at
+    max_bond (None means no cap, only singular values below cutoff relative to
+    the largest one are dropped)
+    """
+    if not set(circ.count_ops()).issubset(BASIS_GATES + IGNORED_INSTRUCTIONS):
+        circ = qiskit.transpile(circ, basis_gates=BASIS_GATES, optimization_level=0)
+
+    state = _MPSState(circ.num_qubits, max_bond=max_bond, cutoff=cutoff)
+
+    qubit_indx = {qubit: indx for indx, qubit in enumerate(circ.qubits)}
+    for instruction in circ.data:
+        name = instruction.operation.name
+        qubits = [qubit_indx[qubit] for qubit in instruction.qubits]
+
+        if name == "u3":
+            params = [float(param) for param in instruction.operation.params]
+            state.apply_1q(u3(*params), qubits[0])
+
+        elif name == "cx":
+            state.apply_cx(*qubits)
+
+        elif name in IGNORED_INSTRUCTIONS:
+            continue
+
+        else:
+            raise ValueError(f"gate {name} not supported by the mps simulator")
+
+    return state.to_quimb()
+
+
+def circuit_overlap_mps(
+    circ, target_mps, num_ancillas=0, site_ind_id="k{}", max_bond=None, cutoff=1e-10
+):
+    """returns |<target_mps|psi>| where psi is the (normalized) output of circ
+    after projecting its first num_ancillas qubits onto |0>. target_mps lives on
+    the remaining qubits, its physical indices are named by site_ind_id.
+    """
+    psi = circuit_to_mps(circ, max_bond=max_bond, cutoff=cutoff)
+
+    # postselect the ancillas, the remaining sites carry the target state
+    psi = psi.isel({psi.site_ind(i): 0 for i in range(num_ancillas)})
+    psi = psi.reindex(
+        {
+            psi.site_ind(num_ancillas + i): site_ind_id.format(i)
+            for i in range(target_mps.L)
+        }
+    )
+
+    norm = np.sqrt(np.abs((psi.H & psi).contract(all, optimize="auto")))
+    target_norm = np.sqrt(np.abs((target_mps.H & target_mps).contract(all)))
+    ovlp = (target_mps.H & psi).contract(all, optimize="auto")
+
+    return np.abs(ovlp) / (norm * target_norm)
@@ -2,14 +2,30 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 import scipy as sp
-import random
 
 import qiskit
-from qiskit.providers.aer import QasmSimulator
+from qiskit.circuit.library import U3Gate
 import quimb.tensor as qtn
 
+from .mps_simulator import circuit_overlap_mps
+from .synthesis import append_unitaries, decompose_unitaries, zyz_decomposition
+from .synthesis import estimate_costs
+
+from ..tsp_helper_routines import should_validate
+
+
+def approximate_adiabatic_cost(gates, num_samples=None, num_gates=None, exact=False):
+    """total number of gates and of cx gates of the (merged) two-site gates of
+    the adiabatic evolution. every gate is classified without synthesizing it
+    (see estimate_costs): the cx count of two-qubit gates is exact (local
+    invariants), for larger blocked gates it is the upper bound of
+    cx_count_bounds, and the total number of gates is an upper bound
+    3*num_cx + n. with exact=True the gates are synthesized instead
+    (natively for two qubits, with qiskit.transpile otherwise), only
+    num_samples evenly spaced ones if given. if gates is only a sample (see
+    SummaryGateSink), the counts are extrapolated to num_gates gates.
+    """
 
-def approximate_adiabatic_cost(gates):
     def qiskit_decomposition(u):
         num_qubits = int(np.log2(len(u)))
         qc = qiskit.QuantumCircuit(num_qubits)
@@ -17,12 +33,34 @@ def approximate_adiabatic_cost(gates):
         qc = qiskit.transpile(qc, basis_gates=["cx", "u"])
         return qc
 
+    if len(gates) == 0:
+        return np.zeros(2)
+
+    # (d, d, d, d) gates act on two sites of d = 2**k levels
+    num_left_qubits = int(np.log2(gates[0].shape[0])) if gates[0].ndim == 4 else None
+    gates = [gate.reshape(np.prod(gate.shape[:2]), -1) for gate in gates]
+    num_gates = len(gates) if num_gates is None else num_gates
+
+    if not exact:
+        counts = estimate_costs(np.array(gates), num_left_qubits)
+        return num_gates * np.mean(counts, axis=1)
+
+    if num_samples is not None and num_samples < len(gates):
+        gates = [
+            gates[it] for it in np.linspace(0, len(gates) - 1, num_samples, dtype=int)
+        ]
+
     counts = []
-    for sampled_gate in random.sample(gates, 30):
-        sampled_gate = sampled_gate.reshape(np.prod(sampled_gate.shape[:2]), -1)
-        qc = qiskit_decomposition(sampled_gate)
-        counts.append([qc.size(), qc.num_nonlocal_gates()])
-    return len(gates) * np.mean(counts, axis=0)
+    if all(len(gate) == 4 for gate in gates):
+        # two qubit gates are synthesized natively, in one batched call
+        for instructions, _ in decompose_unitaries(gates):
+            num_cx = sum(name == "cx" for name, _, _ in instructions)
+            counts.append([len(instructions), num_cx])
+    else:
+        for gate in gates:
+            qc = qiskit_decomposition(gate)
+            counts.append([qc.size(), qc.num_nonlocal_gates()])
+    return num_gates * np.mean(counts, axis=0)
 
 
 def closest_unitary(A):
@@ -31,89 +69,81 @@ def closest_unitary(A):
     return U
 
 
-def circuit_from_unitary_layers(unitary_layers, L, target_mps=[]):
+def circuit_from_unitary_layers(unitary_layers, L, target_mps=[], max_bond=None):
     circ = qiskit.QuantumCircuit(L)
 
+    gates = []
+
     def apply_unitary_layer(Gs_lst):
         for start_indx, end_indx, Gs, _, _ in Gs_lst:
             for it in range(start_indx, end_indx + 1):
                 u = Gs[it - start_indx].data
                 if it == end_indx:
-                    circ.unitary(u, [it])
+                    gates.append((u, [it]))
 
                 else:
-                    circ.unitary(u, [it + 1, it])
+                    gates.append((u, [it + 1, it]))
 
     for it in reversed(range(len(unitary_layers))):
         apply_unitary_layer(unitary_layers[it])
 
-    circ = qiskit.transpile(circ, basis_gates=["cx", "u3"])
+    # native u3/cx synthesis, replaces circ.unitary + qiskit.transpile
+    append_unitaries(circ, gates)
 
     overlap_from_seq_circ = None
-    if L <= 16 and isinstance(
-        target_mps, qtn.tensor_1d.MatrixProductState
-    ):  # some snaity check
-        circ.save_statevector(label="vec_final")
-        backend = QasmSimulator()
-        backend_options = {"method": "statevector"}
-        job = qiskit.execute(circ, backend, backend_options=backend_options)
-        result = job.result()
-        qiskit_vec = result.data()["vec_final"].data
-
-        orig = (
-            (target_mps ^ all).fuse({"k": (f"k{i}" for i in range(L))}).data
-        ).reshape([2] * L)
-        orig = orig.transpose(list(reversed(range(L)))).flatten()
-        overlap_from_seq_circ = np.abs(np.conj(orig.T) @ qiskit_vec)
-        # print(f'overlap to target mps from constructed circuit = {np.abs(np.conj(orig.T)@qiskit_vec)}, ')
+    is_mps = isinstance(target_mps, qtn.tensor_1d.MatrixProductState)
+    if is_mps and should_validate("circuit"):  # some snaity check
+        overlap_from_seq_circ = circuit_overlap_mps(
+            circ, target_mps, site_ind_id="k{}", max_bond=max_bond
+        )
 
     return circ, overlap_from_seq_circ
 
 
-def find_tensor(u_gen, tag):
-    for gate in u_gen:
-        if tag in gate.tags:
-            return gate
-
-    return "gate not found"
+def gate_tensor_index(u_gen):
+    """maps every gate id to (the first of) its tensors in one pass over the
+    network, instead of scanning it by tag once per gate
+    """
+    index = {}
+    for ten in u_gen:
+        for tag in ten.tags:
+            if tag.startswith("GATE_"):
+                index.setdefault(int(tag[len("GATE_") :]), ten)
+    return index
 
 
-def circuit_from_quimb_unitary(unitary, gid_to_qubit, L, target_mps=[]):
+def circuit_from_quimb_unitary(unitary, gid_to_qubit, L, target_mps=[], max_bond=None):
     circ = qiskit.QuantumCircuit(L)
+    gate_tensors = gate_tensor_index(unitary)
 
     for gid, qubits in gid_to_qubit.items():
-        ten = find_tensor(unitary, "GATE_" + str(gid))
+        ten = gate_tensors[gid]
 
         if len(qubits) == 2:
             if "CZ" in ten.tags:
-                circ.cz(qubits[0], qubits[1])
+                # cz = (1 x h) cx (1 x h), with h = u3(pi/2, 0, pi)
+                circ.append(U3Gate(np.pi / 2, 0.0, np.pi), [qubits[1]])
+                circ.cx(qubits[0], qubits[1])
+                circ.append(U3Gate(np.pi / 2, 0.0, np.pi), [qubits[1]])
             else:
                 circ.cx(qubits[0], qubits[1])
 
-        else:
-            circ.unitary(
-                closest_unitary(np.array(ten.data, dtype=np.complex128)), [qubits[0]]
-            )
+        elif "U3" in ten.tags and hasattr(ten, "params"):
+            # optimized parameters are exported as they are, no re-synthesis
+            params = np.real(ten.params).astype(np.float64)
+            circ.append(U3Gate(*params), [qubits[0]])
 
-    circ = qiskit.transpile(circ, basis_gates=["cx", "u3"])
+        else:
+            u = closest_unitary(np.array(ten.data, dtype=np.complex128))
+            thetas, phis, lams, phases = zyz_decomposition(u[None])
+            circ.append(U3Gate(thetas[0], phis[0], lams[0]), [qubits[0]])
+            circ.global_phase += phases[0]
 
     overlap_from_seq_circ = None
-    ###
-    if L <= 16 and isinstance(
-        target_mps, qtn.tensor_1d.MatrixProductState
-    ):  # some snaity check
-        circ.save_statevector(label="vec_final")
-        backend = QasmSimulator()
-        backend_options = {"method": "statevector"}
-        job = qiskit.execute(circ, backend, backend_options=backend_options)
-        result = job.result()
-        qiskit_vec = result.data()["vec_final"].data
-
-        orig = (
-            (target_mps ^ all).fuse({"b": (f"b{i}" for i in range(L))}).data
-        ).reshape([2] * L)
-        orig = orig.transpose(list(reversed(range(L)))).flatten()
-        overlap_from_seq_circ = np.abs(np.conj(orig.T) @ qiskit_vec)
-        # print(f'overlap to target mps from constructed circuit = {np.abs(np.conj(orig.T)@qiskit_vec)}, ')
+    is_mps = isinstance(target_mps, qtn.tensor_1d.MatrixProductState)
+    if is_mps and should_validate("circuit"):  # some snaity check
+        overlap_from_seq_circ = circuit_overlap_mps(
+            circ, target_mps, site_ind_id="b{}", max_bond=max_bond
+        )
 
     return circ, overlap_from_seq_circ
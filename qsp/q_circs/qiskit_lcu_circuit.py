@@ -1,296 +1,241 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import copy
 import numpy as np
-import scipy as sp
 
-from ncon import ncon
-import qiskit
-from qiskit.providers.aer import QasmSimulator
-
-
-backend = QasmSimulator()
-unitary_backend = qiskit.Aer.get_backend("unitary_simulator")
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
+import qiskit
+import quimb.tensor as qtn
+
+from .mps_simulator import circuit_overlap_mps
+from .mps_simulator import circuit_to_mps
+from .synthesis import decompose_unitaries
+
+from ..tsp_helper_routines import MPSSum
+from ..tsp_helper_routines import get_validation_level
+from ..tsp_helper_routines import should_validate
+
+SELECT_ORACLES = ("mcx", "gray")
+
+# the assembled circuit (ancillas included) is only simulated at the "full"
+# validation level and up to this many qubits
+MAX_CIRCUIT_CHECK_QUBITS = 12
+
+
+def lcu_circuit_from_unitary_layers(
+    circ,
+    kappas,
+    unitary_layers,
+    target_mps=None,
+    max_bond=None,
+    max_workers=None,
+    select="mcx",
+):
+    """appends the lcu circuit sum_i kappas[i] unitary_layers[i] to circ, the
+    first k+1 qubits are the ancillas. the gates of all branches are
+    decomposed in one batched (cached) call, and the controlled branches of
+    the select oracle are synthesized in max_workers processes if given.
+
+    with select="mcx" the flag qubit k is computed and uncomputed by a k
+    controlled mcx around every branch. with select="gray" the branches are
+    visited in gray code order and the flag is moved from one branch to the
+    next by a single mcx with k-1 controls (the ancilla bit that changes is
+    not needed), which roughly halves the number of mcx gates and shrinks all
+    but two of them. both give the same postselected state.
+    """
+    if select not in SELECT_ORACLES:
+        raise ValueError(f"select should be one of {SELECT_ORACLES}, got {select}")
 
-def lcu_circuit_from_unitary_layers(circ, kappas, unitary_layers, target_mps=[]):
     k = int(np.ceil(np.log2(len(kappas))))
 
-    as_circs = copy.deepcopy(unitary_layers)
-    kappas = copy.deepcopy(kappas)
-
-    for u_it, unitary_layer in enumerate(unitary_layers):
-        for mps_num, (start_indx, end_indx, Gs, _, _) in enumerate(unitary_layer[0]):
-            for it in range(start_indx, end_indx + 1):
-                qc, phase = qiskit_decomposition(Gs[it - start_indx].data)
-                kappas[u_it] = kappas[u_it] * (np.conj(phase))
+    # (u, qubits) of every gate of every branch, as in apply_ctrl_unitary_layer
+    branches = [
+        [
+            (Gs[it - start_indx].data, (it,) if it == end_indx else (it + 1, it))
+            for start_indx, end_indx, Gs, _, _ in unitary_layer[0]
+            for it in range(start_indx, end_indx + 1)
+        ]
+        for unitary_layer in unitary_layers
+    ]
+    decompositions = iter(
+        decompose_unitaries([u for branch in branches for u, _ in branch])
+    )
 
-                as_circs[u_it][0][mps_num][2][it - start_indx] = qc
+    kappas = np.array(kappas, dtype=np.complex128)
+    branch_gates = []
+    for u_it, branch in enumerate(branches):
+        gates = []
+        for _, qubits in branch:
+            instructions, global_phase = next(decompositions)
+            # the decomposition misses the phase exp(1j*global_phase)
+            kappas[u_it] = kappas[u_it] * np.exp(1j * global_phase)
+            gates.append((instructions, qubits))
+        branch_gates.append(gates)
+
+    num_qubits = circ.num_qubits
+    args = [(num_qubits, k, gates) for gates in branch_gates]
+    if max_workers is None:
+        branch_circs = [controlled_branch(*arg) for arg in args]
+    else:
+        # forking a process that already runs tensorflow threads can deadlock
+        with ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            branch_circs = list(executor.map(controlled_branch, *zip(*args)))
+
+    # the controlled branches act on orthogonal ancilla states, so they commute
+    # and can be visited in any order
+    if select == "gray":
+        order = [u ^ (u >> 1) for u in range(2**k)]
+        order = [u_it for u_it in order if u_it < len(branch_circs)]
+    else:
+        order = list(range(len(branch_circs)))
 
     prepapre_state(circ, kappas, inverse=False)
-    for u_it in range(2**k):
-        mcx_gate = qiskit.circuit.library.MCXGate(k, ctrl_state=u_it)
+    previous = None
+    for u_it in order:
+        if select == "mcx":
+            flag_toggles = select_toggles(k, previous, None)
+            flag_toggles += select_toggles(k, None, u_it)
+        else:
+            flag_toggles = select_toggles(k, previous, u_it)
 
-        circ.append(mcx_gate, list(range(k + 1)))
-        apply_ctrl_unitary_layer(circ, as_circs[u_it], k)
-        circ.append(mcx_gate, list(range(k + 1)))
+        for controls, ctrl_state in flag_toggles:
+            append_flag_mcx(circ, controls, ctrl_state, k)
+        circ.compose(branch_circs[u_it], inplace=True)
+        previous = u_it
 
+    for controls, ctrl_state in select_toggles(k, previous, None):
+        append_flag_mcx(circ, controls, ctrl_state, k)
     prepapre_state(circ, kappas, inverse=True)
 
-    circ_copy = circ.copy()
     overlap_from_lcu_circ = None
 
-    # some sanity check
-    if target_mps:
-        if target_mps.L <= 16:
-            vec = get_state_vector(circ)
-            L = target_mps.L
-            zero = np.zeros(2 ** (k + 1))
-            zero[0] = 1.0
-            lcu_output = ncon(
-                [vec.reshape(2**L, -1), zero], [(-1, 1), (1,)]
-            ).flatten()
-            targe_vec = (
-                (target_mps ^ all)
-                .transpose(*reversed([f"k{i}" for i in range(L)]))
-                .data.flatten()
+    # some sanity check, the output with the ancillas postselected on |0> is
+    # the kappa weighted sum of the synthesized branches, it is contracted as
+    # an mps sum without simulating the ancillas
+    is_mps = isinstance(target_mps, qtn.tensor_1d.MatrixProductState)
+    if is_mps and should_validate("circuit"):
+        encoded_sum = postselected_lcu_mps(
+            target_mps.L, kappas, branch_gates, max_bond=max_bond
+        )
+        overlap_from_lcu_circ = np.abs(encoded_sum.norm_ovrlap(target_mps))
+
+        # the mps sum does not see the prepare and select oracles, check them
+        # on the assembled circuit for small instances
+        check_circuit = (
+            get_validation_level() == "full"
+            and max_bond is None
+            and circ.num_qubits <= MAX_CIRCUIT_CHECK_QUBITS
+        )
+        if check_circuit:
+            overlap_from_full_circ = circuit_overlap_mps(
+                circ, target_mps, num_ancillas=k + 1
             )
-            overlap_from_lcu_circ = overlap(targe_vec, lcu_output)
-            # print('overlap to target mps from constructed lcu circuit =',
-            #        overlap_from_lcu_circ)
+            assert np.abs(overlap_from_full_circ - overlap_from_lcu_circ) < 1e-6
 
-    return circ_copy, overlap_from_lcu_circ
+    return circ, overlap_from_lcu_circ
 
 
-def apply_ctrl_unitary_layer(circ, unitary_layer, k):
+def controlled_branch(num_qubits, k, gates):
+    """a branch of the select oracle, i.e. its gates controlled on the flag
+    qubit k
+    """
+    branch_circ = qiskit.QuantumCircuit(num_qubits)
+    apply_ctrl_unitary_layer(branch_circ, gates, k)
+    return branch_circ
 
-    for start_indx, end_indx, Gs, _, _ in unitary_layer[0]:
-        for it in range(start_indx, end_indx + 1):
-            u = Gs[it - start_indx].data
-            if it == end_indx:
-                apply_cu(circ, u, k, it)
 
-            else:
-                apply_cu(circ, u, k, it + 1, it)
+def select_toggles(k, previous, current):
+    """returns the (controls, ctrl_state) of the mcx gates moving the flag
+    qubit k from marking the ancilla state previous to marking current (None
+    marks nothing). states differing in one bit j only need the other k-1
+    ancillas as controls, [a == previous] xor [a == current] does not depend
+    on bit j of a.
+    """
+    if previous is None:
+        return [] if current is None else [(list(range(k)), current)]
 
+    if current is None:
+        return [(list(range(k)), previous)]
 
-def prepapre_state(circ, kappas, inverse=False):
-    temp = np.sqrt(kappas)
-    if inverse:
-        temp = np.conj(temp)
+    diff = previous ^ current
+    if diff & (diff - 1):
+        return [(list(range(k)), previous), (list(range(k)), current)]
 
-    temp = temp / np.sqrt(np.conj(temp.T) @ temp)
-    state_prep = qiskit.circuit.library.StatePreparation(temp, inverse=inverse)
-    circ.append(state_prep, list(range(state_prep.num_qubits)))
+    j = diff.bit_length() - 1
+    controls = [q for q in range(k) if q != j]
+    ctrl_state = sum(((previous >> q) & 1) << i for i, q in enumerate(controls))
+    return [(controls, ctrl_state)]
 
 
-def qiskit_decomposition(u):
-    num_qubits = int(np.log2(len(u)))
-    qc = qiskit.QuantumCircuit(num_qubits)
-    qc.unitary(u, range(num_qubits))
-    qc = qiskit.transpile(qc, basis_gates=["cx", "u3"], optimization_level=0)
-
-    # print(np.sum(np.abs(get_unitary(qc) - u)))
-    # if u.shape==(2,2):
-    # return qc, 1
-
-    # determine the phase missing from qiskit decomposition/transpilation
-    # u = phase* (circ made of basis gates i.e. u_prime)
-    def u3(th, phi, lam):
-        th = th / 2
-        u3 = np.array(
-            [
-                [np.cos(th), -np.exp(1j * lam) * np.sin(th)],
-                [np.exp(1j * phi) * np.sin(th), np.exp(1j * (phi + lam)) * np.cos(th)],
-            ]
-        )
-        return u3
+def append_flag_mcx(circ, controls, ctrl_state, k):
+    if not controls:
+        circ.x(k)
+        return
 
-    cz = np.array(
-        [
-            [1.0, 0.0, 0.0, 0.0],
-            [0.0, 1.0, 0.0, 0.0],
-            [0.0, 0.0, 1.0, 0.0],
-            [0.0, 0.0, 0.0, -1.0],
-        ]
-    )
+    mcx_gate = qiskit.circuit.library.MCXGate(len(controls), ctrl_state=ctrl_state)
+    circ.append(mcx_gate, list(controls) + [k])
 
-    cx = np.array(
-        [
-            [1.0, 0.0, 0.0, 0.0],
-            [0.0, 1.0, 0.0, 0.0],
-            [0.0, 0.0, 0.0, 1.0],
-            [0.0, 0.0, 1.0, 0.0],
-        ]
-    )
 
-    num_qubits = qc.num_qubits
+def postselected_lcu_mps(L, kappas, branch_gates, max_bond=None):
+    """returns the postselected output of the lcu circuit as MPSSum of the
+    branches, every branch is simulated (uncontrolled) from its synthesized
+    gates. kappas already include the phases missing from the synthesis.
+    """
+    terms = []
+    for gates in branch_gates:
+        branch_circ = qiskit.QuantumCircuit(L)
+        for instructions, qubits in gates:
+            apply_u(branch_circ, instructions, *qubits)
+        terms.append(circuit_to_mps(branch_circ, max_bond=max_bond))
 
-    u_prime = np.eye(2**num_qubits)
-    u_prime = u_prime.reshape([2] * (num_qubits * 2))
+    return MPSSum(terms, kappas)
 
-    for instruction in qc:
-        if instruction.operation.name == "u3":
-            qubit_indx = instruction.qubits[0].index
-            params = instruction.operation.params
-            th, phi, lam = params
 
-            if isinstance(th, qiskit.circuit.parameterexpression.ParameterExpression):
-                th = th
+def apply_ctrl_unitary_layer(circ, gates, k):
+    """gates is a list of (instructions, qubits) of the decomposed layer"""
+    for instructions, qubits in gates:
+        apply_cu(circ, instructions, k, *qubits)
 
-            qubit_indx = [1, 0][instruction.qubits[0].index]
-            inds = [-i for i in range(1, 2 * num_qubits + 1)]
 
-            inds[qubit_indx] = -inds[qubit_indx]
-            u_prime = ncon(
-                [u_prime, (u3(th, phi, lam))],
-                (list(inds), [-(qubit_indx + 1), qubit_indx + 1]),
-            )
+def prepapre_state(circ, kappas, inverse=False):
+    temp = np.sqrt(kappas)
+    if inverse:
+        temp = np.conj(temp)
+
+    temp = temp / np.sqrt(np.conj(temp.T) @ temp)
+    state_prep = qiskit.circuit.library.StatePreparation(temp, inverse=inverse)
+    circ.append(state_prep, list(range(state_prep.num_qubits)))
 
-        elif instruction.operation.name == "cx":
-            # u_prime = cz@u_prime
-
-            qubit_indx1 = [1, 0][instruction.qubits[0].index]
-            qubit_indx2 = [1, 0][instruction.qubits[1].index]
-
-            inds = [-i for i in range(1, 2 * num_qubits + 1)]
-            inds[qubit_indx1] = -inds[qubit_indx1]
-            inds[qubit_indx2] = -inds[qubit_indx2]
-
-            u_prime = ncon(
-                [u_prime, cx.reshape(2, 2, 2, 2)],
-                [
-                    inds,
-                    [
-                        qubit_indx1 + 1,
-                        qubit_indx2 + 1,
-                        -(qubit_indx1 + 1),
-                        -(qubit_indx2 + 1),
-                    ],
-                ],
-            )
 
-    u_prime = u_prime.reshape(2**num_qubits, 2**num_qubits)
-    phases = []
-    for r1, r2 in zip(u_prime, u):
-        for a, b in zip(r1, r2):
-            if (np.abs(a) > 1e-8) and (np.abs(b) > 1e-8):
-                phases.append(a / b)
+def apply_u(circ, unitary_as_circuit, orig_indx, orig_indx_plus1=[]):
 
-    # assert np.allclose(np.array(phases)-phases[0],
-    #                    np.zeros(len(phases))), ('problem with phase extraction '
-    #                                             'all phases are not same')
+    for name, params, qubits in unitary_as_circuit:
+        if name == "u3":
+            qubit_indx = [orig_indx, orig_indx_plus1][qubits[0]]
+            circ.append(qiskit.circuit.library.U3Gate(*params), [qubit_indx])
 
-    return qc, phases[0]
+        elif name == "cx":
+            qubit1 = [orig_indx, orig_indx_plus1][qubits[0]]
+            qubit2 = [orig_indx, orig_indx_plus1][qubits[1]]
+            circ.cx(qubit1, qubit2)
 
 
 def apply_cu(circ, unitary_as_circuit, k, orig_indx, orig_indx_plus1=[]):
 
-    for instruction in unitary_as_circuit:
-        if instruction.operation.name == "u3":
-            qubit_indx = [orig_indx, orig_indx_plus1][instruction.qubits[0].index]
-            params = instruction.operation.params
+    for name, params, qubits in unitary_as_circuit:
+        if name == "u3":
+            qubit_indx = [orig_indx, orig_indx_plus1][qubits[0]]
             gate = qiskit.circuit.library.CU3Gate(*params)
 
             circ.append(gate, [k, (k + 1) + qubit_indx])
 
-        elif instruction.operation.name == "cx":
-            qubit1 = [orig_indx, orig_indx_plus1][instruction.qubits[0].index]
-            qubit2 = [orig_indx, orig_indx_plus1][instruction.qubits[1].index]
+        elif name == "cx":
+            qubit1 = [orig_indx, orig_indx_plus1][qubits[0]]
+            qubit2 = [orig_indx, orig_indx_plus1][qubits[1]]
             circ.ccx(k, (k + 1) + qubit1, (k + 1) + qubit2)
 
         else:
             exit()
-
-
-def apply_lcu(circ, kappas, unitaries_as_circuits, target_mps=[]):
-    k = int(np.ceil(np.log2(len(kappas))))
-
-    prepapre_state(circ, kappas, inverse=False)
-    for u_it in range(2**k):
-        mcx_gate = qiskit.circuit.library.MCXGate(k, ctrl_state=u_it)
-
-        circ.append(mcx_gate, list(range(k + 1)))
-        apply_cu(circ, unitaries_as_circuits[u_it], k, 0, 1)
-        circ.append(mcx_gate, list(range(k + 1)))
-
-    prepapre_state(circ, kappas, inverse=True)
-
-
-###############################################################################
-
-
-def get_unitary(circ):
-    job = qiskit.execute(circ, unitary_backend, shots=1)
-    result = job.result()
-    return result.get_unitary(circ)
-
-
-def get_state_vector(circ):
-    circ.save_statevector(label="vec_final")
-
-    backend_options = {"method": "statevector"}
-    job = qiskit.execute(circ, backend, backend_options=backend_options)
-    result = job.result()
-    vec = result.data()["vec_final"].data
-
-    return vec.reshape([2] * circ.num_qubits)
-
-
-def normalize(vec):
-    return vec / np.abs(np.sqrt(np.conj(vec).T @ vec))
-
-
-def overlap(vec1, vec2):
-    vec1 = normalize(vec1)
-    vec2 = normalize(vec2)
-    return np.abs(np.conj(vec1).T @ vec2)
-
-
-###############################################################################
-
-if __name__ == "__main__":
-    import warnings
-
-    warnings.filterwarnings("ignore", category=DeprecationWarning)
-
-    # pass
-    k = 2  # number of ancilla qubits
-    L = 2  # number of target qubits
-    num_qubits = L + k + 1
-
-    unitaries = [
-        (
-            sp.linalg.svd(
-                np.random.rand(2**L, 2**L) + np.random.rand(2**L, 2**L) * 1j
-            )
-        )[0]
-        for _ in range(2**k)
-    ]
-
-    kappas = np.random.rand(4) + 1j * np.random.rand(4) * 1  #
-    kappas = np.array(kappas, np.complex128)
-
-    uni = unitaries.copy()
-    kp = kappas.copy()
-
-    unitaries_as_circuits = {}
-    for u_it in range(2**k):
-        qc, phase = qiskit_decomposition(unitaries[u_it])
-        unitaries_as_circuits[u_it] = qc
-        kappas[u_it] = kappas[u_it] * (np.conj(phase))
-
-    circ = qiskit.QuantumCircuit(num_qubits)
-    apply_lcu(circ, kappas, unitaries_as_circuits)
-
-    vec = get_state_vector(circ)
-    zero = np.zeros(2 ** (k + 1))
-    zero[0] = 1
-    lcu_output = ncon([vec.reshape(2**L, -1), zero], [(-1, 1), (1,)]).flatten()
-
-    unitary_sum = np.sum(
-        np.array([kappa * unitary for kappa, unitary in zip(kp, uni)]), axis=0
-    )
-    zero = np.zeros(2**L)
-    zero[0] = 1.0
-    print("final overlap: ", np.abs(overlap(unitary_sum @ zero, lcu_output)))
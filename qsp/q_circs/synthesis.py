@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""native synthesis of one- and two-qubit unitaries into u3 and cx gates, and
+cx counts of unitaries estimated without synthesizing them.
+
+every decomposition is returned as (instructions, global_phase) such that
+u = exp(1j*global_phase) * (product of instructions). instructions are tuples
+(name, params, qubits) with name in ('u3', 'cx') and qubits given in the
+qiskit (little-endian) ordering of u, i.e. exactly as they would appear after
+circ.unitary(u, range(n)) and qiskit.transpile.
+"""
+
+import hashlib
+import itertools
+
+import numpy as np
+import qiskit
+
+ATOL = 1e-9
+# tolerance of the local invariants, which are quadratic in the unitary
+INVARIANT_ATOL = 1e-8
+MAX_CACHE_SIZE = 2**16
+
+pauli_x = np.array([[0.0, 1.0], [1.0, 0.0]], dtype=np.complex128)
+pauli_y = np.array([[0.0, -1.0j], [1.0j, 0.0]], dtype=np.complex128)
+pauli_z = np.array([[1.0, 0.0], [0.0, -1.0]], dtype=np.complex128)
+identity = np.eye(2, dtype=np.complex128)
+
+hadamard = np.array([[1.0, 1.0], [1.0, -1.0]], dtype=np.complex128) / np.sqrt(2)
+s_gate = np.diag([1.0, 1.0j])
+rx_half_pi = (identity - 1j * pauli_x) / np.sqrt(2)
+
+# magic basis, in which local gates are real orthogonal matrices and
+# exp(i(a XX + b YY + c ZZ)) is diagonal
+magic = np.array(
+    [[1, 0, 0, 1j], [0, 1j, 1, 0], [0, 1j, -1, 0], [1, 0, 0, -1j]],
+    dtype=np.complex128,
+) / np.sqrt(2)
+
+paulis_2q = [np.kron(p, p) for p in (pauli_x, pauli_y, pauli_z)]
+magic_diagonals = np.array(
+    [np.ones(4)] + [np.real(np.diag(magic.conj().T @ p @ magic)) for p in paulis_2q]
+).T
+
+_cache = {}
+
+# all orderings of four eigenvalues, to match two spectra
+_permutations_4 = np.array(list(itertools.permutations(range(4))))
+
+
+def clear_synthesis_cache():
+    _cache.clear()
+
+
+def u3_matrix(theta, phi, lam):
+    c, s = np.cos(theta / 2), np.sin(theta / 2)
+    return np.array(
+        [
+            [c, -np.exp(1j * lam) * s],
+            [np.exp(1j * phi) * s, np.exp(1j * (phi + lam)) * c],
+        ]
+    )
+
+
+def is_identity(theta, phi, lam):
+    return (
+        np.abs(np.sin(theta / 2)) < ATOL
+        and np.abs(np.exp(1j * (phi + lam)) - 1.0) < ATOL
+    )
+
+
+def zyz_decomposition(us):
+    """vectorized decomposition of a stack of 2x2 unitaries,
+    us[i] = exp(1j*phases[i]) * u3(thetas[i], phis[i], lams[i])
+    """
+    us = np.asarray(us, dtype=np.complex128).reshape(-1, 2, 2)
+
+    alpha = np.angle(np.linalg.det(us)) / 2
+    su2 = us * np.exp(-1j * alpha)[:, None, None]
+    a, b = su2[:, 0, 0], su2[:, 1, 0]
+
+    thetas = 2 * np.arctan2(np.abs(b), np.abs(a))
+    phis = np.angle(b) - np.angle(a)
+    lams = -np.angle(a) - np.angle(b)
+    phases = alpha - (phis + lams) / 2
+    return thetas, phis, lams, phases
+
+
+def kron_factor(u):
+    """factors a local 4x4 unitary as u = a (x) b"""
+    r = u.reshape(2, 2, 2, 2).transpose(0, 2, 1, 3).reshape(4, 4)
+    left, s, right = np.linalg.svd(r)
+    a = np.sqrt(s[0]) * left[:, 0].reshape(2, 2)
+    b = np.sqrt(s[0]) * right[0, :].reshape(2, 2)
+    return a, b
+
+
+def _diagonalize_symmetric_unitaries(m2s):
+    """finds real orthogonal p with p.T @ m2 @ p diagonal for every complex
+    symmetric unitary m2 in the stack. real and imaginary parts of m2 commute,
+    so a generic real combination of both shares their eigenvectors.
+    """
+    ps = np.zeros(m2s.shape, dtype=np.float64)
+    todo = np.arange(len(m2s))
+    rng = np.random.default_rng(1234)
+    for _ in range(100):
+        if len(todo) == 0:
+            break
+        x = rng.normal()
+        _, p = np.linalg.eigh(m2s[todo].real + x * m2s[todo].imag)
+        d = np.transpose(p, (0, 2, 1)) @ m2s[todo] @ p
+        off_diag = np.abs(d - d * np.eye(4)).max(axis=(1, 2))
+
+        ok = off_diag < ATOL
+        ps[todo[ok]] = p[ok]
+        todo = todo[~ok]
+
+    if len(todo) > 0:
+        raise ValueError("simultaneous diagonalization in kak decomposition failed")
+
+    # make p special orthogonal
+    ps[:, :, 0] *= np.sign(np.linalg.det(ps))[:, None]
+    return ps
+
+
+def _canonical_gate(a, b, c):
+    """exp(i(a XX + b YY + c ZZ)), the three terms commute"""
+    gate = np.eye(4, dtype=np.complex128)
+    for coeff, p in zip((a, b, c), paulis_2q):
+        gate = gate @ (np.cos(coeff) * np.eye(4) + 1j * np.sin(coeff) * p)
+    return gate
+
+
+def _weyl_reduce(coords, left, right, phase):
+    """brings the interaction coefficients (a, b, c) of
+    u = exp(1j*phase) left @ exp(i(a XX + b YY + c ZZ)) @ right
+    into the form pi/4 >= a >= b >= |c| by moving local gates into left and
+    right.
+    """
+    coords = list(coords)
+    paulis = [pauli_x, pauli_y, pauli_z]
+
+    # shift every coefficient into [-pi/4, pi/4] using exp(i pi/2 PP) = i PP
+    for i in range(3):
+        k = int(np.round(coords[i] / (np.pi / 2)))
+        coords[i] -= k * np.pi / 2
+        if k % 2:
+            right = paulis_2q[i] @ right
+        phase += k * np.pi / 2
+
+    # swap two coefficients by conjugating with v (x) v, where v exchanges the
+    # corresponding pauli axes
+    swaps = {(0, 1): s_gate, (0, 2): hadamard, (1, 2): rx_half_pi}
+
+    def swap(i, j, left, right):
+        v = np.kron(swaps[(i, j)], swaps[(i, j)])
+        coords[i], coords[j] = coords[j], coords[i]
+        return left @ v.conj().T, v @ right
+
+    for i, j in [(0, 1), (1, 2), (0, 1)]:
+        if np.abs(coords[i]) < np.abs(coords[j]):
+            left, right = swap(i, j, left, right)
+
+    # flip the sign of two coefficients by conjugating with the local pauli
+    # that anticommutes with both
+    def flip(i, j, left, right):
+        p = np.kron(paulis[3 - i - j], identity)
+        coords[i], coords[j] = -coords[i], -coords[j]
+        return left @ p, p @ right
+
+    if coords[0] < 0:
+        left, right = flip(0, 2 if coords[1] >= 0 else 1, left, right)
+    if coords[1] < 0:
+        left, right = flip(1, 2, left, right)
+
+    return coords, left, right, phase
+
+
+def _two_qubit_template(a, b, c):
+    """returns (phase, left, layers, right) with
+    exp(i(a XX + b YY + c ZZ)) = exp(1j*phase) left @ (layers) @ right.
+    layers are ('local', 4x4) or ('cx', control, target) with qubit 0 being
+    the first (most significant) tensor factor, applied from left to right.
+    """
+    rz = lambda t: np.diag([np.exp(-0.5j * t), np.exp(0.5j * t)])
+    ry = lambda t: np.array(
+        [[np.cos(t / 2), -np.sin(t / 2)], [np.sin(t / 2), np.cos(t / 2)]]
+    )
+    rx = lambda t: np.cos(t / 2) * identity - 1j * np.sin(t / 2) * pauli_x
+    eye4 = np.eye(4)
+
+    if np.abs(a) < ATOL and np.abs(b) < ATOL and np.abs(c) < ATOL:
+        return 0.0, eye4, [], eye4
+
+    if np.abs(a - np.pi / 4) < ATOL and np.abs(b) < ATOL and np.abs(c) < ATOL:
+        # exp(i pi/4 ZZ) = exp(i pi/4) (S^dg (x) S^dg) cz, with cz = (1 (x) H) cx (1 (x) H),
+        # and exp(i pi/4 XX) = (H (x) H) exp(i pi/4 ZZ) (H (x) H)
+        h2 = np.kron(hadamard, hadamard)
+        left = (
+            h2 @ np.kron(s_gate.conj().T, s_gate.conj().T) @ np.kron(identity, hadamard)
+        )
+        right = np.kron(identity, hadamard) @ h2
+        return np.pi / 4, left, [("cx", 0, 1)], right
+
+    if np.abs(c) < ATOL:
+        # exp(i(a XX + b YY)): swap b into the ZZ slot, then
+        # exp(i(a XX + b ZZ)) = cx (rx(-2a) (x) rz(-2b)) cx
+        v = np.kron(rx_half_pi, rx_half_pi)
+        layers = [
+            ("cx", 0, 1),
+            ("local", np.kron(rx(-2 * a), rz(-2 * b))),
+            ("cx", 0, 1),
+        ]
+        return 0.0, v.conj().T, layers, v
+
+    layers = [
+        ("local", np.kron(rz(-np.pi / 2), identity)),
+        ("cx", 1, 0),
+        ("local", np.kron(identity, ry(2 * b - np.pi / 2))),
+        ("cx", 0, 1),
+        ("local", np.kron(rz(np.pi / 2 - 2 * c), ry(np.pi / 2 - 2 * a))),
+        ("cx", 1, 0),
+        ("local", np.kron(identity, rz(np.pi / 2))),
+    ]
+    circuit = eye4
+    for layer in layers:
+        if layer[0] == "local":
+            op = layer[1]
+        else:
+            op = _cx_matrix(*layer[1:])
+        circuit = circuit @ op
+    target = _canonical_gate(a, b, c)
+    indx = np.argmax(np.abs(circuit))
+    phase = np.angle(target.flat[indx] / circuit.flat[indx])
+    return phase, eye4, layers, eye4
+
+
+def _cx_matrix(control, target):
+    p0, p1 = np.diag([1.0, 0.0]), np.diag([0.0, 1.0])
+    ops = [[p0, identity], [p1, pauli_x]]
+    if control == 0:
+        return np.kron(ops[0][0], ops[0][1]) + np.kron(ops[1][0], ops[1][1])
+    return np.kron(ops[0][1], ops[0][0]) + np.kron(ops[1][1], ops[1][0])
+
+
+def _local_to_instructions(local, instructions):
+    """appends a local 4x4 gate as u3 gates, returns the dropped phase"""
+    phase = 0.0
+    a, b = kron_factor(local)
+    # qubit 0 of the template is the most significant, i.e. qiskit qubit 1
+    for qubit, op in [(1, a), (0, b)]:
+        theta, phi, lam, p = [x[0] for x in zyz_decomposition(op)]
+        phase += p
+        if not is_identity(theta, phi, lam):
+            instructions.append(("u3", (theta, phi, lam), (qubit,)))
+    return phase
+
+
+def decompose_two_qubit_unitaries(us):
+    """vectorized kak decomposition of a stack of 4x4 unitaries into at most
+    three cx gates and u3 gates, using the fewest cx gates possible.
+    """
+    us = np.asarray(us, dtype=np.complex128).reshape(-1, 4, 4)
+
+    phases = np.angle(np.linalg.det(us)) / 4
+    su4 = us * np.exp(-1j * phases)[:, None, None]
+
+    u_magic = magic.conj().T @ su4 @ magic
+    m2s = np.transpose(u_magic, (0, 2, 1)) @ u_magic
+    ps = _diagonalize_symmetric_unitaries(m2s)
+
+    d2 = np.diagonal(np.transpose(ps, (0, 2, 1)) @ m2s @ ps, axis1=1, axis2=2)
+    ds = np.sqrt(d2)
+    ds[:, 0] *= np.where(np.real(np.prod(ds, axis=1)) < 0, -1, 1)
+
+    k1s = u_magic @ ps / ds[:, None, :]
+    lefts = magic @ k1s @ magic.conj().T
+    rights = magic @ np.transpose(ps, (0, 2, 1)) @ magic.conj().T
+
+    # angles of ds are phase + a x + b y + c z in the magic basis
+    coeffs = np.linalg.solve(magic_diagonals, np.angle(ds).T).T
+
+    decompositions = []
+    for phase, coeff, left, right in zip(phases, coeffs, lefts, rights):
+        (a, b, c), left, right, phase = _weyl_reduce(
+            coeff[1:], left, right, phase + coeff[0]
+        )
+        template_phase, t_left, layers, t_right = _two_qubit_template(a, b, c)
+        phase += template_phase
+
+        instructions = []
+        layers = [("local", left @ t_left)] + layers + [("local", t_right @ right)]
+
+        # merge neighbouring local layers, then emit in circuit (time) order
+        merged = []
+        for layer in layers:
+            if layer[0] == "local" and merged and merged[-1][0] == "local":
+                merged[-1] = ("local", merged[-1][1] @ layer[1])
+            else:
+                merged.append(layer)
+
+        for layer in reversed(merged):
+            if layer[0] == "local":
+                phase += _local_to_instructions(layer[1], instructions)
+            else:
+                # qiskit qubit index = 1 - template qubit index
+                instructions.append(("cx", (), (1 - layer[1], 1 - layer[2])))
+
+        decompositions.append((instructions, phase))
+
+    return decompositions
+
+
+def two_qubit_cx_counts(us, atol=INVARIANT_ATOL):
+    """minimal number of cx gates of every 4x4 unitary in the stack, read off
+    the spectrum of gamma(u) = u (Y x Y) u.T (Y x Y) with u in SU(4) (shende,
+    markov and bullock, Phys. Rev. A 69, 062321 (2004)): 0 if gamma = +-1, 1
+    if its eigenvalues are +-i (twice each), 2 if they are closed under
+    complex conjugation (tr(gamma) real) and 3 otherwise. the eigenvalues are
+    compared instead of the traces, which are only cubic in the interaction
+    coefficients of gates close to the identity. this is the number of cx
+    gates decompose_two_qubit_unitaries uses, without decomposing.
+    """
+    us = np.asarray(us, dtype=np.complex128).reshape(-1, 4, 4)
+    su4 = us * np.exp(-1j * np.angle(np.linalg.det(us)) / 4)[:, None, None]
+
+    yy = np.kron(pauli_y, pauli_y)
+    gammas = su4 @ yy @ np.transpose(su4, (0, 2, 1)) @ yy
+    eigs = np.linalg.eigvals(gammas)
+
+    # distance of the spectrum to its complex conjugate, over all matchings
+    distances = np.abs(eigs[:, :, None] - np.conj(eigs[:, None, :]))
+    conjugate_closed = (
+        distances[:, np.arange(4), _permutations_4].max(axis=2).min(axis=1) < atol
+    )
+    signs = np.sign(eigs[:, :1].real)
+
+    counts = np.full(len(us), 3)
+    counts[conjugate_closed] = 2
+    counts[
+        (np.abs(eigs.real).max(axis=1) < atol) & (np.abs(eigs.imag.sum(axis=1)) < atol)
+    ] = 1
+    counts[np.abs(eigs - signs).max(axis=1) < atol] = 0
+    return counts
+
+
+def qsd_cx_count(num_qubits):
+    """cx gates of the quantum shannon decomposition of a generic unitary on
+    num_qubits qubits (shende, bullock and markov, IEEE Trans. Comput.-Aided
+    Des. 25, 1000 (2006)), an upper bound for any unitary
+    """
+    if num_qubits <= 1:
+        return 0
+    return int(round(23 / 48 * 4**num_qubits - 3 / 2 * 2**num_qubits + 4 / 3))
+
+
+def operator_schmidt_ranks(us, num_left_qubits, atol=INVARIANT_ATOL):
+    """operator schmidt rank of every unitary in the stack across the cut
+    between its first num_left_qubits (most significant) qubits and the rest
+    """
+    us = np.asarray(us, dtype=np.complex128)
+    dim = us.shape[-1]
+    dl = 2**num_left_qubits
+    dr = dim // dl
+
+    r = us.reshape(-1, dl, dr, dl, dr).transpose(0, 1, 3, 2, 4)
+    s = np.linalg.svd(r.reshape(-1, dl**2, dr**2), compute_uv=False)
+    return np.sum(s > atol * s[:, :1], axis=1)
+
+
+def cx_count_bounds(us, num_left_qubits=None):
+    """returns (lower, upper), bounds on the number of cx gates of every
+    2**n x 2**n unitary in the stack. they are exact for two qubits (see
+    two_qubit_cx_counts). for more qubits, every cx across the cut between
+    the first num_left_qubits qubits and the rest at most doubles the
+    operator schmidt rank, which bounds it from below, and the quantum
+    shannon decomposition of both sides (a product across the cut) or of the
+    whole unitary bounds it from above.
+    """
+    us = np.asarray(us, dtype=np.complex128)
+    us = us.reshape(-1, us.shape[-1], us.shape[-1])
+    num_qubits = int(round(np.log2(us.shape[-1])))
+
+    if num_qubits == 1:
+        zeros = np.zeros(len(us), dtype=int)
+        return zeros, zeros
+
+    if num_qubits == 2:
+        counts = two_qubit_cx_counts(us)
+        return counts, counts
+
+    if num_left_qubits is None:
+        num_left_qubits = num_qubits // 2
+    ranks = operator_schmidt_ranks(us, num_left_qubits)
+
+    lower = np.ceil(np.log2(ranks)).astype(int)
+    product = qsd_cx_count(num_left_qubits) + qsd_cx_count(num_qubits - num_left_qubits)
+    upper = np.where(ranks == 1, product, qsd_cx_count(num_qubits))
+    return lower, upper
+
+
+def estimate_costs(us, num_left_qubits=None):
+    """returns (max_num_gates, num_cx) of every unitary in the stack without
+    synthesizing it. num_cx is the upper bound of cx_count_bounds (exact for
+    two qubits). max_num_gates = 3*num_cx + n is an upper bound of the total
+    number of gates: between and around the cx gates every qubit needs at
+    most one u3 gate, but the synthesis drops the trivial ones (qiskit's
+    transpile merges and drops more), so the actual count is usually
+    smaller.
+    """
+    us = np.asarray(us, dtype=np.complex128)
+    us = us.reshape(-1, us.shape[-1], us.shape[-1])
+    num_qubits = int(round(np.log2(us.shape[-1])))
+
+    _, num_cx = cx_count_bounds(us, num_left_qubits)
+    return 3 * num_cx + num_qubits, num_cx
+
+
+def decompose_single_qubit_unitaries(us):
+    thetas, phis, lams, phases = zyz_decomposition(us)
+    return [
+        ([("u3", (theta, phi, lam), (0,))], phase)
+        for theta, phi, lam, phase in zip(thetas, phis, lams, phases)
+    ]
+
+
+def _content_hash(u):
+    u = np.ascontiguousarray(u, dtype=np.complex128)
+    return hashlib.sha1(u.tobytes() + str(u.shape).encode()).hexdigest()
+
+
+def decompose_unitaries(us):
+    """decomposes a list of one- and two-qubit unitaries into u3 and cx gates.
+    decompositions are cached by the content of the unitary, and all unitaries
+    missing from the cache are decomposed in one vectorized call per size.
+    """
+    keys = [_content_hash(u) for u in us]
+
+    missing = {}
+    for key, u in zip(keys, us):
+        if key not in _cache:
+            missing.setdefault(len(u), {})[key] = u
+
+    for dim, todo in missing.items():
+        if dim == 2:
+            decompositions = decompose_single_qubit_unitaries(list(todo.values()))
+        elif dim == 4:
+            decompositions = decompose_two_qubit_unitaries(list(todo.values()))
+        else:
+            raise ValueError(f"native synthesis of {dim}x{dim} unitaries not supported")
+
+        for key, decomposition in zip(todo.keys(), decompositions):
+            if len(_cache) >= MAX_CACHE_SIZE:
+                _cache.pop(next(iter(_cache)))
+            _cache[key] = decomposition
+
+    return [_cache[key] for key in keys]
+
+
+def decompose_unitary(u):
+    return decompose_unitaries([u])[0]
+
+
+def append_unitaries(circ, gates):
+    """appends gates, a list of (u, qubits) pairs with the same meaning as in
+    circ.unitary(u, qubits), to circ using only u3 and cx gates. consecutive
+    single qubit gates acting on the same qubit are merged into one u3 gate,
+    and the global phase of circ is updated so that it implements the exact
+    product of the unitaries.
+    """
+    decompositions = decompose_unitaries([u for u, _ in gates])
+
+    phase = 0.0
+    pending = {}
+
+    def flush(qubit):
+        nonlocal phase
+        if qubit not in pending:
+            return
+        theta, phi, lam, p = [x[0] for x in zyz_decomposition(pending.pop(qubit))]
+        phase += p
+        if not is_identity(theta, phi, lam):
+            circ.append(qiskit.circuit.library.U3Gate(theta, phi, lam), [qubit])
+
+    for (_, qubits), (instructions, global_phase) in zip(gates, decompositions):
+        phase += global_phase
+        for name, params, local_qubits in instructions:
+            if name == "u3":
+                qubit = qubits[local_qubits[0]]
+                pending[qubit] = u3_matrix(*params) @ pending.get(qubit, identity)
+
+            elif name == "cx":
+                control, target = [qubits[q] for q in local_qubits]
+                flush(control)
+                flush(target)
+                circ.cx(control, target)
+
+    for qubit in list(pending.keys()):
+        flush(qubit)
+
+    circ.global_phase += phase
+    return circ
@@ -3,10 +3,10 @@
 import numpy as np
 
 
-import qiskit
 import quimb.tensor as qtn
 
 from ..q_circs import circuit_from_quimb_unitary
+from ..q_circs import decompose_unitary
 
 from ..tsp_helper_routines import cl_zero_mps
 from ..tsp_helper_routines import norm_mps_ovrlap
@@ -21,21 +21,19 @@ def apply_quimb_unitary(u, quimb_circ, it, it_plus_1, gid_to_qubit):
     params_count = 0
     n_qubits = int(np.log2(u.shape[0]))
 
-    circ = qiskit.QuantumCircuit(n_qubits)
-    circ.unitary(u, list(range(n_qubits)))
-
     if n_qubits == 1:
         # single qubit unitary, to take care of the reverse ordering in the single-case
         it_plus_1 = it
 
-    trans_qc = qiskit.transpile(circ, basis_gates=["cx", "u3"])
+    # same qubit order as circ.unitary(u, [it_plus_1, it]) in qiskit
+    qubits = (it_plus_1, it)
+    instructions, _ = decompose_unitary(u)
 
     count = len(gid_to_qubit.keys())
 
-    for instruction in trans_qc:
-        if instruction.operation.name == "u3":
-            qubit_id = (it_plus_1, it)[instruction.qubits[0].index]
-            params = instruction.operation.params
+    for name, params, local_qubits in instructions:
+        if name == "u3":
+            qubit_id = qubits[local_qubits[0]]
             quimb_circ.apply_gate(
                 "U3", params[0], params[1], params[2], qubit_id, parametrize=True
             )
@@ -43,9 +41,10 @@ def apply_quimb_unitary(u, quimb_circ, it, it_plus_1, gid_to_qubit):
             gid_to_qubit[count] = (qubit_id,)
             params_count = params_count + 3
 
-        elif instruction.operation.name == "cx":
-            quimb_circ.apply_gate("CX", it_plus_1, it)
-            gid_to_qubit[count] = (it_plus_1, it)
+        elif name == "cx":
+            control, target = [qubits[q] for q in local_qubits]
+            quimb_circ.apply_gate("CX", control, target)
+            gid_to_qubit[count] = (control, target)
 
         else:
             print("unhandled gate")
@@ -12,9 +12,11 @@ import quimb.tensor as qtn
 
 from .adiabatic import adiabatic_state_preparation_1d
 from .adiabatic import adiabatic_state_preparation_2d
+from .adiabatic import make_schedule
 
 from .lcu import lcu_qgopt
 from .lcu import lcu_manopt
+from .lcu import lcu_multistart
 from .lcu import lcu_unitary_circuit
 
 from .misc_states import make_bell_pair_mps
@@ -24,13 +26,17 @@ from .q_circs import approximate_adiabatic_cost
 from .q_circs import lcu_circuit_from_unitary_layers
 
 from .sequential import apply_unitary_layers_on_wfn
+from .sequential import generate_bond_d_unitary
 from .sequential import quantum_circuit_tensor_network_ansatz
 from .sequential import sequential_unitary_circuit_optimization
 from .sequential import sequential_unitary_circuit
 
+from .tsp_helper_routines import MPSSum
 from .tsp_helper_routines import blockup_mps
 from .tsp_helper_routines import cl_zero_mps
 from .tsp_helper_routines import norm_mps_ovrlap
+from .tsp_helper_routines import should_validate
+from .tsp_helper_routines import with_validation_level
 
 
 class MPSPreparation:
@@ -48,6 +54,11 @@ class MPSPreparation:
         string of three letters (l, r, p) specifying the ordering of the
         indices in the MPS, where l = left, r = right, and p = physical
 
+    validation : str, optional
+        level of the internal sanity checks ("off", "sampled" or "full") used
+        by the methods of this instance. None (default) uses the global level
+        set by qsp.tsp_helper_routines.set_validation_level.
+
 
     Example usage
     --------
@@ -60,7 +71,7 @@ class MPSPreparation:
 
     """
 
-    def __init__(self, tensor_array, shape="lrp"):
+    def __init__(self, tensor_array, shape="lrp", validation=None):
         if isinstance(tensor_array, qtn.MatrixProductState):
             target_mps = tensor_array
 
@@ -75,7 +86,9 @@ class MPSPreparation:
         self.target_mps = target_mps
         self.shape = target_mps.shape
         self.L = target_mps.L
+        self.validation = validation
 
+    @with_validation_level
     def sequential_unitary_circuit(
         self, num_seq_layers, do_compression=False, max_bond_dim=None, verbose=False
     ):
@@ -126,13 +139,16 @@ class MPSPreparation:
         self.seq_data = data
         unitaries, circ = data["unitaries"], data["circ"]
 
+        overlap = data["overlaps"][-1]
+
         # sanity check
-        encoded_mps = apply_unitary_layers_on_wfn(unitaries, cl_zero_mps(self.L))
-        encoded_mps.right_canonize(normalize=True)
-        overlap = norm_mps_ovrlap(encoded_mps, self.target_mps)
-        assert (
-            np.abs(overlap - data["overlaps"][-1]) < 1e-12
-        ), "overlap from seqential unitary construction does not match!"
+        if should_validate("mps_preparation"):
+            encoded_mps = apply_unitary_layers_on_wfn(unitaries, cl_zero_mps(self.L))
+            encoded_mps.right_canonize(normalize=True)
+            overlap = norm_mps_ovrlap(encoded_mps, self.target_mps)
+            assert (
+                np.abs(overlap - data["overlaps"][-1]) < 1e-12
+            ), "overlap from seqential unitary construction does not match!"
 
         overlap_from_seq_circ = data["overlap_from_seq_circ"]
         temp_str = (
@@ -148,6 +164,7 @@ class MPSPreparation:
 
         return overlap, circ
 
+    @with_validation_level
     def sequential_unitary_circuit_optimization(
         self,
         num_var_seq_layers,
@@ -228,6 +245,7 @@ class MPSPreparation:
         )
         return overlap, circ
 
+    @with_validation_level
     def quantum_circuit_tensor_network_ansatz(
         self, qctn_depth, max_iterations=400, num_hops=1
     ):
@@ -284,7 +302,8 @@ class MPSPreparation:
         return overlap, circ
     
 
-    def lcu_unitary_circuit(self, num_lcu_layers, verbose=False):
+    @with_validation_level
+    def lcu_unitary_circuit(self, num_lcu_layers, verbose=False, select="mcx"):
         """The MPS is approximated by linear combination of unitaries.
         Each of the unitary in the linear combination describes an MPS of bond
         dimension 2. The approximation algorithm is described in
@@ -295,6 +314,11 @@ class MPSPreparation:
         num_lcu_layers: int
             number of unitaries in the linear combinations
 
+        select: str, optional
+            construction of the select oracle, "mcx" or "gray" (see
+            lcu_circuit_from_unitary_layers). "gray" needs fewer and smaller
+            multi-controlled gates.
+
         Returns
         -------
         dict
@@ -323,19 +347,15 @@ class MPSPreparation:
             apply_unitary_layers_on_wfn(curr_us, zero_wfn) for curr_us in unitaries
         ]
 
-        encoded_mps = cl_zero_mps(self.L) * 0
-        for kappa, curr_mps in zip(kappas, lcu_mps):
-            encoded_mps = encoded_mps + kappa * curr_mps
-
-        encoded_mps.right_canonize(normalize=True)
-        overlap = norm_mps_ovrlap(encoded_mps, self.target_mps)
+        encoded_mps = MPSSum(lcu_mps, kappas)
+        overlap = encoded_mps.norm_ovrlap(self.target_mps)
         # assert np.abs(overlap-data['overlaps'][-1]) < 1e-14, f"overlap from lcu unitary does not match! {overlap}!={data['overlaps'][-1]}"
 
         k = int(np.ceil(np.log2(len(kappas))))
         L = self.L
         circ = qiskit.QuantumCircuit(L + k + 1)
         circ, overlap_from_lcu_circ = lcu_circuit_from_unitary_layers(
-            circ, kappas, unitaries, self.target_mps
+            circ, kappas, unitaries, self.target_mps, select=select
         )
         circ = qiskit.transpile(circ, basis_gates=["cx", "u3"])
         self.lcu_data["circ"] = circ
@@ -351,8 +371,16 @@ class MPSPreparation:
         )
         return overlap, circ
 
+    @with_validation_level
     def lcu_unitary_circuit_optimization(
-        self, num_var_lcu_layers, max_iterations=500, verbose=False
+        self,
+        num_var_lcu_layers,
+        max_iterations=500,
+        verbose=False,
+        checkpoint_file=None,
+        num_starts=1,
+        max_workers=None,
+        select="mcx",
     ):
         """First the MPS is approximated as a linear combination of unitaries
         by using the algorithm described in https://arxiv.org/abs/2209.07106.
@@ -367,6 +395,28 @@ class MPSPreparation:
         max_iterations: int, optional
             maximum number of optimization steps.
 
+        checkpoint_file: str, optional
+            if given, the state of the variational optimization is periodically
+            saved to this file. calling the method again with the same file
+            resumes the optimization from the last saved state.
+
+        num_starts: int, optional
+            if larger than one, the optimization is started from the greedy
+            solution and num_starts-1 perturbations of it in parallel worker
+            processes, and the best result is kept (see lcu_multistart).
+            starts falling behind are pruned early. checkpoint_file is not
+            used in this case. the workers import the main module again, so
+            a script using this has to guard its code by
+            if __name__ == "__main__".
+
+        max_workers: int, optional
+            number of worker processes for num_starts > 1, defaults to the
+            number of cores.
+
+        select: str, optional
+            construction of the select oracle, "mcx" or "gray" (see
+            lcu_circuit_from_unitary_layers).
+
         Returns
         -------
         dict
@@ -393,23 +443,9 @@ class MPSPreparation:
         kappas = self.var_lcu_static_data["kappas"]
         unitaries = self.var_lcu_static_data["unitaries"]
 
-        k = int(np.ceil(np.log2(len(kappas))))
-        L = self.L
-        circ = qiskit.QuantumCircuit(L + k + 1)
-        circ, overlap_from_lcu_circ = lcu_circuit_from_unitary_layers(
-            circ, kappas, unitaries, self.target_mps
-        )
-        circ = qiskit.transpile(circ, basis_gates=["cx", "u3"])
-
-        temp_str = (
-            ""
-            if overlap_from_lcu_circ is None
-            else f" (from circ {np.abs(overlap_from_lcu_circ):0.8f})"
-        )
         print(
             "overlap before lcu optimization = "
-            f'{np.abs(self.var_lcu_static_data["overlaps"][-1]):.10f} {temp_str}, '
-            f"n_gates={circ.size()}, n_2qg={circ.num_nonlocal_gates()}"
+            f'{np.abs(self.var_lcu_static_data["overlaps"][-1]):.10f}'
         )
 
         lcu_mps = [
@@ -418,7 +454,27 @@ class MPSPreparation:
         ]
 
         method_name = ""
-        if all([D == 2 for mps in lcu_mps for D in mps.bond_sizes()]):
+        if num_starts > 1:
+            method_name = (
+                "manopt"
+                if all([D == 2 for mps in lcu_mps for D in mps.bond_sizes()])
+                else "qgopt"
+            )
+            self.var_lcu_data = lcu_multistart(
+                self.target_mps,
+                kappas,
+                lcu_mps,
+                max_iterations=max_iterations,
+                method=method_name,
+                num_starts=num_starts,
+                max_workers=max_workers,
+                verbose=verbose,
+            )
+            lcu_mps_opt = self.var_lcu_data["lcu_mps_opt"]
+            kappas = self.var_lcu_data["kappas"]
+            method_name = f"{method_name} (best of {num_starts} starts)"
+
+        elif all([D == 2 for mps in lcu_mps for D in mps.bond_sizes()]):
             method_name = "manopt"
             self.var_lcu_data = lcu_manopt(
                 self.target_mps,
@@ -426,10 +482,11 @@ class MPSPreparation:
                 lcu_mps,
                 max_iterations=max_iterations,
                 verbose=verbose,
+                checkpoint_file=checkpoint_file,
             )
 
             lcu_mps_opt = self.var_lcu_data["lcu_mps_opt"]
-            kappas = self.var_lcu_static_data["kappas"]
+            kappas = self.var_lcu_data["kappas"]
 
         else:
             method_name = "qgopt"
@@ -439,33 +496,64 @@ class MPSPreparation:
                 lcu_mps,
                 max_iterations=max_iterations,
                 verbose=verbose,
+                checkpoint_file=checkpoint_file,
             )
             lcu_mps_opt = self.var_lcu_data["lcu_mps_opt"]
-            kappas = self.var_lcu_static_data["kappas"]
+            kappas = self.var_lcu_data["kappas"]
 
         self.var_lcu_data["method_name"] = method_name
 
-        encoded_mps = cl_zero_mps(self.L) * 0
-        for kappa, curr_mps in zip(kappas, lcu_mps_opt):
-            encoded_mps = encoded_mps + kappa * curr_mps
-        encoded_mps.right_canonize(normalize=True)
-        overlap = norm_mps_ovrlap(encoded_mps, self.target_mps)
+        encoded_mps = MPSSum(lcu_mps_opt, kappas)
+        overlap = encoded_mps.norm_ovrlap(self.target_mps)
+
+        # the circuit is built once, from the unitaries encoding the optimized
+        # bond-2 terms
+        unitaries = []
+        for mps in lcu_mps_opt:
+            mps = mps.copy()
+            mps.permute_arrays(shape="lpr")
+            mps.right_canonize(normalize=True)
+            unitaries.append([generate_bond_d_unitary(mps)])
 
         k = int(np.ceil(np.log2(len(kappas))))
         L = self.L
         circ = qiskit.QuantumCircuit(L + k + 1)
         circ, overlap_from_lcu_circ = lcu_circuit_from_unitary_layers(
-            circ, kappas, unitaries, self.target_mps
+            circ, kappas, unitaries, self.target_mps, select=select
         )
         circ = qiskit.transpile(circ, basis_gates=["cx", "u3"])
+        self.var_lcu_data["unitaries"] = unitaries
         self.var_lcu_data["circ"] = circ
         self.var_lcu_data["overlap"] = overlap
 
-        print("overllap after lcu optimization "
-              f"({method_name}) = {np.abs(overlap):.8f}\n")
+        temp_str = (
+            ""
+            if overlap_from_lcu_circ is None
+            else f" (from circ {overlap_from_lcu_circ:0.8f})"
+        )
+        print(
+            f"overllap after lcu optimization ({method_name}) = "
+            f"{np.abs(overlap):.8f}{temp_str}, "
+            f"n_gates={circ.size()}, n_2qg={circ.num_nonlocal_gates()}\n"
+        )
         return overlap, circ
 
-    def adiabatic_state_preparation(self, runtime, tau, max_bond_dim, verbose=False):
+    @with_validation_level
+    def adiabatic_state_preparation(
+        self,
+        runtime,
+        tau,
+        max_bond_dim,
+        verbose=False,
+        checkpoint_file=None,
+        integrator="mpo",
+        schedule="sin_sin",
+        adaptive_tol=None,
+        formula="second",
+        gate_sink="memory",
+        exact_cost=False,
+        measure_every=1,
+    ):
         """performs adiabatic preparation of the mps using the algorithm
         described in https://arxiv.org/abs/2209.01230
 
@@ -480,12 +568,64 @@ class MPSPreparation:
         max_bond_dim: int
             max. bond dimension of the mps during adiabatic evolution
 
+        checkpoint_file: str, optional
+            if given, the evolved mps and its history are periodically saved
+            to this file. calling the method again with the same file resumes
+            the evolution from the last saved time step.
+
+        integrator: str, optional
+            "mpo" applies the trotter gates of every step as two mpos and
+            compresses the mps, "tebd" applies them as batched two-site
+            updates truncated to max_bond_dim, which is several times
+            faster.
+
+        schedule: str or callable, optional
+            interpolation schedule s(t), one of "sin_sin", "sin", "linear",
+            "gap" (slows down where the gap of the parent hamiltonian,
+            estimated from the transfer matrix of the middle tensors, is
+            small, see gap_adapted_schedule) or a function of t.
+
+        adaptive_tol: float, optional
+            if given, the step size is adapted such that the fidelity with
+            the instantaneous ground state drops by at most adaptive_tol per
+            step, tau is the initial step size.
+
+        formula: str, optional
+            product formula of a trotter step, "second" (the parent
+            hamiltonian frozen at the beginning of the step), "midpoint2"
+            (evaluated at the midpoint), the fourth order "suzuki4" and
+            "yoshida4" or, with integrator="tebd", the optimized splittings
+            "omelyan2" and "omelyan4". the fourth order formulas need more
+            gates per step but allow much larger tau at equal fidelity.
+
+        gate_sink: str or GateSink, optional
+            where the gates of the evolution go, see gate_sinks. "memory"
+            (the default) keeps all of them as {t: gates}, "summary" keeps
+            only their number, their estimated cost and a random sample (for
+            long runs), "discard" drops them and a .npy or .qasm path streams
+            them to that file. the cost is only estimated for "summary" and
+            "memory".
+
+        exact_cost: bool, optional
+            if True, the cost is counted on synthesized gates (the sample of
+            "summary" or all gates of "memory") instead of estimated from
+            their local invariants, see approximate_adiabatic_cost. the
+            estimated total number of gates is an upper bound.
+
+        measure_every: int, optional
+            the fidelities and the energy are measured every measure_every
+            steps (and at the last one). the other steps are left out of the
+            {t: value} dicts of adiabatic_data and are nan in
+            adiabatic_data["history"].
+
         Returns
         -------
-        dict
-            contains fidelity of the adiabatically prepared state with respect
-            to the target mps and approximate gate cost of the adiabatic
-            algorithm.
+        tuple
+            fidelity of the adiabatically prepared state with respect to the
+            target mps and approximate number of two-qubit gates of the
+            adiabatic algorithm (None for the sinks without cost). the
+            histories and data["gates"], what gate_sink returns ({t: gates}
+            for "memory"), are kept in self.adiabatic_data.
         """
 
         print(
@@ -507,18 +647,21 @@ class MPSPreparation:
         else:
             blocked_mps = self.target_mps
 
-        s_func = (
-            lambda t: np.sin((np.pi / 2) * np.sin((np.pi / 2) * t / runtime) ** 2) ** 2
-        )
-        # s_func = lambda t: np.sin( (np.pi/2)*t/runtime)**2
-        # s_func = lambda t: t/runtime
-
         # # ####################################
         initial_tens = make_bell_pair_mps(
             L=blocked_mps.L, phys_dim=blocked_mps.phys_dim()
         )
         initial_mps = qtn.MatrixProductState(initial_tens, shape="lrp")
 
+        blocked_mps.permute_arrays(shape="lrp")
+        mid = blocked_mps.L // 2
+        s_func = make_schedule(
+            schedule,
+            runtime,
+            initial_tensor=initial_tens[mid],
+            target_tensor=blocked_mps[mid].data,
+        )
+
         data = adiabatic_state_preparation_1d(
             blocked_mps,
             initial_mps,
@@ -527,12 +670,27 @@ class MPSPreparation:
             s_func,
             max_bond_dim,
             verbose=verbose,
+            checkpoint_file=checkpoint_file,
+            integrator=integrator,
+            adaptive_tol=adaptive_tol,
+            formula=formula,
+            gate_sink=gate_sink,
+            measure_every=measure_every,
         )
 
         self.adiabatic_data = data
 
-        gates = [gate for gate_layer in data["gates"].values() for gate in gate_layer]
-        n_gates, n_2qg = approximate_adiabatic_cost(gates)
+        n_gates = n_2qg = None
+        if gate_sink == "summary" and exact_cost:
+            summary = data["gates"]
+            n_gates, n_2qg = approximate_adiabatic_cost(
+                summary["samples"], num_gates=summary["num_gates"], exact=True
+            )
+        elif gate_sink == "summary":
+            n_gates, n_2qg = data["gates"]["cost"]
+        elif gate_sink == "memory":
+            gates = [gate for layer in data["gates"].values() for gate in layer]
+            n_gates, n_2qg = approximate_adiabatic_cost(gates, exact=exact_cost)
 
         t_last = max(data["ss"].keys())
         s, e = data["ss"][t_last], data["energy"][t_last]
@@ -542,9 +700,13 @@ class MPSPreparation:
         )
         print(
             f"final overlap @ {s=:.5f} is e={e:.08f}, "
-            f"curr_f={curr_f:.08f}, target_fidelity={tar_f:.08f}\n"
-            f"approximate n_gates={int(n_gates)}, and n_2qg={int(n_2qg)}\n"
+            f"curr_f={curr_f:.08f}, target_fidelity={tar_f:.08f}"
         )
+        if n_2qg is not None and exact_cost:
+            print(f"approximate n_gates={int(n_gates)}, and n_2qg={int(n_2qg)}\n")
+        elif n_2qg is not None:
+            # estimated from the local invariants, see estimate_costs
+            print(f"n_gates<={int(n_gates)} (upper bound), and n_2qg={int(n_2qg)}\n")
         return tar_f, n_2qg
 
 
@@ -556,7 +718,16 @@ class PEPSPreparation:
         self.Lx, self.Ly = len(tensor_grid[0]), len(tensor_grid)
         self.phy_dim = tensor_grid[0][0].shape[-1]
 
-    def adiabatic_state_preparation(self, Tmax, tau, max_bond, verbose=False):
+    def adiabatic_state_preparation(
+        self,
+        Tmax,
+        tau,
+        max_bond,
+        verbose=False,
+        checkpoint_file=None,
+        schedule="sin",
+        formula="first",
+    ):
         """performs adiabatic preparation of the peps using the algorithm
         described in https://arxiv.org/abs/2209.01230
 
@@ -571,6 +742,21 @@ class PEPSPreparation:
         max_bond_dim: int
             max. bond dimension of the mps during adiabatic evolution
 
+        checkpoint_file: str, optional
+            if given, the evolved peps and its history are periodically saved
+            to this file. calling the method again with the same file resumes
+            the evolution from the last saved time step.
+
+        schedule: str or callable, optional
+            interpolation schedule s(t), one of "sin", "sin_sin", "linear" or
+            a function of t.
+
+        formula: str, optional
+            product formula of a trotter step, "first" (one sweep over the
+            bonds), "second" (forward and backward sweep), "midpoint2" (the
+            same evaluated at the midpoint of the step) or the fourth order
+            "suzuki4" and "yoshida4".
+
         Returns
         -------
         dict
@@ -583,9 +769,7 @@ class PEPSPreparation:
             f"runtime={Tmax}, tau={tau:0.04}, steps={int(Tmax/tau)}, "
             f"max_bond={max_bond}")
 
-        # s_func = lambda t: np.sin( (np.pi/2)*np.sin( (np.pi/2)*t/Tmax )**2 )**2
-        s_func = lambda t: np.sin((np.pi / 2) * t / Tmax) ** 2
-        # s_func = lambda t: t/Tmax
+        s_func = make_schedule(schedule, Tmax)
 
         # target_grid, bonds = make_aklt_peps(Lx, Ly)
         initial_grid, bonds = make_bell_pair_peps(self.Lx, self.Ly)
@@ -602,6 +786,8 @@ class PEPSPreparation:
             max_bond,
             s_func,
             verbose=verbose,
+            checkpoint_file=checkpoint_file,
+            formula=formula,
         )
         self.adiabatic_data = data
 
@@ -611,4 +797,7 @@ class PEPSPreparation:
             data["energy"][t_last],
             data["target_fidelity"][t_last],
         )
-        print(f"\n2d adiabatic preparation: @ {s=:.5f}, e={e:.08f}, fidelity={f:.08f}")
+        print(
+            f"\n2d adiabatic preparation: @ {s=:.5f}, e={e:.08f}, fidelity={f:.08f}, "
+            f"n_gates={sum(data['num_gates'].values())}"
+        )
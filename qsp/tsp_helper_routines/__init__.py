@@ -1,3 +1,7 @@
+from .checkpoint import check_checkpoint
+from .checkpoint import load_checkpoint
+from .checkpoint import save_checkpoint
+
 from .helper_routines import blockup_mps
 from .helper_routines import cl_zero_mps
 from .helper_routines import compute_energy_expval
@@ -7,12 +11,29 @@ from .helper_routines import norm_mps_ovrlap
 from .helper_routines import unitaries_sanity_check
 from .helper_routines import unitaries_specs
 
+from .mps_sum import MPSSum
+
+from .validation import get_validation_level
+from .validation import set_validation_level
+from .validation import should_validate
+from .validation import validation_level
+from .validation import with_validation_level
+
 __all__ = [
+    "MPSSum",
     "blockup_mps",
+    "check_checkpoint",
     "cl_zero_mps",
     "compute_energy_expval",
+    "get_validation_level",
+    "load_checkpoint",
     "make_splitted_mps",
     "norm_mps_ovrlap",
+    "save_checkpoint",
+    "set_validation_level",
+    "should_validate",
     "unitaries_sanity_check",
     "unitaries_specs",
+    "validation_level",
+    "with_validation_level",
 ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle as pkl
+
+
+def save_checkpoint(filename, state):
+    """pickles state to filename. the state is first written to a temporary
+    file which then replaces the old checkpoint, so a job killed while writing
+    still leaves the previous checkpoint intact.
+    """
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "wb") as f:
+        pkl.dump(state, f)
+    os.replace(tmp_filename, filename)
+
+
+def load_checkpoint(filename):
+    """returns the state stored in filename, or None if there is nothing to
+    resume from.
+    """
+    if filename is None or not os.path.exists(filename):
+        return None
+
+    with open(filename, "rb") as f:
+        state = pkl.load(f)
+    return state
+
+
+def check_checkpoint(state, **kwargs):
+    """raises ValueError if the checkpoint was written by a run with different
+    settings, e.g. a different runtime or trotter step size.
+    """
+    for key, value in kwargs.items():
+        if key not in state:
+            raise ValueError(
+                f"checkpoint does not record {key} (written by an older "
+                "version), cannot resume"
+            )
+
+        if state[key] != value:
+            raise ValueError(
+                f"checkpoint was written with {key}={state[key]}, "
+                f"cannot resume with {key}={value}"
+            )
@@ -4,6 +4,8 @@ import numpy as np
 import quimb as qu
 import quimb.tensor as qtn
 
+from .validation import should_validate
+
 
 def compute_energy_expval(psi, qubit_hamiltonian):
 
@@ -54,6 +56,9 @@ def unitaries_specs(Gs_lst):
 
 
 def unitaries_sanity_check(Gs_list):
+    if not should_validate("unitaries"):
+        return
+
     chks = []
     for _, _, Gs, _, _ in Gs_list:
         for G in Gs:
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+import quimb.tensor as qtn
+
+
+def mps_to_arrays(mps):
+    """returns the tensors of mps as a list of (left, phys, right) arrays, the
+    end tensors get a dummy bond of size one
+    """
+    L = mps.L
+    arrays = []
+    for i in range(L):
+        left = [mps.bond(i - 1, i)] if i > 0 else []
+        right = [mps.bond(i, i + 1)] if i < L - 1 else []
+        data = mps[i].transpose(*left, mps.site_ind(i), *right).data
+
+        if i == 0:
+            data = data[np.newaxis]
+        if i == L - 1:
+            data = data[..., np.newaxis]
+        arrays.append(np.asarray(data, dtype=np.complex128))
+
+    return arrays
+
+
+def arrays_to_mps(arrays):
+    """inverse of mps_to_arrays"""
+    arrays = [array.transpose(0, 2, 1) for array in arrays]
+    arrays[0] = arrays[0][0]
+    arrays[-1] = arrays[-1][:, 0]
+    return qtn.MatrixProductState(arrays, shape="lrp")
+
+
+def _stack(arrays_list, chi):
+    """stacks the arrays of several mps, zero padding every bond to chi"""
+    K, L, d = len(arrays_list), len(arrays_list[0]), arrays_list[0][0].shape[1]
+    stack = np.zeros((K, L, chi, d, chi), dtype=np.complex128)
+    for k, arrays in enumerate(arrays_list):
+        for i, array in enumerate(arrays):
+            dl, _, dr = array.shape
+            stack[k, i, :dl, :, :dr] = array
+    return stack
+
+
+def _transfer_overlaps(bra_stack, ket_arrays):
+    """<bra_k|ket> for every mps k in bra_stack, contracted site by site"""
+    K = bra_stack.shape[0]
+    env = np.zeros((K, bra_stack.shape[2], 1), dtype=np.complex128)
+    env[:, 0, 0] = 1.0
+    for i, ket in enumerate(ket_arrays):
+        env = np.einsum("kab,kapc,bpd->kcd", env, np.conj(bra_stack[:, i]), ket)
+    return env[:, 0, 0]
+
+
+def _transfer_gram(bra_stack, ket_stack):
+    """<bra_k|ket_l> for every pair of mps in bra_stack and ket_stack"""
+    K, M, chi = bra_stack.shape[0], ket_stack.shape[0], bra_stack.shape[2]
+    env = np.zeros((K, M, chi, ket_stack.shape[2]), dtype=np.complex128)
+    env[:, :, 0, 0] = 1.0
+    for i in range(bra_stack.shape[1]):
+        env = np.einsum(
+            "klab,kapc,lbpd->klcd", env, np.conj(bra_stack[:, i]), ket_stack[:, i]
+        )
+    return env[:, :, 0, 0]
+
+
+class MPSSum:
+    """lazy linear combination sum_i coeffs[i] |terms[i]> of mps (e.g. the
+    bond-2 terms of an lcu). the terms are kept as stacked zero-padded arrays,
+    norms and overlaps are evaluated from the cached gram matrix of the terms,
+    and a (compressed) mps is only built by to_mps.
+
+    Parameters
+    ----------
+    terms : list(quimb.qtn.MatrixProductState), optional
+        mps with the same length and physical dimension
+
+    coeffs : list(complex), optional
+        coefficients of the terms, defaults to ones
+    """
+
+    def __init__(self, terms=(), coeffs=None):
+        self.arrays = []
+        self.coeffs = np.zeros(0, dtype=np.complex128)
+        self.chi = 1
+        self._stack = None
+        self._gram = np.zeros((0, 0), dtype=np.complex128)
+
+        coeffs = np.ones(len(terms)) if coeffs is None else coeffs
+        for term, coeff in zip(terms, coeffs):
+            self.append(term, coeff)
+
+    def __len__(self):
+        return len(self.arrays)
+
+    @property
+    def L(self):
+        return len(self.arrays[0])
+
+    @property
+    def stack(self):
+        if self._stack is None or self._stack.shape[0] != len(self):
+            self._stack = _stack(self.arrays, self.chi)
+        return self._stack
+
+    @property
+    def gram(self):
+        """<t_i|t_j> of the terms, new rows are computed only for new terms"""
+        K, M = len(self), len(self._gram)
+        if M < K:
+            gram = np.zeros((K, K), dtype=np.complex128)
+            gram[:M, :M] = self._gram
+            new = _transfer_gram(self.stack, self.stack[M:])
+            gram[:, M:] = new
+            gram[M:, :] = np.conj(new.T)
+            self._gram = gram
+        return self._gram
+
+    def append(self, term, coeff=1.0):
+        arrays = mps_to_arrays(term)
+        self.chi = max(self.chi, *[max(a.shape[0], a.shape[2]) for a in arrays])
+        self.arrays.append(arrays)
+        self.coeffs = np.append(self.coeffs, coeff)
+
+    def set_coeffs(self, coeffs):
+        self.coeffs = np.asarray(coeffs, dtype=np.complex128)
+
+    def overlaps_with(self, mps):
+        """returns the vector <t_i|mps>"""
+        return _transfer_overlaps(self.stack, mps_to_arrays(mps))
+
+    def overlap(self, mps):
+        """returns <self|mps>"""
+        return np.conj(self.coeffs) @ self.overlaps_with(mps)
+
+    def norm(self):
+        return np.sqrt(np.abs(np.conj(self.coeffs) @ self.gram @ self.coeffs))
+
+    def projection_coefficient(self, mps):
+        """returns <self|mps>/<self|self>, the weight of self in mps"""
+        return self.overlap(mps) / self.norm() ** 2
+
+    def norm_ovrlap(self, mps):
+        """same as norm_mps_ovrlap(self, mps), i.e. <mps|self>/(|mps| |self|)"""
+        mps_norm = np.sqrt(np.abs(mps.H @ mps))
+        return np.conj(self.overlap(mps)) / (self.norm() * mps_norm)
+
+    def to_mps(self, max_bond=None, cutoff=1e-10):
+        """materializes the sum as an mps. the terms are added one by one and
+        the partial sum is compressed after each addition, so the bond
+        dimension never exceeds the rank of the sum (or max_bond)
+        """
+        psi = None
+        for coeff, arrays in zip(self.coeffs, self.arrays):
+            term = arrays_to_mps(arrays) * coeff
+            psi = term if psi is None else psi + term
+            psi.compress(max_bond=max_bond, cutoff=cutoff)
+        return psi
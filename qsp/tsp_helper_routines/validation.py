@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import functools
+
+VALIDATION_LEVELS = ("off", "sampled", "full")
+
+# "full" runs every sanity check, "sampled" runs every sample_every-th call of
+# each check (always including the first), "off" skips them all
+_policy = {"level": "full", "sample_every": 10}
+_counters = {}
+
+
+def _set_policy(level, sample_every=None):
+    if level not in VALIDATION_LEVELS:
+        raise ValueError(
+            f"validation level should be one of {VALIDATION_LEVELS}, got {level}"
+        )
+
+    _policy["level"] = level
+    if sample_every is not None:
+        _policy["sample_every"] = max(1, int(sample_every))
+
+
+def set_validation_level(level, sample_every=None):
+    """sets the global validation level used by all internal sanity checks and
+    restarts the sampling of the checks
+    """
+    _set_policy(level, sample_every=sample_every)
+    _counters.clear()
+
+
+def get_validation_level():
+    return _policy["level"]
+
+
+@contextlib.contextmanager
+def validation_level(level, sample_every=None):
+    """temporarily changes the validation level, level=None leaves it as is.
+    the counters of the sampled checks keep running, so nested and repeated
+    calls sample every sample_every-th call of a check overall.
+    """
+    if level is None:
+        yield
+        return
+
+    previous = dict(_policy)
+    _set_policy(level, sample_every=sample_every)
+    try:
+        yield
+    finally:
+        _policy.update(previous)
+
+
+def should_validate(check):
+    """returns True if the sanity check named check should run at this call"""
+    level = _policy["level"]
+    if level == "full":
+        return True
+
+    if level == "off":
+        return False
+
+    count = _counters.get(check, 0)
+    _counters[check] = count + 1
+    return count % _policy["sample_every"] == 0
+
+
+def with_validation_level(method):
+    """runs method under the validation level stored in self.validation"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with validation_level(self.validation):
+            return method(self, *args, **kwargs)
+
+    return wrapper